@@ -0,0 +1,293 @@
+""" Benchmarks of the hot paths of training and parsing on synthetic data
+
+Prints the results as json (or writes them to --out). Each benchmark
+reports the median and min time (in seconds) over --repeat runs and the
+throughput of the median run.
+
+    python benchmarks/bench_hot_paths.py --out before.json
+    ... change things ...
+    python benchmarks/bench_hot_paths.py --compare before.json
+
+--compare exits with status 1 if any benchmark got slower than the
+baseline by more than --tolerance (a ratio of the median time).
+"""
+import os
+import sys
+import json
+import time
+import codecs
+import shutil
+import argparse
+import tempfile
+import platform
+import numpy as np
+
+# so that we can run from anywhere without installing johnny
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from synthetic import Treebank
+
+
+BLUEPRINTS = {'word_bilstm': 'word-level.yaml',
+              'char_bilstm': 'lstm-char-level.yaml',
+              'char_cnn': 'cnn-char-level.yaml'}
+DECODE_LENGTHS = (5, 10, 20, 40, 80)
+QUICK_DECODE_LENGTHS = (5, 10, 20)
+
+
+def timed(func, repeat, units=None, setup=None):
+    """Time func repeat times - setup is called (untimed) before each run.
+
+    units: dict of name: count of things processed in a run - we report
+    count / median time as <name>_per_sec.
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    median = float(np.median(times))
+    result = {'median': median, 'min': float(np.min(times)), 'repeat': repeat}
+    for name, count in (units or dict()).items():
+        result['%s_per_sec' % name] = count / median if median > 0 else 0.
+    return result
+
+
+def build_parser(blueprint, word_vocab_size, char_vocab_size):
+    """A randomly initialised GraphParser from one of blueprints/*.yaml."""
+    import yaml
+    from johnny.bundle import build
+    from johnny.vocab import UDepVocab
+    with open(os.path.join(ROOT, 'blueprints', blueprint)) as f:
+        conf = yaml.safe_load(f)
+    spec = conf['model']
+    embedder = spec['encoder']['embedder']
+    if conf['subword']:
+        embedder['word_encoder']['vocab_size'] = char_vocab_size
+    else:
+        embedder['in_sizes'] = [word_vocab_size]
+    spec['num_labels'] = len(UDepVocab())
+    return build(spec), conf['subword']
+
+
+def bench_graph_parser(treebank, batch_size, repeat):
+    """Forward and backward pass of GraphParser.__call__ for each encoder."""
+    from johnny.vocab import Vocab, UDepVocab
+    from johnny.text_utils import process_texts, encode_texts
+    results = dict()
+    # one batch of sentences of about the same length, like the buckets
+    order = np.argsort(treebank.lengths, kind='mergesort')
+    middle = len(order) // 2
+    rows = order[max(middle - batch_size // 2, 0):][:batch_size]
+    sents = [treebank.sents[i] for i in rows]
+    heads = [treebank.heads[i] for i in rows]
+    labels = [UDepVocab().encode(treebank.labels[i]) for i in rows]
+    num_tokens = sum(len(sent) for sent in sents)
+    for name, blueprint in sorted(BLUEPRINTS.items()):
+        words = process_texts(sents, 1, False, {'lowercase': True})
+        chars = process_texts(sents, 1, True, {'lowercase': True})
+        v_word = Vocab(size=10000).fit(w for sent in words for w in sent)
+        v_char = Vocab(size=100).fit(c for sent in chars
+                                     for w in sent for c in w)
+        np.random.seed(0)
+        model, subword = build_parser(blueprint, len(v_word), len(v_char))
+        if subword:
+            ids = encode_texts(chars, v_char, is_subword=True)
+        else:
+            ids = encode_texts(words, v_word)
+
+        def forward():
+            model.cleargrads()
+            model(ids, heads=heads, labels=labels)
+
+        def backward():
+            model.loss.backward()
+
+        units = {'tokens': num_tokens, 'sents': len(sents)}
+        results['graph_parser.%s.forward' % name] = timed(forward, repeat, units)
+        results['graph_parser.%s.backward' % name] = timed(backward, repeat,
+                                                           units, setup=forward)
+    return results
+
+
+def bench_decoder(lengths, repeat, seed):
+    """DependencyDecoder - chu liu edmonds and eisner vs sentence length."""
+    from johnny.extern import DependencyDecoder
+    rs = np.random.RandomState(seed)
+    dd = DependencyDecoder()
+    results = dict()
+    for l in lengths:
+        # the way GraphParser calls it - root column is zeros
+        scores = np.pad(rs.rand(l + 1, l), ((0, 0), (1, 0)), 'constant')
+        units = {'sents': 1}
+        results['decoder.nonproj.len_%d' % l] = timed(
+            lambda: dd.parse_nonproj(scores), repeat, units)
+        results['decoder.proj.len_%d' % l] = timed(
+            lambda: dd.parse_proj(scores), repeat, units)
+    return results
+
+
+def bench_load_conllu(treebank, repeat):
+    from johnny.dep import UDepLoader
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'synthetic.conllu')
+        with codecs.open(path, 'w', encoding='utf-8') as f:
+            f.write(treebank.to_conllu())
+        units = {'sents': len(treebank), 'tokens': treebank.num_tokens}
+        return {'load_conllu_sents': timed(
+            lambda: UDepLoader.load_conllu_sents(path), repeat, units)}
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_vocab(treebank, repeat):
+    from johnny.vocab import Vocab
+    vocab = Vocab(size=10000).fit(w for sent in treebank.sents for w in sent)
+    units = {'sents': len(treebank), 'tokens': treebank.num_tokens}
+
+    def encode():
+        for sent in treebank.sents:
+            vocab.encode(sent)
+
+    return {'vocab.encode': timed(encode, repeat, units),
+            'vocab.encode_batch': timed(
+                lambda: vocab.encode_batch(treebank.sents), repeat, units)}
+
+
+def bench_buckets(treebank, batch_size, repeat):
+    from johnny.misc import BucketManager
+    rows = list(zip(treebank.sents, treebank.heads, treebank.labels))
+    max_len = int(treebank.lengths.max())
+    units = {'sents': len(treebank)}
+    results = dict()
+    for name, kwargs in (('batch_size', dict(batch_size=batch_size)),
+                         ('token_budget', dict(batch_size=None,
+                                               token_budget=batch_size * 20))):
+        np.random.seed(0)
+        buckets = BucketManager(rows, 5, max_len, right_leak=5,
+                                row_key=lambda row: len(row[0]), **kwargs)
+
+        def epoch():
+            for _ in buckets:
+                pass
+
+        results['buckets.%s' % name] = timed(epoch, repeat, units,
+                                             setup=buckets.reset)
+    return results
+
+
+def bench_process_text(treebank, repeat):
+    from johnny.text_utils import process_text, process_texts, clear_cache
+    funcs = {'lowercase': True, 'expand_diacritics': True}
+    units = {'sents': len(treebank), 'tokens': treebank.num_tokens}
+
+    def per_sent():
+        for sent in treebank.sents:
+            process_text(sent, 1, True, funcs)
+
+    results = dict()
+    # cold: nothing cached, warm: every word type seen in the previous run
+    results['process_text.cold'] = timed(per_sent, repeat, units,
+                                         setup=clear_cache)
+    results['process_text.warm'] = timed(per_sent, repeat, units)
+    results['process_texts.cold'] = timed(
+        lambda: process_texts(treebank.sents, 1, True, funcs), repeat,
+        units, setup=clear_cache)
+    clear_cache()
+    return results
+
+
+def run(args):
+    scale = 0.1 if args.quick else 1.
+    treebank = Treebank(num_sents=int(args.num_sents * scale),
+                        mean_len=args.mean_len, sigma=args.sigma,
+                        max_len=args.max_len, seed=args.seed)
+    benches = {
+        'graph_parser': lambda: bench_graph_parser(treebank, args.batch_size,
+                                                   args.repeat),
+        'decoder': lambda: bench_decoder(QUICK_DECODE_LENGTHS if args.quick
+                                         else DECODE_LENGTHS,
+                                         args.repeat, args.seed),
+        'load_conllu': lambda: bench_load_conllu(treebank, args.repeat),
+        'vocab': lambda: bench_vocab(treebank, args.repeat),
+        'buckets': lambda: bench_buckets(treebank, args.batch_size, args.repeat),
+        'process_text': lambda: bench_process_text(treebank, args.repeat)
+    }
+    results = dict()
+    for name in args.only or sorted(benches):
+        results.update(benches[name]())
+    return results
+
+
+def meta(args):
+    import chainer
+    return {'python': platform.python_version(),
+            'numpy': np.__version__,
+            'chainer': chainer.__version__,
+            'machine': platform.machine(),
+            'seed': args.seed,
+            'num_sents': int(args.num_sents * (0.1 if args.quick else 1.)),
+            'mean_len': args.mean_len,
+            'quick': args.quick}
+
+
+def regressions(results, baseline, tolerance):
+    """Benchmarks whose median time is over (1 + tolerance) times that of
+    the baseline - returns a dict of name: ratio."""
+    slower = dict()
+    for name, result in results.items():
+        if name in baseline and baseline[name]['median'] > 0:
+            ratio = result['median'] / baseline[name]['median']
+            if ratio > 1. + tolerance:
+                slower[name] = ratio
+    return slower
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths '
+                                     'of johnny on synthetic data')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--num_sents', type=int, default=2000,
+                        help='Sentences in the synthetic treebank.')
+    parser.add_argument('--mean_len', type=float, default=20.,
+                        help='Median sentence length (lognormal).')
+    parser.add_argument('--sigma', type=float, default=0.6,
+                        help='Spread of the sentence lengths (lognormal).')
+    parser.add_argument('--max_len', type=int, default=100)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--quick', action='store_true',
+                        help='A tenth of the sentences and short lengths '
+                        'for the decoder - a smoke test.')
+    parser.add_argument('--only', type=str, nargs='+',
+                        choices=('graph_parser', 'decoder', 'load_conllu',
+                                 'vocab', 'buckets', 'process_text'),
+                        help='Only run these benchmarks.')
+    parser.add_argument('--out', type=str,
+                        help='Write the json here instead of stdout.')
+    parser.add_argument('--compare', type=str,
+                        help='json of a previous run to check for regressions.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed slowdown relative to --compare.')
+    args = parser.parse_args()
+
+    report = {'meta': meta(args), 'results': run(args)}
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        slower = regressions(report['results'], baseline, args.tolerance)
+        for name, ratio in sorted(slower.items()):
+            sys.stderr.write('%s is %.2fx slower than the baseline\n'
+                             % (name, ratio))
+        if slower:
+            sys.exit(1)
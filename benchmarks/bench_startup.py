@@ -0,0 +1,108 @@
+""" Time to first parse of a fresh process - import, load and parse
+
+Each run starts a new python process, so nothing is cached in memory.
+Prints the median timings (in seconds) as json.
+
+    python benchmarks/bench_startup.py --bundle models/.../mytest.bundle
+    python benchmarks/bench_startup.py  # synthetic word level model
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+# so that we can run from anywhere without installing johnny
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+CHILD = '''
+import sys, time, json
+start = time.time()
+from johnny.parse import Parser
+imported = time.time()
+parser = Parser(sys.argv[1])
+loaded = time.time()
+parser.parse([["the", "cat", "sat", "on", "the", "mat"]])
+parsed = time.time()
+print(json.dumps({"import": imported - start, "load": loaded - imported,
+                  "first_parse": parsed - loaded, "to_first_parse": parsed - start}))
+'''
+
+
+def synthetic_bundle(path, vocab_size=5000, num_units=200):
+    """A randomly initialised word level model with the architecture of
+    blueprints/word-level.yaml."""
+    import chainer
+    from johnny.bundle import build, save_bundle
+    from johnny.vocab import Vocab, UDepVocab, save_vocabs
+    words = ['w%d' % i for i in range(vocab_size)] + ['the', 'cat', 'sat', 'on', 'mat']
+    vocab = Vocab(size=len(words)).fit(words)
+    model_spec = {'$module': 'johnny.models', '$classname': 'GraphParser',
+                  'encoder': {'$module': 'johnny.components',
+                              '$classname': 'SentenceEncoder',
+                              'num_units': num_units, 'num_layers': 2,
+                              'use_bilstm': True,
+                              'embedder': {'$module': 'johnny.components',
+                                           '$classname': 'Embedder',
+                                           'in_sizes': [len(vocab)],
+                                           'out_sizes': [num_units]}},
+                  'mlp_arc_units': 100, 'mlp_lbl_units': 100,
+                  'num_labels': len(UDepVocab()), 'treeify': 'chu'}
+    tmp = tempfile.mkdtemp()
+    try:
+        model_path = os.path.join(tmp, 'model.npz')
+        vocab_path = os.path.join(tmp, 'vocab')
+        chainer.serializers.save_npz(model_path, build(model_spec))
+        save_vocabs(vocab_path, dict(text=vocab, arcs=UDepVocab()))
+        config = {'ngram': 1, 'subword': False,
+                  'preprocess': {'lowercase': True}, 'model': model_spec}
+        save_bundle(path, config, model_path, vocab_path)
+    finally:
+        shutil.rmtree(tmp)
+
+
+def time_startup(path, repeat):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(p for p in (ROOT, env.get('PYTHONPATH')) if p)
+    runs = []
+    for _ in range(repeat):
+        start = time.time()
+        out = subprocess.check_output([sys.executable, '-c', CHILD, path], env=env)
+        timings = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+        # including starting the interpreter
+        timings['process_to_first_parse'] = time.time() - start
+        runs.append(timings)
+    return dict((key, float(np.median([run[key] for run in runs])))
+                for key in runs[0])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark time to first parse')
+    parser.add_argument('--bundle', type=str,
+                        help='Model bundle folder - a synthetic one if not set.')
+    parser.add_argument('--blueprint', type=str,
+                        help='Also time loading this blueprint (mlconf).')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    results = dict()
+    tmp = None
+    bundle = args.bundle
+    if bundle is None:
+        tmp = tempfile.mkdtemp()
+        bundle = os.path.join(tmp, 'synthetic.bundle')
+        synthetic_bundle(bundle)
+    try:
+        results['bundle'] = time_startup(bundle, args.repeat)
+        if args.blueprint is not None:
+            results['blueprint'] = time_startup(args.blueprint, args.repeat)
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp)
+    print(json.dumps(results, indent=2, sort_keys=True))
@@ -0,0 +1,93 @@
+""" Synthetic, seedable treebanks for the benchmarks
+
+Sentence lengths follow a lognormal distribution (like real treebanks -
+mostly short sentences with a long tail) and words follow a zipf
+distribution over a fixed lexicon of random letter strings.
+"""
+import io
+import string
+import numpy as np
+from johnny.vocab import UDepVocab
+
+
+LETTERS = np.array(list(string.ascii_lowercase))
+
+
+def sent_lengths(random_state, num_sents, mean=20., sigma=0.6, max_len=100):
+    """num_sents lengths in [1, max_len] - mean is the median length."""
+    lengths = random_state.lognormal(np.log(mean), sigma, size=num_sents)
+    return np.clip(np.round(lengths), 1, max_len).astype(np.int64)
+
+
+def lexicon(random_state, size, mean_len=6.):
+    """size distinct word types - some capitalized, some numbers."""
+    words, seen = [], set()
+    while len(words) < size:
+        n = max(int(random_state.poisson(mean_len)), 1)
+        word = ''.join(random_state.choice(LETTERS, size=n))
+        draw = random_state.rand()
+        if draw < 0.1:
+            word = word.capitalize()
+        elif draw < 0.15:
+            word = str(random_state.randint(10 ** n))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+
+def sentences(random_state, lengths, words, zipf_a=1.3):
+    """A sentence of zipf distributed words for each length."""
+    ranks = random_state.zipf(zipf_a, size=int(np.sum(lengths))) - 1
+    tokens = [words[r % len(words)] for r in ranks]
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    return [tuple(tokens[s:e]) for s, e in zip(offsets[:-1], offsets[1:])]
+
+
+def heads(random_state, length):
+    """Random (not necessarily well formed) heads - no self loops."""
+    h = random_state.randint(0, length, size=length)
+    # positions are 1 based, skip over ourselves
+    h[h >= np.arange(1, length + 1)] += 1
+    return tuple(h.tolist())
+
+
+class Treebank(object):
+    """A synthetic treebank.
+
+    sents: tuple of words per sentence
+    heads: tuple of heads per sentence
+    labels: tuple of dependency labels per sentence
+    """
+
+    def __init__(self, num_sents=1000, mean_len=20., sigma=0.6, max_len=100,
+                 vocab_size=10000, seed=0):
+        super(Treebank, self).__init__()
+        rs = np.random.RandomState(seed)
+        self.lengths = sent_lengths(rs, num_sents, mean=mean_len,
+                                    sigma=sigma, max_len=max_len)
+        self.sents = sentences(rs, self.lengths, lexicon(rs, vocab_size))
+        self.heads = [heads(rs, l) for l in self.lengths]
+        label_set = UDepVocab.TAGS
+        self.labels = [tuple(label_set[i] for i in
+                             rs.randint(0, len(label_set), size=l))
+                       for l in self.lengths]
+
+    def __len__(self):
+        return len(self.sents)
+
+    @property
+    def num_tokens(self):
+        return int(np.sum(self.lengths))
+
+    def to_conllu(self):
+        """The treebank as CoNLL-U text."""
+        out = io.StringIO()
+        for i, (words, hs, ls) in enumerate(zip(self.sents, self.heads,
+                                                self.labels)):
+            out.write(u'# sent_id = %d\n' % (i + 1))
+            for j, (w, h, l) in enumerate(zip(words, hs, ls)):
+                out.write(u'%d\t%s\t%s\tX\t_\t_\t%d\t%s\t_\t_\n'
+                          % (j + 1, w, w.lower(), h, l))
+            out.write(u'\n')
+        return out.getvalue()
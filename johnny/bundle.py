@@ -0,0 +1,122 @@
+""" Self contained model bundles that load fast
+
+A bundle is a folder with:
+
+    config.json - the architecture of the model (in blueprint form, with
+                  $module and $classname entries) and the text settings
+    model.npz   - the weights (uncompressed)
+    vocab       - the vocabs in the binary format of johnny.vocab
+
+Loading a bundle doesn't need mlconf (or yaml) and chainer is only
+imported when the model is built.
+"""
+import os
+import json
+import shutil
+import importlib
+import numpy as np
+from johnny.vocab import is_vocab_file, load_vocabs, save_vocabs
+
+
+CONFIG_FILE = 'config.json'
+WEIGHTS_FILE = 'model.npz'
+VOCAB_FILE = 'vocab'
+BUNDLE_VERSION = 1
+MODULE = '$module'
+CLASS = '$classname'
+POSITIONAL = '$pos_args'
+# settings of the blueprint we need to process text at parse time
+TEXT_KEYS = ('ngram', 'subword', 'preprocess')
+
+
+def is_bundle(path):
+    return os.path.isfile(os.path.join(path, CONFIG_FILE))
+
+
+def build(spec):
+    """Instantiate the classes in spec (same rules as mlconf's
+    Blueprint.build - dicts with $module and $classname entries are
+    replaced by instances of the class, built with the rest of the
+    entries as keyword arguments)."""
+    if isinstance(spec, dict):
+        spec = dict((key, build(val)) for key, val in spec.items())
+        if MODULE in spec and CLASS in spec:
+            module = importlib.import_module(spec.pop(MODULE))
+            cls = getattr(module, spec.pop(CLASS))
+            pos_args = spec.pop(POSITIONAL, ())
+            return cls(*pos_args, **spec)
+        return spec
+    elif isinstance(spec, (list, tuple)):
+        return [build(val) for val in spec]
+    return spec
+
+
+def save_bundle(path, config, model_path, vocab_path):
+    """Write a bundle to the folder path.
+
+    config: dict - the blueprint of a trained model as a dict (we keep
+    model and the text settings).
+
+    model_path, vocab_path: the weights and the vocabs of the model as
+    saved by train.py.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    bundle_config = dict((key, config[key]) for key in TEXT_KEYS)
+    bundle_config['model'] = config['model']
+    bundle_config['version'] = BUNDLE_VERSION
+    # uncompressed weights are faster to load
+    with np.load(model_path) as npz:
+        np.savez(os.path.join(path, WEIGHTS_FILE),
+                 **dict((k, npz[k]) for k in npz.files))
+    if is_vocab_file(vocab_path):
+        shutil.copyfile(vocab_path, os.path.join(path, VOCAB_FILE))
+    else:
+        # pickled vocabs of models trained before the binary format
+        from johnny.parse import load_model_vocabs
+        save_vocabs(os.path.join(path, VOCAB_FILE), load_model_vocabs(vocab_path))
+    # the config is written last - a folder is only a bundle once it has one
+    tmp_path = os.path.join(path, CONFIG_FILE + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(bundle_config, f, indent=2, sort_keys=True)
+    shutil.move(tmp_path, os.path.join(path, CONFIG_FILE))
+
+
+def load_bundle(path, treeify=None):
+    """Load the bundle in the folder path.
+
+    treeify: if specified, overrides how the model postprocesses arcs.
+
+    returns: the model with its weights loaded, the vocabs (see
+    johnny.vocab.load_vocabs) and the config dict.
+    """
+    with open(os.path.join(path, CONFIG_FILE)) as f:
+        config = json.load(f)
+    if config.get('version') != BUNDLE_VERSION:
+        raise ValueError('Unsupported bundle version %s' % config.get('version'))
+    if treeify is not None:
+        config['model']['treeify'] = treeify
+    # heavy imports are deferred until here
+    from chainer import serializers
+    model = build(config['model'])
+    serializers.load_npz(os.path.join(path, WEIGHTS_FILE), model)
+    vocabs = load_vocabs(os.path.join(path, VOCAB_FILE))
+    return model, vocabs, config
+
+
+if __name__ == "__main__":
+    import argparse
+    from mlconf import Blueprint
+
+    parser = argparse.ArgumentParser(description='Create a model bundle from '
+                                     'the blueprint of a trained model')
+    parser.add_argument('--blueprint', required=True, type=str,
+                        help='Path to .bp blueprint file produced by training.')
+    parser.add_argument('--out', required=True, type=str,
+                        help='Folder to write the bundle to.')
+    args = parser.parse_args()
+
+    blueprint = Blueprint.from_file(args.blueprint)
+    save_bundle(args.out, blueprint.as_dict(), blueprint.model_path,
+                blueprint.vocab_path)
+    print('Wrote bundle to %s' % args.out)
@@ -0,0 +1,239 @@
+""" Saving and restoring the full state of training so that it can be resumed """
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+import numpy as np
+from six.moves import queue
+from chainer import serializers
+from johnny.misc import rng_state_dict, load_rng_state_dict
+
+
+MODEL_PREFIX = 'model/'
+OPTIMIZER_PREFIX = 'optimizer/'
+RULE_T_PREFIX = 'rule_t/'
+BUCKETS_PREFIX = 'buckets/'
+RNG_PREFIX = 'rng/'
+COUNTERS_KEY = 'counters'
+# os.replace is atomic on windows too, but python 2 doesn't have it
+_replace = getattr(os, 'replace', os.rename)
+
+
+def _prefixed(prefix, d):
+    return dict(('%s%s' % (prefix, k), v) for k, v in d.items())
+
+
+def _unprefixed(prefix, d):
+    return dict((k[len(prefix):], v) for k, v in d.items()
+                if k.startswith(prefix))
+
+
+def training_state(model, optimizer, buckets, counters):
+    """Everything we need to resume training as a flat dict of arrays.
+
+    model, optimizer: the chainer link and optimizer being trained.
+
+    buckets: BucketManager we are drawing training batches from.
+
+    counters: dict - anything else train_loop keeps track of (epoch,
+    patience, results so far..) - needs to be json serialisable.
+    """
+    state = dict()
+    serializers.DictionarySerializer(state, MODEL_PREFIX).save(model)
+    serializers.DictionarySerializer(state, OPTIMIZER_PREFIX).save(optimizer)
+    # chainer only saves the step count of the optimizer, but each update
+    # rule keeps its own and Adam uses it to correct its bias
+    for name, param in model.namedparams():
+        rule = getattr(param, 'update_rule', None)
+        if rule is not None:
+            state['%s%s' % (RULE_T_PREFIX, name)] = np.array(rule.t)
+    state.update(_prefixed(BUCKETS_PREFIX, buckets.state_dict()))
+    state.update(_prefixed(RNG_PREFIX, rng_state_dict()))
+    state[COUNTERS_KEY] = np.array(json.dumps(counters, default=float))
+    return state
+
+
+def restore_training_state(state, model, optimizer, buckets):
+    """Load a state returned by training_state into model, optimizer and
+    buckets and reset numpy's global random state. The optimizer must
+    already be setup with the model.
+
+    returns: the counters dict
+    """
+    serializers.NpzDeserializer(state, path=MODEL_PREFIX).load(model)
+    serializers.NpzDeserializer(state, path=OPTIMIZER_PREFIX).load(optimizer)
+    for name, param in model.namedparams():
+        rule = getattr(param, 'update_rule', None)
+        key = '%s%s' % (RULE_T_PREFIX, name)
+        if rule is not None and key in state:
+            rule.t = int(state[key])
+    buckets.load_state_dict(_unprefixed(BUCKETS_PREFIX, state))
+    load_rng_state_dict(_unprefixed(RNG_PREFIX, state))
+    return json.loads(str(state[COUNTERS_KEY]))
+
+
+def atomic_savez(path, arrays, compress=False, keep=1):
+    """Write arrays to path as an npz file. We write to a temporary file
+    in the same folder and rename it, so path always holds either the
+    previous or the new complete file - never half of one.
+
+    keep: how many files to keep - previous files are kept as path.1,
+    path.2 .. (see rotate)
+
+    returns: the number of bytes written
+    """
+    folder = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if compress:
+                np.savez_compressed(f, **arrays)
+            else:
+                np.savez(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        num_bytes = os.path.getsize(tmp_path)
+        rotate(path, keep)
+        _replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return num_bytes
+
+
+def save_training_state(path, model, optimizer, buckets, counters):
+    """Save the training state to path (see training_state)."""
+    return atomic_savez(path, training_state(model, optimizer,
+                                             buckets, counters))
+
+
+def load_training_state(path, model, optimizer, buckets):
+    """Load the training state saved in path (see restore_training_state)."""
+    with np.load(path) as npz:
+        state = dict((k, npz[k]) for k in npz.files)
+    return restore_training_state(state, model, optimizer, buckets)
+
+
+def _serialized(obj):
+    serializer = serializers.DictionarySerializer()
+    serializer.save(obj)
+    return serializer.target
+
+
+def rotate(path, keep):
+    """Shift path.1 -> path.2 .. and copy path to path.1, so that together
+    with a new file at path at most keep files are left. path itself stays
+    in place, it is about to be atomically replaced."""
+    if keep <= 1 or not os.path.exists(path):
+        return
+    for i in range(keep - 1, 1, -1):
+        older = '%s.%d' % (path, i - 1)
+        if os.path.exists(older):
+            _replace(older, '%s.%d' % (path, i))
+    previous = '%s.1' % path
+    if os.path.exists(previous):
+        os.remove(previous)
+    try:
+        # no need to copy the data, the new file will get a new inode
+        os.link(path, previous)
+    except (AttributeError, OSError):
+        shutil.copy2(path, previous)
+
+
+class AsyncCheckpointer(object):
+    """Writes checkpoints from a background thread.
+
+    save takes a snapshot of the arrays in host memory (so training can
+    carry on modifying the parameters) and returns straight away - the
+    file is written by the thread, atomically (see atomic_savez). The last
+    keep files written to the same path are kept as path.1, path.2 ..
+
+    stats returns how long the last write took and how large it was.
+    Errors in the thread are raised by the next call to save or close.
+
+    The thread is only started by the first save, so that processes we
+    fork before that (eg: DataParallel workers) don't inherit it.
+    """
+
+    def __init__(self, keep=1, compress=False, name='checkpoint', max_pending=2):
+        super(AsyncCheckpointer, self).__init__()
+        self.keep = keep
+        self.compress = compress
+        self.name = name
+        self.num_writes = 0
+        self.last_write_time = 0.
+        self.last_write_bytes = 0
+        self.total_write_time = 0.
+        self._error = None
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = None
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _check_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def save(self, path, arrays):
+        """Queue arrays (dict of name -> array) to be written to path."""
+        self._check_error()
+        if self._closed:
+            raise ValueError('Checkpointer is closed')
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._consume)
+            self._thread.daemon = True
+            self._thread.start()
+        snapshot = dict((k, np.array(v, copy=True)) for k, v in arrays.items())
+        self._queue.put((path, snapshot))
+
+    def save_model(self, path, model):
+        """Same as chainer.serializers.save_npz, but asynchronous."""
+        self.save(path, _serialized(model))
+
+    def _consume(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                path, arrays = item
+                start = time.time()
+                num_bytes = atomic_savez(path, arrays, compress=self.compress,
+                                         keep=self.keep)
+                self.last_write_time = time.time() - start
+                self.last_write_bytes = num_bytes
+                self.total_write_time += self.last_write_time
+                self.num_writes += 1
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """Wait for queued checkpoints to be written."""
+        if self._thread is not None:
+            self._queue.join()
+        self._check_error()
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._closed = True
+        self._check_error()
+
+    def stats(self):
+        """Stats of the writes that have finished so far."""
+        return {'%s_writes' % self.name: self.num_writes,
+                '%s_write_time' % self.name: self.last_write_time,
+                '%s_write_bytes' % self.name: self.last_write_bytes}
@@ -6,6 +6,7 @@ import chainer.links as L
 import chainer.links.connection.n_step_lstm as chainer_nstep
 from johnny.extern import NStepLSTMBase
 from johnny.vocab import augment_seq, augment_seq_nested, augment_word, reserved
+from johnny.misc import NULL_TIMER
 
 CHAINER_IGNORE_LABEL = -1
 
@@ -87,6 +88,8 @@ class SentenceEncoder(chainer.Chain):
 
 
     CHAINER_IGNORE_LABEL = -1
+    # see GraphParser.set_timer
+    timer = NULL_TIMER
 
     def __init__(self, embedder, use_bilstm=True, num_layers=1,
                  num_units=100, dropout=0.2):
@@ -134,71 +137,55 @@ class SentenceEncoder(chainer.Chain):
                      for i in range(max_seq_len)]
         return batch
 
+    def prepare(self, *in_seqs):
+        """Do the python side work on the input before we can encode it.
+        See PreparedInputs."""
+        return PreparedInputs(in_seqs,
+                              is_subword=getattr(self.embedder, 'is_subword', False))
+
     def __call__(self, *in_seqs):
         """Creates lstm embedding of the sentence and pos tags.
         If use_bilstm is specified - the embedding is formed from
         concatenating the forward and backward activations
         corresponding to each word.
-        """
-        sents = in_seqs[0]
-        # all sequences in in_seqs are assumed to have length corresponding
-        # to in_seqs[0]
-        # we add 1 because we are augmenting the sentence with a ROOT symbol 
-        self.max_seq_len = len(sents[0]) + 1
-        self.batch_size = len(sents)
 
-        # before we modify input we check if our embedder handles subword
-        # information. if so we want to pass the list of individual words
-        # to the embedder for efficiency purposes (we can encode each word
-        # and employ a lookup table on the actual forward pass for each
-        # batch). We assume the subword tokens are passed in a 3D array
-        # as in_seqs[0] -> sentences x words in sentence x tokens in words
-        if getattr(self.embedder, 'is_subword', False):
-            # pad each word with START_WORD END_WORD
-            sents = tuple(tuple(map(augment_word, s)) for s in sents)
-            # unique list of words sorted from longest to shortest
-            word_set = set(chain.from_iterable(sents))
-            # also include the sentence level markers
-            # as single words [token]
-            word_set.update([(reserved.START_SENTENCE,),
-                             (reserved.END_SENTENCE,),
-                             (reserved.ROOT,)])
-            word_encoder = self.embedder.word_encoder
-            word_encoder.encode_words(word_set)
-            # replace 3D input with 2D - words replaced with hash
-            fwd_first = tuple(tuple(map(word_encoder.word_to_index,
-                                        augment_seq_nested(s)))
-                              for s in sents)
-            fwd_rest = [self.transpose_batch(tuple(map(augment_seq, seq)))
-                        for seq in in_seqs[1:]]
-            fwd = [self.transpose_batch(fwd_first)]
-            fwd.extend(fwd_rest)
+        in_seqs are either the sequences themselves or a single
+        PreparedInputs returned by prepare.
+        """
+        if isinstance(in_seqs[0], PreparedInputs):
+            batch = in_seqs[0]
         else:
-            # we augment sequence here - augmenting with START, ROOT at the
-            # beginning and END at the you know where
-            # turn batch_size x seq_len -> seq_len x batch_size
-            # NOTE: seq_len is variable - we aren't padding
-            fwd = [self.transpose_batch(tuple(map(augment_seq, seq)))
-                   for seq in in_seqs]
-
-        # collapse all ids into a vector
-        embeddings = self.embedder(*(F.concat(f, axis=0) for f in fwd))
-
-        col_lengths = [len(col) for col in fwd[0]]
-
-        # use np because cumsum crashes gpu - I know, right?
-        batch_split = np.cumsum(col_lengths[:-1])
-        # split back to batch size
-        batch_embeddings = F.split_axis(embeddings, batch_split, axis=0)
-
-        _, _, states = self.rnn(None, None, batch_embeddings)
+            batch = self.prepare(*in_seqs)
+        # we add 1 because we are augmenting the sentence with a ROOT symbol 
+        self.max_seq_len = batch.max_seq_len
+        self.batch_size = batch.batch_size
+
+        # if our embedder handles subword information we pass the list of
+        # individual words to the embedder for efficiency purposes (we can
+        # encode each word and employ a lookup table on the actual forward
+        # pass for each batch). The first input then holds the index of each
+        # word in that list.
+        if batch.words is not None:
+            with self.timer.stage('encode_words'):
+                self.embedder.word_encoder.encode_words(batch.words)
+
+        with self.timer.stage('embed'):
+            # all ids are already collapsed into a vector
+            embeddings = self.embedder(*(chainer.Variable(self.xp.asarray(f))
+                                         for f in batch.flat))
+
+            # use np because cumsum crashes gpu - I know, right?
+            batch_split = np.cumsum(batch.aug_col_lengths[:-1])
+            # split back to batch size
+            batch_embeddings = F.split_axis(embeddings, batch_split, axis=0)
+
+        with self.timer.stage('lstm'):
+            _, _, states = self.rnn(None, None, batch_embeddings)
 
         # we don't use the START and END encoded states in attention
         # so we get rid of them from states and col_lengths
-        # also creates col_lengths
-        # states = self.deaugment(states)
         keep = list()
-        self.col_lengths = []
+        self.col_lengths = batch.col_lengths
         # END tokens are spread out across the matrix since
         # we have variable length inputs (sorted)
         # eg:  S R 1 2 3 4 E     We want to get rid of S and E without
@@ -208,38 +195,22 @@ class SentenceEncoder(chainer.Chain):
         # to:  1 2 3 4
         #      5 6
         #      7
-        for i in range(1, len(states) - 1):
-            # if the next column is shorter, it means that in the original
-            # data this column was shorter. If not clear imagine a layer of
-            # blocks falling when playing tetris.
-            diff = len(states[i]) - len(states[i+1])
-            if diff > 0:
-                clean = states[i][:-diff]
-            else:
-                clean = states[i]
-            col_len = len(clean)
-            self.col_lengths.append(col_len)
-            keep.append(F.pad(clean,
-                              ((0, self.batch_size - col_len), (0,0)),
-                              'constant',
-                              constant_values=0.))
-        states = F.vstack(keep)
         # discard first and last column. The first column always contains
         # START. The last column contains only END but END tokens are
-        # spread throughout.
-
-        # states = F.vstack((F.pad(s,
-        #                          ((0, self.batch_size - len(s)), (0,0)),
-        #                          'constant',
-        #                          constant_values=0.)
-        #                    for s in states))
-
-        mask_shape = (self.batch_size, self.max_seq_len)
-        self.mask = self.xp.ones(mask_shape, dtype=self.xp.bool_)
-        for i, l in enumerate(self.col_lengths):
-            self.mask[l:, i] = False
-
-        if getattr(self.embedder, 'is_subword', False):
+        # spread throughout - col_lengths tells us how many of each column
+        # to keep.
+        with self.timer.stage('deaugment'):
+            for i in range(1, len(states) - 1):
+                col_len = self.col_lengths[i - 1]
+                keep.append(F.pad(states[i][:col_len],
+                                  ((0, self.batch_size - col_len), (0,0)),
+                                  'constant',
+                                  constant_values=0.))
+            states = F.vstack(keep)
+
+        self.mask = self.xp.asarray(batch.mask)
+
+        if batch.words is not None:
             # Remember to clear cache
             self.embedder.word_encoder.clear_cache()
 
@@ -247,6 +218,79 @@ class SentenceEncoder(chainer.Chain):
         return states
 
 
+def transpose_seqs(seqs):
+    """Same as SentenceEncoder.transpose_batch but returns int32 numpy
+    arrays. seqs must be sorted from longest to shortest."""
+    lengths = np.array([len(s) for s in seqs], dtype=np.int64)
+    flat = np.fromiter(chain.from_iterable(seqs), dtype=np.int32,
+                       count=int(lengths.sum()))
+    starts = np.cumsum(lengths) - lengths
+    num_active = at_least(lengths)[1:]
+    return [flat[starts[:n] + i] for i, n in enumerate(num_active)]
+
+
+def at_least(lengths):
+    """Entry j is the number of lengths that are at least j."""
+    counts = np.bincount(lengths)
+    return counts[::-1].cumsum()[::-1].tolist()
+
+
+class PreparedInputs(object):
+    """A batch of sentences augmented with the START, ROOT and END symbols
+    and transposed to time major int32 arrays - all the work SentenceEncoder
+    needs done before it can start computing.
+
+    This only uses numpy and doesn't touch the model, so it can be created
+    in a background thread while the model is busy with another batch
+    (see johnny.misc.Prefetcher).
+
+    NOTE: in_seqs must be sorted from longest to shortest sentence.
+    """
+
+    def __init__(self, in_seqs, is_subword=False):
+        super(PreparedInputs, self).__init__()
+        sents = in_seqs[0]
+        self.batch_size = len(sents)
+        # we add 1 because we are augmenting the sentence with a ROOT symbol 
+        self.max_seq_len = len(sents[0]) + 1
+        lengths = np.array([len(s) for s in sents], dtype=np.int64)
+
+        # We assume the subword tokens are passed in a 3D array
+        # as in_seqs[0] -> sentences x words in sentence x tokens in words
+        if is_subword:
+            # pad each word with START_WORD END_WORD
+            sents = tuple(tuple(map(augment_word, s)) for s in sents)
+            word_set = set(chain.from_iterable(sents))
+            # also include the sentence level markers
+            # as single words [token]
+            word_set.update([(reserved.START_SENTENCE,),
+                             (reserved.END_SENTENCE,),
+                             (reserved.ROOT,)])
+            # unique list of words sorted from longest to shortest - the
+            # word encoders give word i of the list index i
+            self.words = sorted(word_set, key=lambda w: (-len(w), w))
+            word_index = dict((w, i) for i, w in enumerate(self.words))
+            # replace 3D input with 2D - words replaced with their index
+            first = tuple(tuple(word_index[tuple(w)]
+                                for w in augment_seq_nested(s))
+                          for s in sents)
+        else:
+            self.words = None
+            first = tuple(map(augment_seq, sents))
+        # turn batch_size x seq_len -> seq_len x batch_size
+        # NOTE: seq_len is variable - we aren't padding
+        cols = [transpose_seqs(first)]
+        cols.extend(transpose_seqs(tuple(map(augment_seq, seq)))
+                    for seq in in_seqs[1:])
+        self.aug_col_lengths = [len(col) for col in cols[0]]
+        # each input collapsed into a vector
+        self.flat = [np.concatenate(c) for c in cols]
+        # col_lengths[j] is the number of sentences with a state for word j
+        # once START and END are removed (word 0 is ROOT)
+        self.col_lengths = at_least(lengths)[:self.max_seq_len]
+        self.mask = lengths[:, None] >= np.arange(self.max_seq_len)
+
+
 class LSTMWordEncoder(chainer.Chain):
 
     def __init__(self, vocab_size, num_units, num_layers,
@@ -354,7 +398,9 @@ class CNNWordEncoder(chainer.Chain):
         # so for 32 batch size this can be 1000
         SPLIT_INDEX = int(0.1 * batch_size)
         if SPLIT_INDEX > 0:
-            batch_split = np.array_split(sorted_word_list, [SPLIT_INDEX])
+            # words have different lengths - we can't make an array of them
+            batch_split = [sorted_word_list[:SPLIT_INDEX],
+                           sorted_word_list[SPLIT_INDEX:]]
         else:
             batch_split = [sorted_word_list]
 
@@ -426,6 +472,91 @@ class CNNWordEncoder(chainer.Chain):
         self.cache = dict()
 
 
+class ChunkedArcScores(chainer.Function):
+    """Scores of the mlp arc scorer of GraphParser for all pairs of
+    dependents and heads: v . dropout(tanh(h_j + d_i)) + b
+
+    Pairs are processed in tiles of at most chunk_size pairs (across the
+    batch - split too if it has more than chunk_size sentences), and the tanh activations of a tile are recomputed in backward
+    instead of being kept - memory is linear in chunk_size rather than in
+    the number of pairs. The dropout mask of each tile is regenerated from
+    a seed.
+    """
+
+    def __init__(self, chunk_size, dropout=0.):
+        self.chunk_size = chunk_size
+        self.dropout = dropout if chainer.config.train else 0.
+        if self.dropout > 0.:
+            self.seed = np.random.randint(2**31 - 1024)
+
+    def _tiles(self, num_deps, num_heads, batch_size):
+        """Ranges of dependents, heads and sentences of each tile."""
+        tile_batch = min(batch_size, max(self.chunk_size, 1))
+        tile_heads = min(num_heads, max(self.chunk_size // tile_batch, 1))
+        tile_deps = max(self.chunk_size // (tile_heads * tile_batch), 1)
+        for i in range(0, num_deps, tile_deps):
+            for j in range(0, num_heads, tile_heads):
+                for k in range(0, batch_size, tile_batch):
+                    yield (i, min(i + tile_deps, num_deps),
+                           j, min(j + tile_heads, num_heads),
+                           k, min(k + tile_batch, batch_size))
+
+    def _activations(self, xp, h, d, tile, tile_index):
+        i0, i1, j0, j1, k0, k1 = tile
+        # tile_deps x tile_heads x tile_batch x units
+        act = xp.tanh(d[i0:i1, None, k0:k1] + h[None, j0:j1, k0:k1])
+        if self.dropout > 0.:
+            rs = xp.random.RandomState(self.seed + tile_index)
+            mask = (rs.rand(*act.shape) >= self.dropout).astype(act.dtype)
+            mask *= 1. / (1. - self.dropout)
+        else:
+            mask = None
+        return act, mask
+
+    def forward(self, inputs):
+        # h: heads x batch_size x units, d: dependents x batch_size x units
+        # v: 1 x units, b: 1
+        h, d, v, b = inputs
+        xp = chainer.cuda.get_array_module(h)
+        scores = xp.empty((len(d), len(h), h.shape[1]), dtype=h.dtype)
+        for index, tile in enumerate(self._tiles(len(d), len(h), h.shape[1])):
+            i0, i1, j0, j1, k0, k1 = tile
+            act, mask = self._activations(xp, h, d, tile, index)
+            if mask is not None:
+                act *= mask
+            scores[i0:i1, j0:j1, k0:k1] = act.dot(v[0]) + b[0]
+        # dependents x heads x batch_size
+        return scores,
+
+    def backward(self, inputs, grad_outputs):
+        h, d, v, b = inputs
+        g_scores, = grad_outputs
+        xp = chainer.cuda.get_array_module(h)
+        g_h, g_d = xp.zeros_like(h), xp.zeros_like(d)
+        g_v = xp.zeros_like(v[0])
+        for index, tile in enumerate(self._tiles(len(d), len(h), h.shape[1])):
+            i0, i1, j0, j1, k0, k1 = tile
+            act, mask = self._activations(xp, h, d, tile, index)
+            g = g_scores[i0:i1, j0:j1, k0:k1]
+            g_act = g[..., None] * v[0]
+            if mask is not None:
+                g_act *= mask
+                act_out = act * mask
+            else:
+                act_out = act
+            g_v += xp.tensordot(g, act_out, axes=3)
+            g_pre = g_act * (1. - act * act)
+            g_h[j0:j1, k0:k1] += g_pre.sum(axis=0)
+            g_d[i0:i1, k0:k1] += g_pre.sum(axis=1)
+        g_b = g_scores.sum().reshape(1)
+        return g_h, g_d, g_v.reshape(v.shape), g_b.astype(b.dtype)
+
+
+def chunked_arc_scores(h, d, v, b, chunk_size, dropout=0.):
+    """See ChunkedArcScores - returns dependents x heads x batch_size."""
+    return ChunkedArcScores(chunk_size, dropout=dropout)(h, d, v, b)
+
+
 # class AltCNNWordEncoder(chainer.Chain):
 #
 #     FILTER_MULTIPLIER = 25
@@ -0,0 +1,151 @@
+""" On disk corpus of encoded rows that is read through memory maps """
+import os
+import json
+import numpy as np
+
+
+class MemmapCorpus(object):
+    """A corpus of encoded training rows stored as flat int32 arrays.
+
+    Rows are what data_to_rows produces: (text ids, heads, label ids), where
+    text ids are either word ids or, for subword models, a tuple of char ids
+    per word. Instead of keeping a python tuple per row, all ids are
+    concatenated into flat arrays and rows are located using offsets:
+
+    text      : word ids (or char ids for subword)
+    heads     : head index of each word
+    labels    : label id of each word
+    sent_offsets : where each sentence starts in heads, labels (and text
+                   if not subword) - num_sents + 1 entries
+    char_offsets : subword only - where each word starts in text
+    lengths   : number of words in each sentence - this is all BucketManager
+                needs in order to bucket the rows
+
+    The arrays are accessed via np.memmap, so the corpus can be larger
+    than RAM - only the rows that end up in a batch are read.
+    """
+
+    META_FILE = 'meta.json'
+    DTYPE = np.int32
+    OFFSET_DTYPE = np.int64
+    ARRAYS = {'text': DTYPE,
+              'heads': DTYPE,
+              'labels': DTYPE,
+              'lengths': DTYPE,
+              'sent_offsets': OFFSET_DTYPE,
+              'char_offsets': OFFSET_DTYPE}
+
+    def __init__(self, path):
+        super(MemmapCorpus, self).__init__()
+        self.path = path
+        with open(os.path.join(path, self.META_FILE), 'r') as f:
+            self.meta = json.load(f)
+        self.subword = self.meta['subword']
+        self.num_sents = self.meta['num_sents']
+        for name in self.meta['arrays']:
+            setattr(self, name, self._memmap(name))
+
+    def __repr__(self):
+        return ('<MemmapCorpus at %s with %d sents (subword: %s)>'
+                % (self.path, len(self), self.subword))
+
+    def __len__(self):
+        return self.num_sents
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.num_sents
+        if not 0 <= index < self.num_sents:
+            raise IndexError('Row %d out of range' % index)
+        start, end = self.sent_offsets[index:index + 2].tolist()
+        if self.subword:
+            bounds = self.char_offsets[start:end + 1].tolist()
+            chars = self.text[bounds[0]:bounds[-1]].tolist()
+            offset = bounds[0]
+            text = tuple(tuple(chars[s - offset:e - offset])
+                         for s, e in zip(bounds[:-1], bounds[1:]))
+        else:
+            text = tuple(self.text[start:end].tolist())
+        return (text,
+                tuple(self.heads[start:end].tolist()),
+                tuple(self.labels[start:end].tolist()))
+
+    def __iter__(self):
+        for i in range(self.num_sents):
+            yield self[i]
+
+    def _array_path(self, name):
+        return os.path.join(self.path, '%s.bin' % name)
+
+    def _memmap(self, name):
+        dtype = self.ARRAYS[name]
+        count = self.meta['arrays'][name]
+        if count == 0:
+            # can't memory map an empty file
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(self._array_path(name), dtype=dtype,
+                         mode='r', shape=(count,))
+
+    @classmethod
+    def exists(cl, path):
+        """Whether a corpus was built in folder path - the meta file is
+        written last, so half built corpora don't count."""
+        return os.path.isfile(os.path.join(path, cl.META_FILE))
+
+    @classmethod
+    def build(cl, path, rows, subword=False, chunk_size=10000):
+        """Write rows to a corpus in folder path and return it opened.
+
+        rows: iterable of (text ids, heads, label ids) rows as returned by
+        data_to_rows. It is consumed in chunks of chunk_size rows, so it can
+        be a generator over data that doesn't fit in memory.
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        names = ['text', 'heads', 'labels', 'lengths', 'sent_offsets']
+        if subword:
+            names.append('char_offsets')
+        files = dict((name, open(os.path.join(path, '%s.bin' % name), 'wb'))
+                     for name in names)
+        counts = dict((name, 0) for name in names)
+
+        def dump(name, values):
+            arr = np.asarray(values, dtype=cl.ARRAYS[name])
+            arr.tofile(files[name])
+            counts[name] += len(arr)
+
+        num_sents, num_words, num_chars = 0, 0, 0
+        try:
+            dump('sent_offsets', [0])
+            if subword:
+                dump('char_offsets', [0])
+            buff = dict((name, []) for name in names)
+            for row in rows:
+                text, heads, labels = row
+                assert(len(text) == len(heads) == len(labels))
+                if subword:
+                    for word in text:
+                        buff['text'].extend(word)
+                        num_chars += len(word)
+                        buff['char_offsets'].append(num_chars)
+                else:
+                    buff['text'].extend(text)
+                buff['heads'].extend(heads)
+                buff['labels'].extend(labels)
+                buff['lengths'].append(len(heads))
+                num_words += len(heads)
+                buff['sent_offsets'].append(num_words)
+                num_sents += 1
+                if num_sents % chunk_size == 0:
+                    for name, values in buff.items():
+                        dump(name, values)
+                    buff = dict((name, []) for name in names)
+            for name, values in buff.items():
+                dump(name, values)
+        finally:
+            for f in files.values():
+                f.close()
+        meta = dict(subword=subword, num_sents=num_sents, arrays=counts)
+        with open(os.path.join(path, cl.META_FILE), 'w') as f:
+            json.dump(meta, f)
+        return cl(path)
@@ -1,13 +1,17 @@
+import io
 import os
 import six
 import glob
 import codecs
+import hashlib
 import json
 import re
+import threading
 import numpy as np
 import heapq
 from itertools import chain
 from collections import OrderedDict, defaultdict
+from six.moves import queue
 
 
 def py2repr(f):
@@ -20,6 +24,35 @@ def py2repr(f):
     return func
     
 
+CONLLU_COMMENT = '#'
+
+
+def _conllu_blocks(inp, keep_last=False):
+    """Lines (without comments) of each sentence in inp - sentences end
+    with an empty line. The last sentence is only yielded if it isn't
+    followed by an empty line when keep_last is True."""
+    lines = []
+    for line in inp:
+        line = line.rstrip()
+        # we ignore documents for the time being
+        if lines and not line:
+            yield lines
+            lines = []
+        if line and not line.startswith(CONLLU_COMMENT):
+            lines.append(line)
+    if keep_last and lines:
+        yield lines
+
+
+def _conllu_sentence(lines):
+    tokens = []
+    for l in lines:
+        cols = l.split('\t')
+        assert(len(cols) == 10)
+        tokens.append(Token(*cols))
+    return Sentence(tokens)
+
+
 class Dataset(object):
 
     def __init__(self, sents, lang=None, name=None):
@@ -42,10 +75,9 @@ class Dataset(object):
             yield s
 
     def save(self, path):
-        with codecs.open(path, 'w', encoding='utf-8') as inp:
+        with ConlluWriter(path) as writer:
             for sent in self:
-                s = '%s\n\n' % '\n'.join(str(t) for t in sent.all_tokens)
-                inp.write(s)
+                writer.write(sent)
 
     @property
     def words(self):
@@ -99,23 +131,35 @@ class Dataset(object):
         for s in self.sents:
             s.unset_misc()
 
+    def _token_arrays(self):
+        """Single pass over the tokens collecting what stats need:
+        sentence lengths, a flat array of heads and the word and lemma
+        types."""
+        lengths = np.zeros(len(self.sents), dtype=np.int64)
+        heads = []
+        words, lemmas = set(), set()
+        for i, s in enumerate(self.sents):
+            tokens = s.tokens
+            lengths[i] = len(tokens)
+            heads.extend(t.head for t in tokens)
+            words.update(t.form for t in tokens)
+            lemmas.update(t.lemma for t in tokens)
+        return lengths, np.array(heads, dtype=np.int64), words, lemmas
+
     def compute_token_ratios(self):
-        # TODO: make this more efficient
-        all_words = list(chain.from_iterable(s.words for s in self.sents))
-        self.num_words = len(all_words)
-        all_lemmas = list(chain.from_iterable(s.lemmas for s in self.sents))
-        distinct_words = set(all_words)
-        distinct_lemmas = set(all_lemmas)
-        self.num_types = len(distinct_words)
-        self.num_lemmas = len(distinct_lemmas)
+        _, heads, words, lemmas = self._token_arrays()
+        self._set_token_ratios(len(heads), words, lemmas)
+
+    def _set_token_ratios(self, num_words, words, lemmas):
+        self.num_words = num_words
+        self.num_types = len(words)
+        self.num_lemmas = len(lemmas)
         self.type_to_token_ratio = float(self.num_types)/self.num_words
         self.lemma_to_token_ratio = float(self.num_lemmas)/self.num_words
 
-    @property
-    def len_stats(self):
-        sent_lens = self.sent_lengths
-        self.max_sent_len = max(sent_lens)
-        self.min_sent_len = min(sent_lens)
+    def _len_stats(self, sent_lens):
+        self.max_sent_len = int(np.max(sent_lens))
+        self.min_sent_len = int(np.min(sent_lens))
         self.avg_sent_len = np.mean(sent_lens)
         self.std_sent_len = np.std(sent_lens)
         return {'max_sent_len': self.max_sent_len,
@@ -123,11 +167,9 @@ class Dataset(object):
                 'avg_sent_len': self.avg_sent_len,
                 'std_sent_len': self.std_sent_len}
 
-    @property
-    def arc_len_stats(self):
-        arc_lengths = self.arc_lengths 
-        self.max_arc_len = max(arc_lengths)
-        self.min_arc_len = min(arc_lengths)
+    def _arc_len_stats(self, arc_lengths):
+        self.max_arc_len = int(np.max(arc_lengths))
+        self.min_arc_len = int(np.min(arc_lengths))
         self.avg_arc_len = np.mean(arc_lengths)
         self.std_arc_len = np.std(arc_lengths)
         return {'max_arc_len': self.max_arc_len,
@@ -135,22 +177,82 @@ class Dataset(object):
                 'avg_arc_len': self.avg_arc_len,
                 'std_arc_len': self.std_arc_len}
 
+    @property
+    def len_stats(self):
+        return self._len_stats(np.array(self.sent_lengths))
+
+    @property
+    def arc_len_stats(self):
+        return self._arc_len_stats(np.array(self.arc_lengths))
+
     @property
     def stats(self):
-        stats = dict(**self.len_stats)
-        stats.update(**self.arc_len_stats)
+        sent_lens, heads, words, lemmas = self._token_arrays()
+        arc_lengths = compute_arc_lengths(heads, sent_lens)
+        stats = self._len_stats(sent_lens)
+        stats.update(**self._arc_len_stats(arc_lengths))
         stats['num_sents'] = len(self)
-        self.compute_token_ratios()
+        self._set_token_ratios(len(heads), words, lemmas)
         stats['num_words'] = self.num_words
         stats['num_types'] = self.num_types
         stats['num_lemmas'] = self.num_lemmas
         stats['type_to_token_ratio'] = self.type_to_token_ratio
         stats['lemma_to_token_ratio'] = self.lemma_to_token_ratio
-        num_projective = sum(s.is_projective() for s in self.sents)
-        stats['percentage_projective'] = float(num_projective)/len(self.sents)
+        # arc_len_hist[i] is the number of arcs of length i
+        stats['arc_len_hist'] = np.bincount(arc_lengths).tolist()
+        num_non_projective = int(np.sum(non_projective(heads, sent_lens)))
+        stats['num_non_projective'] = num_non_projective
+        stats['percentage_projective'] = (1. - float(num_non_projective)
+                                          / len(self.sents))
         return stats
 
 
+def compute_arc_lengths(heads, sent_lens):
+    """Compute how long the arcs are in words for a flat array of heads
+    of sentences with lengths sent_lens. Arcs to root have length 1."""
+    heads = np.asarray(heads, dtype=np.int64)
+    starts = np.cumsum(sent_lens) - sent_lens
+    # 1 based position of each token in its sentence
+    positions = np.arange(len(heads)) - np.repeat(starts, sent_lens) + 1
+    return np.where(heads == 0, 1, np.abs(heads - positions))
+
+
+def non_projective(heads, sent_lens, max_elements=1 << 24):
+    """Check which sentences have crossing arcs.
+
+    heads: flat array of the heads of all sentences.
+    sent_lens: length of each sentence.
+    max_elements: upper bound on the size of the boolean arc x arc
+    comparison tensor built at once.
+
+    A tree is projective iff no two of its arcs cross - if we also
+    consider the arcs leaving the root at position 0. Arc (a, b) crosses
+    arc (c, d) (a < b, c < d) if a < c < b < d. Sentences of the same length
+    are stacked so the test is vectorised over all of them.
+
+    Returns a boolean array - True for non projective sentences.
+    """
+    heads = np.asarray(heads, dtype=np.int64)
+    sent_lens = np.asarray(sent_lens, dtype=np.int64)
+    starts = np.cumsum(sent_lens) - sent_lens
+    result = np.zeros(len(sent_lens), dtype=np.bool_)
+    for n in np.unique(sent_lens):
+        if n < 2:
+            continue
+        which = np.flatnonzero(sent_lens == n)
+        deps = np.arange(1, n + 1)
+        step = max(1, max_elements // (n * n))
+        for i in range(0, len(which), step):
+            chunk = which[i:i + step]
+            h = heads[starts[chunk][:, None] + deps - 1]
+            lo, hi = np.minimum(h, deps), np.maximum(h, deps)
+            crosses = ((lo[:, :, None] < lo[:, None, :]) &
+                       (lo[:, None, :] < hi[:, :, None]) &
+                       (hi[:, :, None] < hi[:, None, :]))
+            result[chunk] = crosses.any(axis=(1, 2))
+    return result
+
+
 class Sentence(object):
 
     def __init__(self, tokens=None):
@@ -159,8 +261,10 @@ class Sentence(object):
         # we don't care about multiword tokens or
         # repetition of words that won't be reflected in the sentence
         self.all_tokens = tuple(tokens)
+        # multiword tokens have no head - unless the sentence isn't annotated
+        # (text we want to parse), in which case we go by their id (eg: 4-5)
         self.tokens = tuple(token for token in tokens
-                            if token.head != -1) or tuple()
+                            if token.head != -1 or token.id.isdigit()) or tuple()
 
     def __getitem__(self, index):
         return self.tokens[index]
@@ -337,8 +441,28 @@ class Token(object):
                          for attr in Token.CONLLU_ATTRS)
 
     def __str__(self):
-        return '\t'.join(six.text_type(self.serialize(attr))
-                         for attr in Token.CONLLU_ATTRS)
+        return self.to_conllu()
+
+    def to_conllu(self, head=None, deprel=None):
+        """Serialise the token to a CoNLL-U line. If head or deprel are
+        passed they are written instead of the values of the token, so
+        that predictions can be written without mutating the token."""
+        text = six.text_type
+        if head is None:
+            head = self.head
+            # multiword tokens were read with _ as head
+            if head == -1:
+                head = self.EMPTY
+        return '\t'.join((text(self.id),
+                          text(self.form),
+                          text(self.lemma),
+                          text(self.upostag),
+                          text(self.xpostag),
+                          text(self.serialize('feats')),
+                          text(head),
+                          text(self.deprel if deprel is None else deprel),
+                          text(self.deps),
+                          text(self.misc)))
 
     def serialize(self, attr):
         value = getattr(self, attr)
@@ -371,6 +495,217 @@ class Token(object):
             return dict()
 
 
+class ConlluWriter(object):
+    """Streams sentences to a CoNLL-U file.
+
+    Sentences are serialised into a buffer that is written to disk in
+    large chunks. Predicted heads and labels can be passed along with each
+    sentence, in which case they are written in place of the values of
+    the tokens - the tokens themselves are left untouched.
+
+    If background is True, serialisation and writing happen in a separate
+    thread, so that the caller can get on with parsing the next batch.
+    """
+
+    def __init__(self, path, rev_labels=None, chunk_size=1 << 20,
+                 background=False, max_pending=64):
+        """
+        path: str - the file to write to, or an open (text) file object,
+        which is flushed but not closed by close.
+
+        rev_labels: dict or sequence - if specified, labels passed to
+        write are ids and are mapped to strings using rev_labels[id].
+
+        chunk_size: int - number of characters to buffer before writing.
+
+        background: bool - whether to serialise and write in a thread.
+
+        max_pending: int - number of sentences the background thread can
+        fall behind before write blocks.
+        """
+        super(ConlluWriter, self).__init__()
+        self.path = path
+        self.rev_labels = rev_labels
+        self.chunk_size = chunk_size
+        self.background = background
+        self.num_sents = 0
+        self._buffer = []
+        self._buffered = 0
+        self._error = None
+        self._owns_file = not hasattr(path, 'write')
+        if self._owns_file:
+            self._file = io.open(path, 'w', encoding='utf-8')
+        else:
+            self._file = path
+        self._closed = False
+        if self.background:
+            self._queue = queue.Queue(maxsize=max_pending)
+            self._thread = threading.Thread(target=self._consume)
+            self._thread.daemon = True
+            self._thread.start()
+        else:
+            self._queue = None
+            self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, sent, heads=None, labels=None):
+        """Write a sentence, optionally replacing heads and labels of
+        the (non multiword) tokens with the predictions passed."""
+        self._check_error()
+        # copy to plain lists - the caller may reuse the arrays
+        if heads is not None:
+            heads = np.asarray(heads).tolist()
+        if labels is not None:
+            labels = np.asarray(labels).tolist()
+        if self.background:
+            self._queue.put((sent, heads, labels))
+        else:
+            self._add(sent, heads, labels)
+        self.num_sents += 1
+
+    def serialize(self, sent, heads=None, labels=None):
+        """Return the CoNLL-U block for a sentence."""
+        if heads is None and labels is None:
+            lines = [t.to_conllu() for t in sent.all_tokens]
+        else:
+            if labels is not None and self.rev_labels is not None:
+                labels = [self.rev_labels[l] for l in labels]
+            words = sent.tokens
+            lines = []
+            # predictions only refer to tokens that are not multiword
+            # tokens, we walk both sequences to line them up
+            j = 0
+            for t in sent.all_tokens:
+                if j < len(words) and t is words[j]:
+                    lines.append(t.to_conllu(
+                        head=heads[j] if heads is not None else None,
+                        deprel=labels[j] if labels is not None else None))
+                    j += 1
+                else:
+                    lines.append(t.to_conllu())
+        lines.append('\n')
+        return '\n'.join(lines)
+
+    def flush(self):
+        """Write out anything buffered so far. In background mode
+        this waits for the thread to catch up."""
+        if self.background:
+            # once the queue is joined the thread is idle, waiting
+            # for the next sentence - so we can write its buffer here
+            self._queue.join()
+        self._write_buffer()
+        self._check_error()
+        self._file.flush()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if self.background:
+                self._queue.put(None)
+                self._thread.join()
+            else:
+                self._write_buffer()
+        finally:
+            if self._owns_file:
+                self._file.close()
+            else:
+                self._file.flush()
+        self._check_error()
+
+    def _add(self, sent, heads, labels):
+        block = self.serialize(sent, heads, labels)
+        self._buffer.append(block)
+        self._buffered += len(block)
+        if self._buffered >= self.chunk_size:
+            self._write_buffer()
+
+    def _write_buffer(self):
+        if self._buffer:
+            self._file.write(''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+
+    def _consume(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    self._write_buffer()
+                    return
+                if self._error is None:
+                    self._add(*item)
+            except Exception as e:
+                # keep draining so that write doesn't block forever
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _check_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+
+class Shard(object):
+    """Deterministically chooses which sentences of a file to load.
+
+    Each sentence is hashed - either by its position in the file or by its
+    content - to a number in [0, 1). The hash decides which of num_shards
+    shards the sentence belongs to and, independently, whether it is part
+    of a sample_ratio subsample. The hash is stable across runs and
+    machines, so distributed workers agree on the assignment without
+    communicating, and no random number generator is touched.
+    """
+
+    POSITION = 'position'
+    CONTENT = 'content'
+    HASH_OPTS = [POSITION, CONTENT]
+
+    def __init__(self, index=0, num_shards=1, sample_ratio=1.,
+                 hash_by=POSITION, salt=''):
+        super(Shard, self).__init__()
+        assert(0 <= index < num_shards)
+        assert(0. < sample_ratio <= 1.)
+        assert(hash_by in self.HASH_OPTS)
+        self.index = index
+        self.num_shards = num_shards
+        self.sample_ratio = sample_ratio
+        self.hash_by = hash_by
+        self.salt = salt
+
+    def __repr__(self):
+        return ('<Shard %d/%d sample ratio %.3f hashed by %s>'
+                % (self.index, self.num_shards, self.sample_ratio, self.hash_by))
+
+    def __call__(self, position, lines):
+        """Whether the sentence at position with lines should be kept."""
+        if self.num_shards > 1:
+            which = int(self.fraction(position, lines, 'shard') * self.num_shards)
+            if which != self.index:
+                return False
+        if self.sample_ratio < 1.:
+            return self.fraction(position, lines, 'sample') < self.sample_ratio
+        return True
+
+    def fraction(self, position, lines, purpose=''):
+        """Stable hash of a sentence to [0, 1)."""
+        key = position if self.hash_by == self.POSITION else '\n'.join(lines)
+        key = six.text_type('%s:%s:%s') % (self.salt, purpose, key)
+        digest = hashlib.md5(key.encode('utf-8')).hexdigest()
+        return int(digest[:13], 16) / float(16 ** 13)
+
+    @property
+    def keeps_all(self):
+        return self.num_shards == 1 and self.sample_ratio >= 1.
+
+
 class UDepLoader(object):
     """Loader for universal dependencies datasets"""
 
@@ -388,35 +723,46 @@ class UDepLoader(object):
             raise ValueError('Unknown loader, name does not start with '
                     'one of %s' % self.AVAILABLE_LOADERS)
 
-    def load_train_dev(self, lang, verbose=False):
-        return self.loader.load_train_dev(lang, verbose=verbose)
+    def load_train_dev(self, lang, verbose=False, shard=None, load_train=True):
+        """shard: Shard - if specified only the training sentences that
+        fall in the shard are loaded.
+
+        load_train: if False, only the dev set is loaded and train is None
+        (eg: when the training rows are already in a MemmapCorpus)."""
+        return self.loader.load_train_dev(lang, verbose=verbose, shard=shard,
+                                          load_train=load_train)
 
     @staticmethod
     def get_env_var(name):
         return '%s_FOLDER' % name
 
     @staticmethod
-    def load_conllu_sents(path):
-        """ Read in conll file and return a list of sentences """
-        CONLLU_COMMENT = '#'
+    def load_conllu_sents(path, keep=None):
+        """ Read in conll file and return a list of sentences
+
+        keep: callable - if specified, it is called with the position of
+        each sentence in the file and its lines. Only sentences for which it
+        returns True are parsed and returned (eg: a Shard).
+        """
         sents = []
         with codecs.open(path, 'r', encoding='utf-8') as inp:
-            tokens = []
-            for line in inp:
-                line = line.rstrip()
-                # we ignore documents for the time being
-                if tokens and not line:
-                    sents.append(Sentence(tokens))
-                    tokens = []
-                if line and not line.startswith(CONLLU_COMMENT):
-                    cols = line.split('\t')
-                    assert(len(cols) == 10)
-                    tokens.append(Token(*cols))
+            for position, lines in enumerate(_conllu_blocks(inp)):
+                if keep is None or keep(position, lines):
+                    sents.append(_conllu_sentence(lines))
         return sents
 
     @staticmethod
-    def load_conllu(path):
-        return Dataset(UDepLoader.load_conllu_sents(path))
+    def iter_conllu_sents(inp):
+        """Sentences read one at a time from an iterable of CoNLL-U lines
+        (eg: sys.stdin) - each is yielded as soon as it is complete."""
+        for lines in _conllu_blocks(inp, keep_last=True):
+            yield _conllu_sentence(lines)
+
+    @staticmethod
+    def load_conllu(path, shard=None):
+        if shard is not None and shard.keeps_all:
+            shard = None
+        return Dataset(UDepLoader.load_conllu_sents(path, keep=shard))
 
 
 class CONLL2006Loader(object):
@@ -448,24 +794,58 @@ class CONLL2006Loader(object):
         return ('<CONLL2006Loader object from folder %s with %d languages>'
                 % (self.datafolder, len(self.langs)))
 
-    def load_train_dev(self, lang, verbose=False):
+    def load_train_dev(self, lang, verbose=False, shard=None, load_train=True):
         # we convert to lowercase to make matching easier
         p = self.train_map.get(lang.lower(), None)
         if p:
-            sents = UDepLoader.load_conllu_sents(p) 
-            # keep old state - we want the shuffling not to 
-            # change whenever we change the seed
-            rand_state = np.random.get_state()
-            np.random.seed(62)
-            np.random.shuffle(sents)
-            # restore the state
-            np.random.set_state(rand_state)
-            num_sents = len(sents)
-            split_index = int(num_sents * self.train_percentage)
-            train = Dataset(sents[:split_index], lang=lang, name=self.name)
-            dev = Dataset(sents[split_index:], lang=lang, name=self.name)
+            if load_train and (shard is None or shard.keeps_all):
+                sents = UDepLoader.load_conllu_sents(p) 
+                # we want the shuffling not to change whenever we change
+                # the seed - so we use our own random state
+                np.random.RandomState(62).shuffle(sents)
+                num_sents = len(sents)
+                split_index = int(num_sents * self.train_percentage)
+                train_sents = sents[:split_index]
+                dev_sents = sents[split_index:]
+            else:
+                # the shuffle only depends on the number of sentences, so we
+                # can make the same split as above without loading everything
+                # - the dev set is the same whatever the shard
+                with codecs.open(p, 'r', encoding='utf-8') as inp:
+                    num_sents = sum(1 for _ in _conllu_blocks(inp))
+                order = np.arange(num_sents)
+                np.random.RandomState(62).shuffle(order)
+                split_index = int(num_sents * self.train_percentage)
+                # rank[position] is where the shuffle puts the sentence
+                rank = np.empty(num_sents, dtype=np.int64)
+                rank[order] = np.arange(num_sents)
+
+                def load_shuffled(keep):
+                    positions = []
+
+                    def keep_position(position, lines):
+                        if keep(position, lines):
+                            positions.append(position)
+                            return True
+                        return False
+
+                    sents = UDepLoader.load_conllu_sents(p, keep=keep_position)
+                    return [sents[i] for i in
+                            np.argsort(rank[positions], kind='mergesort')]
+
+                if load_train:
+                    train_sents = load_shuffled(
+                        lambda position, lines: rank[position] < split_index
+                        and (shard is None or shard(position, lines)))
+                dev_sents = load_shuffled(lambda position, lines:
+                                          rank[position] >= split_index)
+            train = None
+            if load_train:
+                train = Dataset(train_sents, lang=lang, name=self.name)
+                if verbose:
+                    print('Loaded %d sentences from %s' % (len(train), p))
+            dev = Dataset(dev_sents, lang=lang, name=self.name)
             if verbose:
-                print('Loaded %d sentences from %s' % (len(train), p))
                 print('Loaded %d sentences from %s' % (len(dev), p))
             return train, dev
         else:
@@ -509,20 +889,22 @@ class CONLL2017Loader(object):
         return ('<CONLL2017Loader object from folder %s with %d languages>'
                 % (self.datafolder, len(self.langs)))
 
-    def load_train_dev(self, lang, verbose=False):
+    def load_train_dev(self, lang, verbose=False, shard=None, load_train=True):
+        if shard is not None and shard.keeps_all:
+            shard = None
         p = os.path.join(self.datafolder, self.lang_folders[lang])
         train_filename = [fn for fn in os.listdir(p) 
                         if fn.endswith(self.TRAIN_SUFFIX)]
-        if train_filename:
-            train_filename = train_filename[0]
-            train_path = os.path.join(p, train_filename)
-            train = Dataset(UDepLoader.load_conllu_sents(train_path),
+        if not train_filename:
+            raise ValueError("Couldn't find a %s file for %s"
+                             % (lang, self.TRAIN_SUFFIX))
+        train = None
+        if load_train:
+            train_path = os.path.join(p, train_filename[0])
+            train = Dataset(UDepLoader.load_conllu_sents(train_path, keep=shard),
                             lang=lang, name=self.name)
             if verbose:
                 print('Loaded %d sentences from %s' % (len(train), train_path))
-        else:
-            raise ValueError("Couldn't find a %s file for %s"
-                             % (lang, self.TRAIN_SUFFIX))
         dev_filename = [fn for fn in os.listdir(p) 
                         if fn.endswith(self.DEV_SUFFIX)]
         if dev_filename:
@@ -1,5 +1,6 @@
 from __future__ import division
 import numpy as np
+from johnny.vocab import seq_offsets
 
 
 class Average(object):
@@ -23,44 +24,240 @@ class Average(object):
         return self.cumsum / self.count if self.count else 0.0
 
 
-class UAS(Average):
+def flatten(seqs):
+    """Concatenate a batch of sequences into a single flat array.
+
+    returns: the flat array and the offsets of the sequences in it - the
+    start of each sequence followed by the end of the last one.
+    """
+    offsets = seq_offsets(seqs)
+    if offsets[-1] == 0:
+        return np.zeros(0, dtype=np.int32), offsets
+    return np.concatenate([np.asarray(seq) for seq in seqs]), offsets
+
+
+def add_batch_preds(u_scorer, l_scorer, arc_preds, lbl_preds, heads, labels):
+    """Score a batch of predicted heads and labels (one sequence per
+    sentence) against the gold ones with a UAS and a LAS scorer.
+
+    returns: the flat predicted heads, gold heads, predicted labels and
+    gold labels, and the offsets of the sentences in them (see flatten).
+    """
+    p_arcs, offsets = flatten(arc_preds)
+    p_lbls, _ = flatten(lbl_preds)
+    t_arcs, _ = flatten(heads)
+    t_lbls, _ = flatten(labels)
+    u_scorer.add_batch(p_arcs, t_arcs, offsets)
+    l_scorer.add_batch(p_arcs, t_arcs, p_lbls, t_lbls, offsets)
+    return p_arcs, t_arcs, p_lbls, t_lbls, offsets
+
+
+def sentence_sums(values, offsets):
+    """Sum of the flat token values of each sentence (see flatten)."""
+    lengths = np.diff(offsets)
+    sent_ids = np.repeat(np.arange(len(lengths)), lengths)
+    return np.bincount(sent_ids, weights=values, minlength=len(lengths))
 
-    '''Unlabelled Attachment Score - Scorer'''
 
-    def __init__(self, label='UAS'):
+def _grown(counts, size):
+    """counts padded with zeros to size (if it is smaller)."""
+    if len(counts) >= size:
+        return counts
+    return np.concatenate([counts, np.zeros(size - len(counts))])
+
+
+class AttachmentScore(Average):
+
+    '''Fraction of tokens attached correctly, overall and for sentences
+    of different lengths - sentences with edges[i-1] < length <= edges[i]
+    go in bucket i.'''
+
+    LENGTH_EDGES = (10, 20, 30, 40, 50)
+
+    def __init__(self, label=None, length_edges=LENGTH_EDGES):
+        self.length_edges = np.asarray(length_edges)
         Average.__init__(self, label)
+        self.reset()
+
+    def reset(self):
+        Average.reset(self)
+        num_buckets = len(self.length_edges) + 1
+        self.length_correct = np.zeros(num_buckets)
+        self.length_count = np.zeros(num_buckets)
+
+    def _add(self, correct, offsets=None):
+        """Add the correct mask of the flat tokens of sentences starting at
+        offsets (one sentence if None)."""
+        if offsets is None:
+            offsets = np.array([0, len(correct)])
+        lengths = np.diff(offsets)
+        sent_correct = sentence_sums(correct, offsets)
+        buckets = np.searchsorted(self.length_edges, lengths)
+        num_buckets = len(self.length_correct)
+        self.length_correct += np.bincount(buckets, weights=sent_correct,
+                                           minlength=num_buckets)
+        self.length_count += np.bincount(buckets, weights=lengths,
+                                         minlength=num_buckets)
+        self.count += len(correct)
+        self.cumsum += float(np.sum(correct))
+        return self.cumsum / self.count if self.count else 0.0
+
+    @property
+    def length_scores(self):
+        """dict of length bucket -> score (of buckets we have seen)."""
+        lower = [0] + [int(e) for e in self.length_edges]
+        upper = ['%d' % e for e in self.length_edges] + ['']
+        scores = dict()
+        for l, u, correct, count in zip(lower, upper, self.length_correct,
+                                        self.length_count):
+            if count:
+                scores['%d-%s' % (l + 1, u)] = correct / count
+        return scores
+
+
+class UAS(AttachmentScore):
+
+    '''Unlabelled Attachment Score - Scorer'''
+
+    def __init__(self, label='UAS', length_edges=AttachmentScore.LENGTH_EDGES):
+        AttachmentScore.__init__(self, label, length_edges=length_edges)
 
     def __call__(self, arcs=None):
         pred_arcs, true_arcs = arcs
-        preds = np.asarray(pred_arcs)
-        truth = np.asarray(true_arcs)
-        correct = float(np.sum(preds == truth))
-        self.count += len(preds)
-        self.cumsum += correct
-        return self.cumsum / self.count if self.count else 0.0
+        return self.add_batch(pred_arcs, true_arcs)
 
+    def add_batch(self, pred_arcs, true_arcs, offsets=None):
+        """Score a batch of sentences in one go: pred_arcs and true_arcs
+        are the flat heads of all tokens and offsets where each sentence
+        starts (see flatten) - all tokens are one sentence if None."""
+        return self._add(np.asarray(pred_arcs) == np.asarray(true_arcs),
+                         offsets)
 
-class LAS(Average):
 
-    '''Labelled Attachment Score - Scorer'''
+class LAS(AttachmentScore):
 
-    def __init__(self, num_labels=None, label='LAS'):
-        Average.__init__(self, label)
+    '''Labelled Attachment Score - Scorer
+
+    Also keeps the precision and recall of each label - a token counts for
+    its label if both its head and label are right.'''
+
+    def __init__(self, num_labels=None, label='LAS',
+                 length_edges=AttachmentScore.LENGTH_EDGES):
         self.num_labels = num_labels
+        AttachmentScore.__init__(self, label, length_edges=length_edges)
+
+    def reset(self):
+        AttachmentScore.reset(self)
+        size = self.num_labels or 0
+        self.label_correct = np.zeros(size)
+        self.label_pred = np.zeros(size)
+        self.label_true = np.zeros(size)
         if self.num_labels is not None:
-            self.conf_matrix = np.zeros((num_labels, num_labels),
+            self.conf_matrix = np.zeros((self.num_labels, self.num_labels),
                                         dtype=np.int32)
 
     def __call__(self, arcs=None, labels=None):
         pred_arcs, true_arcs = arcs
         pred_labels, true_labels = labels
-        p_arcs = np.asarray(pred_arcs)
-        t_arcs = np.asarray(true_arcs)
-        p_labels = np.asarray(pred_labels)
-        t_labels = np.asarray(true_labels)
+        return self.add_batch(pred_arcs, true_arcs, pred_labels, true_labels)
+
+    def add_batch(self, pred_arcs, true_arcs, pred_labels, true_labels,
+                  offsets=None):
+        """Score a batch of sentences in one go (see UAS.add_batch)."""
+        p_labels = np.asarray(pred_labels, dtype=np.int64)
+        t_labels = np.asarray(true_labels, dtype=np.int64)
         if self.num_labels is not None:
-            self.conf_matrix[p_labels, t_labels] += 1
-        correct = float(np.sum((p_arcs == t_arcs) & (p_labels == t_labels)))
-        self.count += len(p_arcs)
-        self.cumsum += correct
-        return self.cumsum / self.count if self.count else 0.0
+            # fancy indexed += ignores repeated indices
+            np.add.at(self.conf_matrix, (p_labels, t_labels), 1)
+        correct = ((np.asarray(pred_arcs) == np.asarray(true_arcs))
+                   & (p_labels == t_labels))
+        if len(t_labels):
+            size = max(len(self.label_true), p_labels.max() + 1,
+                       t_labels.max() + 1)
+            self.label_correct = _grown(self.label_correct, size)
+            self.label_pred = _grown(self.label_pred, size)
+            self.label_true = _grown(self.label_true, size)
+            self.label_correct += np.bincount(t_labels, weights=correct,
+                                              minlength=size)
+            self.label_pred += np.bincount(p_labels, minlength=size)
+            self.label_true += np.bincount(t_labels, minlength=size)
+        return self._add(correct, offsets)
+
+    @property
+    def precision(self):
+        """Precision of each label (0 for labels never predicted)."""
+        return self.label_correct / np.maximum(self.label_pred, 1)
+
+    @property
+    def recall(self):
+        """Recall of each label (0 for labels never seen)."""
+        return self.label_correct / np.maximum(self.label_true, 1)
+
+
+class StratifiedRatio(object):
+
+    '''Estimate of a ratio over all sentences (eg: LAS - correct tokens
+    over tokens) from a sample of sentences stratified by length (see
+    johnny.misc.stratified_sample), along with its standard error.
+
+    Uses the combined ratio estimator: each stratum is weighted by its
+    share of the population and the variance is that of the residuals
+    (correct - ratio * tokens) within each stratum.'''
+
+    def __init__(self, edges, stratum_sizes, label='Ratio'):
+        self.edges = np.asarray(edges)
+        self.stratum_sizes = np.asarray(stratum_sizes, dtype=np.float64)
+        self.label = label
+        self.reset()
+
+    def __call__(self, correct, total):
+        """Add a sentence with total tokens, correct of which are right."""
+        self.strata.append(np.searchsorted(self.edges, total))
+        self.correct.append(correct)
+        self.totals.append(total)
+
+    def add_batch(self, correct, totals):
+        """Add sentences - arrays of their correct and total tokens."""
+        self.strata.extend(np.searchsorted(self.edges, totals))
+        self.correct.extend(correct)
+        self.totals.extend(totals)
+
+    def reset(self):
+        self.strata, self.correct, self.totals = [], [], []
+
+    def _estimate(self):
+        strata = np.asarray(self.strata, dtype=np.int64)
+        y = np.asarray(self.correct, dtype=np.float64)
+        x = np.asarray(self.totals, dtype=np.float64)
+        num_strata = len(self.stratum_sizes)
+        n = np.bincount(strata, minlength=num_strata).astype(np.float64)
+        seen = n > 0
+        weights = np.zeros(num_strata)
+        weights[seen] = self.stratum_sizes[seen] / n[seen]
+        y_hat = np.sum(weights[strata] * y)
+        x_hat = np.sum(weights[strata] * x)
+        if x_hat == 0:
+            return 0., 0.
+        ratio = y_hat / x_hat
+        d = y - ratio * x
+        d_mean = np.bincount(strata, weights=d, minlength=num_strata)
+        d_mean[seen] /= n[seen]
+        d_var = np.bincount(strata, weights=(d - d_mean[strata]) ** 2,
+                            minlength=num_strata)
+        # strata with a single sentence don't contribute a variance
+        has_var = n > 1
+        d_var[has_var] /= n[has_var] - 1
+        d_var[~has_var] = 0.
+        fpc = np.ones(num_strata)
+        fpc[seen] = 1. - n[seen] / self.stratum_sizes[seen]
+        var = np.sum((self.stratum_sizes[seen] ** 2) * fpc[seen]
+                     * d_var[seen] / n[seen]) / x_hat ** 2
+        return ratio, np.sqrt(max(var, 0.))
+
+    @property
+    def score(self):
+        return self._estimate()[0]
+
+    @property
+    def stderr(self):
+        return self._estimate()[1]
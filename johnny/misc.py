@@ -1,23 +1,61 @@
 # -*- coding: utf-8 -*-
 import os
+import sys
 import six
+import time
+import threading
 import numpy as np
-import yaml
 import datetime
+from itertools import chain
+from six.moves import queue
 from johnny import EXP_ENV_VAR
 
 
+def rng_state_dict(random_state=None):
+    """State of a numpy RandomState (the global one by default) as a dict of
+    arrays."""
+    if random_state is None:
+        _, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    else:
+        _, keys, pos, has_gauss, cached_gaussian = random_state.get_state()
+    return {'keys': keys,
+            'pos': np.array(pos),
+            'has_gauss': np.array(has_gauss),
+            'cached_gaussian': np.array(cached_gaussian)}
+
+
+def load_rng_state_dict(state, random_state=None):
+    rng_state = ('MT19937',
+                 np.asarray(state['keys'], dtype=np.uint32),
+                 int(state['pos']),
+                 int(state['has_gauss']),
+                 float(state['cached_gaussian']))
+    if random_state is None:
+        np.random.set_state(rng_state)
+    else:
+        random_state.set_state(rng_state)
+
+
 class BucketManager(six.Iterator):
 
     DATA_KEY = 'data'
     INDEX_KEY = 'index'
     END_INDEX_KEY = 'end_index'
-
+    # cost of a batch of num_rows rows when the longest has length max_len
+    # (everything is padded to max_len)
+    BATCH_COSTS = {
+        # number of padded tokens, what the LSTMs and the label mlp scale by
+        'tokens': lambda max_len, num_rows: max_len * num_rows,
+        # number of padded arcs, what the arc mlp scales by
+        'quadratic': lambda max_len, num_rows: max_len * max_len * num_rows
+    }
 
     def __init__(self, data, bucket_width, max_len, min_len=1, batch_size=64,
-                 shuffle=True, right_leak=None, row_key=None, loop_forever=False):
+                 shuffle=True, right_leak=None, row_key=None, loop_forever=False,
+                 lengths=None, token_budget=None, budget_cost='tokens'):
         """
-        data: a list of rows
+        data: a list of rows - or anything that can be indexed by row
+        number, such as a MemmapCorpus.
 
         bucket_width: int - how much of a difference in length is tolerable - 
         hashed to the same bucket.
@@ -34,15 +72,41 @@ class BucketManager(six.Iterator):
 
         row_key: callable - a function run on the row to compute a value to
         use to map it to a bucket
+
+        lengths: sequence of ints - precomputed value of row_key for each row.
+        If specified row_key is not used and rows are only accessed when they
+        are part of a batch, so data does not need to be resident in memory.
+
+        token_budget: int - if specified batches are also capped by cost,
+        rather than only by number of rows. A batch gets as many rows as fit
+        in the budget (at least one, even if that row is over budget on its
+        own). batch_size can be set to None to only cap batches by cost.
+
+        budget_cost: how to compute the cost of a batch - one of BATCH_COSTS.
+        'tokens' is the number of padded tokens and 'quadratic' the number of
+        padded arcs (max length squared times number of rows).
+
+        The random state used for shuffling and sampling buckets is seeded
+        from numpy's global random state when the manager is created, so
+        sampling is reproducible even if batches are drawn from a different
+        thread than the one training the model (see Prefetcher).
         """
         super(BucketManager, self).__init__()
         self.bucket_width = bucket_width
         self.batch_size = batch_size
         self.shuffle = shuffle
         self.right_leak = right_leak
+        self.token_budget = token_budget
+        if budget_cost not in self.BATCH_COSTS:
+            raise ValueError('budget_cost must be one of %s'
+                             % ', '.join(sorted(self.BATCH_COSTS)))
+        self.budget_cost = budget_cost
+        self.batch_cost = self.BATCH_COSTS[budget_cost]
+        assert(batch_size is not None or token_budget is not None)
         # by default we use the length of the first entry in the row to sort by
         self.row_key = row_key or (lambda x: len(x))
         self.loop_forever = loop_forever
+        self.random_state = np.random.RandomState(np.random.randint(2**31))
         self.batch_count = 0
         self.seq_count = 0
 
@@ -58,24 +122,29 @@ class BucketManager(six.Iterator):
         has_remainder = int(bucket_range % self.bucket_width > 0)
         self.num_buckets = exact_fit + has_remainder
 
-        self.buckets = [{self.DATA_KEY: [], self.END_INDEX_KEY: 0, self.INDEX_KEY: 0}
-                        for i in range(self.num_buckets)]
-
-        self.left_samples = np.zeros(self.num_buckets, dtype=np.float32)
-
-        for row in data:
-            length = self.row_key(row)
-            adjust_length = length - self.min_len
-            which_bucket = (adjust_length // self.bucket_width)
-            if which_bucket < 0:
-                raise IndexError
-            target = self.buckets[which_bucket]
-            target[self.DATA_KEY].append(row)
-            target[self.END_INDEX_KEY] += 1
-            self.left_samples[which_bucket] += 1
-
-        if self.shuffle:
-            self.shuffle_bucket_contents()
+        if not hasattr(data, '__getitem__'):
+            data = list(data)
+        self.data = data
+        if lengths is None:
+            lengths = [self.row_key(row) for row in data]
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        assert(len(self.lengths) == len(self.data))
+
+        # buckets hold indices of rows in data
+        self.which_buckets = (self.lengths - self.min_len) // self.bucket_width
+        if len(self.which_buckets) and (self.which_buckets.min() < 0 or
+                                        self.which_buckets.max() >= self.num_buckets):
+            raise IndexError('Row length outside [%d, %d]'
+                             % (self.min_len, self.max_len))
+        self.bucket_counts = np.bincount(self.which_buckets,
+                                         minlength=self.num_buckets)
+        self.buckets = [{self.DATA_KEY: [],
+                         self.END_INDEX_KEY: int(count),
+                         self.INDEX_KEY: 0}
+                        for count in self.bucket_counts]
+        self._fill_buckets(np.arange(len(self.lengths)))
+
+        self.reset()
 
     def __iter__(self):
         return self
@@ -93,64 +162,455 @@ class BucketManager(six.Iterator):
             else:
                 raise StopIteration
 
+    def _fill_buckets(self, order):
+        """Put row indices in buckets, keeping the relative order they have
+        in order."""
+        order = order[np.argsort(self.which_buckets[order], kind='mergesort')]
+        by_bucket = np.split(order, np.cumsum(self.bucket_counts)[:-1])
+        for bucket, indices in zip(self.buckets, by_bucket):
+            bucket[self.DATA_KEY] = indices.tolist()
+
     def shuffle_bucket_contents(self):
-        """Shuffles entries inside each bucket"""
-        for buck_indx in range(self.num_buckets):
-            target = self.buckets[buck_indx]
-            np.random.shuffle(target[self.DATA_KEY])
+        """Shuffles entries inside each bucket. Returns the permutation of
+        all rows that was used."""
+        perm = self.random_state.permutation(len(self.lengths))
+        self._fill_buckets(perm)
+        return perm
 
     def reset(self, shuffle=None):
-        """Resets status"""
+        """Plan the batches of a new epoch.
+
+        All rows are split into batches when the epoch starts, so that
+        drawing a batch is only a matter of moving a pointer. If shuffling,
+        rows are shuffled within buckets and batches are shuffled using a
+        single permutation of all rows: a batch is ranked by where its first
+        row ended up in the permutation. Otherwise batches come out in order
+        of bucket.
+        """
         shuffle = self.shuffle if shuffle is None else shuffle
         if shuffle:
-            self.shuffle_bucket_contents()
-        for buck_indx in range(self.num_buckets):
-            target = self.buckets[buck_indx]
+            perm = self.shuffle_bucket_contents()
+        for bucket in self.buckets:
             # rewinds index of each bucket
-            target[self.INDEX_KEY] = 0
-            self.left_samples[buck_indx] = target[self.END_INDEX_KEY]
-
-    def sample(self):
-        more_to_go = self.total_left
-        if more_to_go:
-            probs = self.left_samples/more_to_go
-            which_bucket = np.random.choice(self.num_buckets, 1, p=probs)[0]
+            bucket[self.INDEX_KEY] = 0
+        batches = []
+        for which_bucket in range(self.num_buckets):
             bucket = self.buckets[which_bucket]
+            while bucket[self.INDEX_KEY] < bucket[self.END_INDEX_KEY]:
+                batches.append(self._take_batch(which_bucket))
+        if shuffle and batches:
+            rank = np.empty_like(perm)
+            rank[perm] = np.arange(len(perm))
+            order = np.argsort(rank[[batch[0] for batch in batches]])
+            batches = [batches[i] for i in order]
+        self._set_plan(np.fromiter(chain.from_iterable(batches), dtype=np.int64,
+                                   count=sum(map(len, batches))),
+                       np.cumsum([0] + [len(batch) for batch in batches]),
+                       0)
+
+    def _set_plan(self, rows, offsets, pointer):
+        self.plan_rows = np.asarray(rows, dtype=np.int64)
+        self.plan_offsets = np.asarray(offsets, dtype=np.int64)
+        self.plan_pointer = int(pointer)
+
+    def _num_to_take(self, bucket, max_len, num_rows):
+        """How many rows to take from the front of what is left in bucket,
+        to add to a batch that has num_rows rows with longest length
+        max_len."""
+        index = bucket[self.INDEX_KEY]
+        room = bucket[self.END_INDEX_KEY] - index
+        if self.batch_size is not None:
+            room = min(room, self.batch_size - num_rows)
+        if self.token_budget is None or room <= 0:
+            return max(room, 0)
+        # each row costs at least 1, so no need to look further
+        room = min(room, self.token_budget)
+        lengths = self.lengths[bucket[self.DATA_KEY][index:index + room]]
+        max_lens = np.maximum.accumulate(np.maximum(lengths, max_len))
+        costs = self.batch_cost(max_lens, np.arange(num_rows + 1,
+                                                    num_rows + room + 1))
+        fits = int(np.searchsorted(costs, self.token_budget, side='right'))
+        # a row over budget on its own gets a batch of its own
+        if fits == 0 and num_rows == 0:
+            fits = 1
+        return fits
+
+    def _take_batch(self, which_bucket):
+        """Take the next batch of row indices from which_bucket. If the
+        bucket is nearly empty and there are others to the right with more
+        to go, combine rows from different buckets."""
+        leak_max_index = min(self.num_buckets - 1,
+                             which_bucket + (self.right_leak or 0))
+        data, max_len = [], 0
+        for leak_index in range(which_bucket, leak_max_index + 1):
+            bucket = self.buckets[leak_index]
             index = bucket[self.INDEX_KEY]
             left_over = bucket[self.END_INDEX_KEY] - index
-            num_samples = min((self.batch_size, left_over))
-            data = bucket[self.DATA_KEY][index : index + num_samples]
+            num_samples = self._num_to_take(bucket, max_len, len(data))
+            more_data = bucket[self.DATA_KEY][index : index + num_samples]
             bucket[self.INDEX_KEY] += num_samples
-            self.left_samples[which_bucket] -= num_samples
-
-            if self.right_leak:
-                # if we are sampling from a nearly empty bucket
-                # and there are others with more to go, combine batches
-                # from different buckets
-                leak_max_index = min(self.num_buckets - 1, which_bucket + self.right_leak)
-                leak_extension = self.left_samples[which_bucket: leak_max_index]
-                more_to_go = np.sum(leak_extension)
-                leak_index = which_bucket
-                cur_size = len(data)
-                while(cur_size < self.batch_size and leak_index <= leak_max_index and more_to_go):
-                    data = data[:]
-                    bucket = self.buckets[leak_index]
-                    index = bucket[self.INDEX_KEY]
-                    left_over = bucket[self.END_INDEX_KEY] - index
-                    num_samples = min((self.batch_size - cur_size, left_over))
-                    more_data = bucket[self.DATA_KEY][index : index + num_samples]
-                    bucket[self.INDEX_KEY] += num_samples
-                    self.left_samples[leak_index] -= num_samples
-                    data.extend(more_data)
-                    more_to_go = np.sum(leak_extension)
-                    cur_size = len(data)
-                    leak_index += 1
-            return data
+            data.extend(more_data)
+            if more_data:
+                max_len = max(max_len, int(self.lengths[more_data].max()))
+            # the batch is full
+            if num_samples < left_over:
+                break
+        return data
+
+    def sample(self):
+        """Next batch of the epoch plan or None if the epoch is over."""
+        if self.plan_pointer < len(self.plan_offsets) - 1:
+            start, end = self.plan_offsets[self.plan_pointer:self.plan_pointer + 2]
+            self.plan_pointer += 1
+            return [self.data[i] for i in self.plan_rows[start:end].tolist()]
         return None
 
+    def bucket_bounds(self, length):
+        """The range [low, high] of lengths of the bucket length maps to."""
+        low = self.min_len + ((length - self.min_len) // self.bucket_width
+                              * self.bucket_width)
+        return low, low + self.bucket_width - 1
+
     @property
     def total_left(self):
-        return int(sum(self.left_samples))
+        return int(self.plan_offsets[-1] - self.plan_offsets[self.plan_pointer])
+
+    def state_dict(self):
+        """The position in the current epoch and the random state as a dict
+        of numpy arrays, so that we can resume iterating from where we
+        were (see load_state_dict)."""
+        state = {'plan_rows': self.plan_rows,
+                 'plan_offsets': self.plan_offsets,
+                 'plan_pointer': np.array(self.plan_pointer),
+                 'batch_count': np.array(self.batch_count),
+                 'seq_count': np.array(self.seq_count)}
+        for key, value in rng_state_dict(self.random_state).items():
+            state['rng_%s' % key] = value
+        return state
+
+    def load_state_dict(self, state):
+        """Resume from a state returned by state_dict. The manager needs
+        to have been created with the same data."""
+        if len(state['plan_rows']) and \
+                int(np.max(state['plan_rows'])) >= len(self.data):
+            raise ValueError('Epoch plan refers to rows not in data')
+        self._set_plan(state['plan_rows'], state['plan_offsets'],
+                       state['plan_pointer'])
+        self.batch_count = int(state['batch_count'])
+        self.seq_count = int(state['seq_count'])
+        load_rng_state_dict(dict((key[len('rng_'):], value)
+                                 for key, value in state.items()
+                                 if key.startswith('rng_')),
+                            self.random_state)
+
+
+class Prefetcher(six.Iterator):
+    """Iterates over func(item) for each item of iterable. Items are
+    consumed and func is applied in a background thread that keeps up to
+    size results ready, so the caller doesn't wait for them.
+
+    Exceptions raised in the background thread are raised by __next__.
+    Call close (or use as a context manager) to stop the thread early.
+    """
+
+    _END = object()
+
+    def __init__(self, iterable, func=None, size=2):
+        super(Prefetcher, self).__init__()
+        self.func = func or (lambda x: x)
+        self.size = size
+        self._queue = queue.Queue(maxsize=size)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._produce,
+                                        args=(iter(iterable),))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._thread is None:
+            raise StopIteration
+        item, error = self._queue.get()
+        if item is self._END:
+            self._thread.join()
+            self._thread = None
+            if error is not None:
+                raise error
+            raise StopIteration
+        return item
+
+    def _put(self, entry):
+        # we time out in order to check whether we were asked to stop
+        while not self._stop.is_set():
+            try:
+                self._queue.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, items):
+        try:
+            for item in items:
+                if not self._put((self.func(item), None)):
+                    return
+        except Exception as e:
+            self._put((self._END, e))
+        else:
+            self._put((self._END, None))
+
+    def close(self):
+        """Stop the background thread - prepared items are discarded."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+
+class _Stage(object):
+    """Adds the time spent in a with block to a StageTimer."""
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        if self.timer.sync is not None:
+            self.timer.sync()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        if self.timer.sync is not None:
+            self.timer.sync()
+        self.timer.add(self.name, time.time() - self.start)
+        return False
+
+
+class StageTimer(object):
+    """Wall clock time spent in named stages of the computation.
+
+        with timer.stage('lstm'):
+            ...
+
+    Stages can be nested - the time of an outer stage includes that of
+    the stages inside it.
+
+    sync: callable - if specified, it is called before reading the clock.
+    On the gpu pass a function that synchronizes the device, otherwise the
+    time of kernels that run asynchronously is charged to a later stage.
+    """
+
+    enabled = True
+
+    def __init__(self, sync=None):
+        super(StageTimer, self).__init__()
+        self.sync = sync
+        self.totals = dict()
+        self.counts = dict()
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def add(self, name, seconds):
+        self.totals[name] = self.totals.get(name, 0.) + seconds
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def reset(self):
+        """Zero the times - stages seen so far are still reported."""
+        for name in self.totals:
+            self.totals[name] = 0.
+            self.counts[name] = 0
+
+    def as_dict(self, prefix='time_'):
+        return dict(('%s%s' % (prefix, name), total)
+                    for name, total in self.totals.items())
+
+
+class _NullStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class NullTimer(object):
+    """A StageTimer that doesn't time anything - the default of models,
+    so that instrumented code costs next to nothing unless profiling."""
+
+    enabled = False
+    _stage = _NullStage()
+
+    def stage(self, name):
+        return self._stage
+
+    def add(self, name, seconds):
+        pass
+
+    def reset(self):
+        pass
+
+    def as_dict(self, prefix='time_'):
+        return dict()
+
+
+NULL_TIMER = NullTimer()
+
+
+def max_rss_bytes():
+    """Peak resident memory of the process so far - None if we can't tell
+    (the resource module is unix only)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on mac, kilobytes elsewhere
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+class _Track(object):
+
+    def __init__(self, tracker, max_len, predicted):
+        self.tracker = tracker
+        self.max_len = max_len
+        self.predicted = predicted
+
+    def __enter__(self):
+        self.start = self.tracker._reset_peak()
+        return self
+
+    def __exit__(self, *args):
+        _, peak = self.tracker._tracemalloc.get_traced_memory()
+        self.tracker.add(self.max_len, peak - self.start, self.predicted)
+        return False
+
+
+class MemoryTracker(object):
+    """Peak memory allocated while processing each batch, aggregated by the
+    length bucket of the longest sentence of the batch.
+
+        with tracker.track(max_len):
+            ... forward and backward ...
+
+    Allocations are measured with tracemalloc, which sees numpy arrays (and
+    python objects) but not gpu memory - it slows things down, so only
+    track when looking into memory. It traces all threads, so allocations
+    of other threads while tracking (eg: a Prefetcher) are counted too.
+    The peak resident memory of the process is reported too.
+
+    buckets: a BucketManager - batches are keyed by its bucket of their
+    max length, otherwise by the max length itself.
+    """
+
+    def __init__(self, buckets=None):
+        super(MemoryTracker, self).__init__()
+        import tracemalloc
+        self._tracemalloc = tracemalloc
+        self._started = not tracemalloc.is_tracing()
+        if self._started:
+            tracemalloc.start()
+        self.buckets = buckets
+        self.by_bucket = dict()
+
+    def _reset_peak(self):
+        """Start a new peak - returns the memory allocated now."""
+        if hasattr(self._tracemalloc, 'reset_peak'):
+            self._tracemalloc.reset_peak()
+        else:
+            # before python 3.9 the only way to reset the peak is restarting
+            self._tracemalloc.stop()
+            self._tracemalloc.start()
+        return self._tracemalloc.get_traced_memory()[0]
+
+    def bucket(self, max_len):
+        if self.buckets is None:
+            return '%d' % max_len
+        return '%d-%d' % self.buckets.bucket_bounds(max_len)
+
+    def track(self, max_len, predicted=None):
+        """Context manager that records the peak memory allocated within
+        it for a batch of longest sentence max_len.
+
+        predicted: the memory we expected the batch to need - reported
+        alongside the measurement.
+        """
+        return _Track(self, max_len, predicted)
+
+    def add(self, max_len, peak, predicted=None):
+        stats = self.by_bucket.setdefault(self.bucket(max_len),
+                                          {'batches': 0, 'max_len': 0,
+                                           'peak_bytes': 0, 'total_bytes': 0,
+                                           'predicted_bytes': 0})
+        stats['batches'] += 1
+        stats['max_len'] = max(stats['max_len'], max_len)
+        stats['peak_bytes'] = max(stats['peak_bytes'], peak)
+        stats['total_bytes'] += peak
+        if predicted is not None:
+            stats['predicted_bytes'] = max(stats['predicted_bytes'], predicted)
+
+    def reset(self):
+        self.by_bucket.clear()
+
+    def as_dict(self, prefix='mem_'):
+        by_bucket = dict()
+        for bucket, stats in self.by_bucket.items():
+            stats = dict(stats)
+            stats['mean_bytes'] = stats.pop('total_bytes') / float(stats['batches'])
+            by_bucket[bucket] = stats
+        return {'%speak_rss' % prefix: max_rss_bytes(),
+                '%sby_bucket' % prefix: by_bucket}
+
+    def close(self):
+        """Stop tracing - if we were the ones that started it."""
+        if self._started:
+            self._tracemalloc.stop()
+            self._started = False
+
+
+def length_strata(lengths, num_strata):
+    """Split rows into at most num_strata strata of similar size by length.
+
+    returns: edges - stratum i holds rows with edges[i-1] < length <= edges[i]
+    (see np.searchsorted) and the stratum of each row.
+    """
+    lengths = np.asarray(lengths)
+    # quantiles that are lengths we have seen
+    qs = np.linspace(0, 1, num_strata + 1)[1:-1]
+    positions = np.floor(qs * (len(lengths) - 1)).astype(np.int64)
+    edges = np.unique(np.sort(lengths)[positions])
+    return edges, np.searchsorted(edges, lengths)
+
+
+def stratified_sample(lengths, sample_size, num_strata=10, random_state=None):
+    """Sample sample_size rows without replacement, stratified by length:
+    each stratum (see length_strata) gets its share of the sample (at
+    least one row).
+
+    returns: sorted indices of the sampled rows, the edges of the strata
+    and the number of rows in each stratum.
+    """
+    random_state = random_state or np.random
+    edges, strata = length_strata(lengths, num_strata)
+    sizes = np.bincount(strata, minlength=len(edges) + 1)
+    to_take = np.clip(np.round(sample_size * sizes / float(len(strata))),
+                      1, sizes).astype(np.int64)
+    indices = []
+    for stratum, num in enumerate(to_take):
+        if num > 0:
+            members = np.flatnonzero(strata == stratum)
+            indices.append(random_state.choice(members, num, replace=False))
+    return np.sort(np.concatenate(indices)), edges, sizes
 
 
 class Experiment(object):
@@ -179,10 +639,13 @@ class Experiment(object):
         self.results['test_results'] = results
 
     def to_yaml(self):
+        # yaml is slow to import and only needed here
+        import yaml
         return yaml.dump(self.__dict__, default_flow_style=False)
 
     @classmethod
     def from_yaml(cl, yaml_string):
+        import yaml
         return cl(**yaml.load(yaml_string))
 
     @staticmethod
@@ -222,6 +685,7 @@ class Experiment(object):
 
     @classmethod
     def load(cl, filename):
+        import yaml
         with open(filename, 'r') as f:
             yml = yaml.load(f.read())
         return cl(**yml)
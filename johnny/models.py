@@ -5,9 +5,10 @@ import chainer.links as L
 import chainer
 from time import sleep
 from chainer import Variable, cuda
-from johnny.misc import bar, discrete_print
+from johnny.misc import bar, discrete_print, NULL_TIMER
 from johnny.extern import DependencyDecoder
 from johnny.vocab import UDepVocab
+from johnny.components import PreparedInputs, transpose_seqs, chunked_arc_scores
 
 
 # TODO Check multiple roots issue
@@ -18,6 +19,9 @@ class GraphParser(chainer.Chain):
 
     MIN_PAD = -100.
     TREE_OPTS = ['none', 'chu', 'eisner']
+    ARC_SCORERS = ['mlp', 'chunked', 'biaffine']
+    # times the stages of the forward pass - see set_timer
+    timer = NULL_TIMER
 
     def __init__(self,
                  encoder,
@@ -28,8 +32,20 @@ class GraphParser(chainer.Chain):
                  lbl_dropout=0.5,
                  treeify='chu',
                  visualise=False,
-                 debug=False
+                 debug=False,
+                 arc_scorer='mlp',
+                 arc_chunk_size=4096
                  ):
+        """
+        arc_scorer: how to score the arcs between heads and dependents.
+        mlp: v . tanh(H h + D d) - keeps the activations of all pairs for
+        backprop (batch_size x max_len^2 x mlp_arc_units floats).
+        chunked: same model (and parameters) as mlp, but pairs are scored
+        in tiles of arc_chunk_size pairs and the activations are recomputed
+        in backward, so memory doesn't grow with mlp_arc_units x max_len^2.
+        biaffine: tanh(D d) U tanh(H h) + u . tanh(H h) - only the scores
+        are quadratic in the sentence length.
+        """
 
         super(GraphParser, self).__init__()
         self.num_labels = num_labels
@@ -41,14 +57,22 @@ class GraphParser(chainer.Chain):
         self.visualise = visualise
         self.debug = debug
         self.sleep_time = 0.
+        self.arc_scorer = arc_scorer
+        self.arc_chunk_size = arc_chunk_size
 
         assert(treeify in self.TREE_OPTS)
+        assert(arc_scorer in self.ARC_SCORERS)
         self.unit_mult = 2 if encoder.use_bilstm else 1
 
         with self.init_scope():
             self.encoder = encoder
 
-            self.vT = L.Linear(mlp_arc_units, 1)
+            if arc_scorer == 'biaffine':
+                self.U_arc = chainer.Parameter(chainer.initializers.Zero(),
+                                               (mlp_arc_units, mlp_arc_units))
+                self.u_arc = L.Linear(mlp_arc_units, 1, nobias=True)
+            else:
+                self.vT = L.Linear(mlp_arc_units, 1)
             # head
             self.H_arc = L.Linear(self.unit_mult*self.encoder.num_units, mlp_arc_units)
             # dependent
@@ -58,6 +82,48 @@ class GraphParser(chainer.Chain):
             self.U_lbl = L.Linear(self.unit_mult*self.encoder.num_units, mlp_lbl_units)
             self.W_lbl = L.Linear(self.unit_mult*self.encoder.num_units, mlp_lbl_units)
 
+    def set_timer(self, timer):
+        """Time the stages of the forward pass (encoder, heads, decode,
+        labels and those of the SentenceEncoder) with timer - a
+        johnny.misc.StageTimer. Pass None to stop timing."""
+        timer = timer or NULL_TIMER
+        self.timer = timer
+        self.encoder.timer = timer
+
+    def activation_bytes(self, batch_size, max_len):
+        """Rough estimate of the memory (in bytes) a training step on a
+        batch of batch_size sentences, the longest of which has max_len
+        words, needs for its activations and their gradients (on top of
+        the parameters and their gradients).
+
+        With the mlp arc scorer it is dominated by _predict_heads: for each
+        dependent we add the activations of all max_len + 1 possible heads
+        to those of the dependent and keep the tanh of the sum (and its
+        dropout) for backprop - batch_size x max_len x (max_len + 1) x
+        mlp_arc_units floats each. The other scorers only keep the scores.
+        """
+        itemsize = 4
+        pairs = batch_size * max_len * (max_len + 1)
+        if self.arc_scorer == 'mlp':
+            # tanh and its gradient - dropout keeps a mask and its output
+            arc_copies = 2 + 2 * int(self.arc_dropout > 0.)
+            arc_bytes = pairs * self.mlp_arc_units * arc_copies * itemsize
+        else:
+            # scores, their softmax and gradients
+            arc_bytes = pairs * 4 * itemsize
+            if self.arc_scorer == 'chunked':
+                # the activations of the tile being computed
+                tile = min(self.arc_chunk_size, pairs)
+                arc_bytes += tile * self.mlp_arc_units * 4 * itemsize
+        # everything else is linear in the number of tokens
+        tokens = batch_size * (max_len + 2)
+        states = self.unit_mult * self.encoder.num_units
+        # the lstms keep the gates, cells and outputs of each step
+        token_bytes = tokens * (16 * states * self.encoder.num_layers +
+                                4 * (self.mlp_arc_units + self.mlp_lbl_units) +
+                                self.num_labels) * itemsize
+        return arc_bytes + token_bytes
+
     def _predict_heads(self, sent_states, mask, batch_stats, sorted_heads=None):
         """For each token in the sentence predict which token in the sentence
         is its head."""
@@ -91,6 +157,15 @@ class GraphParser(chainer.Chain):
                                            self.MIN_PAD,
                                            dtype=self.xp.float32))
 
+        if self.arc_scorer == 'mlp':
+            all_arcs = None
+        else:
+            # dependents (not root) x bs x heads
+            all_arcs = F.transpose(self._score_all_arcs(h_arc, d_arc[1:]),
+                                   (0, 2, 1))
+            # split once - indexing each would backprop a full size array
+            all_arcs = F.split_axis(all_arcs, max_sent_len - 1, axis=0)
+
         sent_arcs = []
         # we start from 1 because we don't consider root
         for i in range(1, max_sent_len):
@@ -99,27 +174,10 @@ class GraphParser(chainer.Chain):
             if calc_loss:
                 # i-1 because sentence has root appended to beginning
                 gold_heads = sorted_heads[i-1]
-            # ================== HEAD PREDICTION ======================
-            # NOTE Because some sentences may be shorter - only num_active of
-            # the batch have valid activations for this token. If in softmax
-            # we didn't limit arcs to [:num_active] we would need to replace
-            # embeddings that are out of sentence range with zeros - because
-            # otherwise when broadcasting and summing we will modify valid
-            # batch activations for earlier tokens of the sentence.
-            # ====================== Code for padding ==========================
-            # invalid_pad = ((0, int(batch_size - num_active)), (0, 0))
-            # d_arc_pad = F.pad(d_arc[i][:num_active],
-            #                   invalid_pad, 'constant', constant_values=0.)
-            # ==================================================================
-            a_u, a_w = F.broadcast(h_arc, d_arc[i])
-
-            arc_logit = F.reshape(F.tanh(a_u + a_w), (-1, self.mlp_arc_units))
-
-            if self.arc_dropout > 0.:
-                arc_logit = F.dropout(arc_logit, ratio=self.arc_dropout)
-
-            arc_logit = self.vT(arc_logit)
-            arcs = F.swapaxes(F.reshape(arc_logit, (-1, batch_size)), 0, 1)
+            if all_arcs is not None:
+                arcs = F.reshape(all_arcs[i-1], (batch_size, -1))
+            else:
+                arcs = self._score_arcs(h_arc, d_arc[i], batch_size)
             arcs = F.where(mask, arcs, mask_vals)
             # Calculate losses
             if calc_loss:
@@ -127,21 +185,76 @@ class GraphParser(chainer.Chain):
                 # NOTE: do not use ignore_label - in gpu mode gold_heads gets mutated
                 # and furthermore we would need to have padded invalid state of
                 # d_arc[i] with zeros before broadcasting. 
-                # see NOTE above
+                # see NOTE in _score_arcs
                 head_loss = F.sum(F.softmax_cross_entropy(arcs[:num_active], gold_heads[:num_active], reduce='no'))
                 self.loss += head_loss
             sent_arcs.append(F.reshape(arcs, (batch_size, -1, 1)))
         arcs = F.concat(sent_arcs, axis=2)
         return arcs
 
+    def _score_arcs(self, h_arc, d_arc_i, batch_size):
+        """mlp scores of all heads for the dependents at one position of
+        the batch - batch_size x heads."""
+        # ================== HEAD PREDICTION ======================
+        # NOTE Because some sentences may be shorter - only num_active of
+        # the batch have valid activations for this token. If in softmax
+        # we didn't limit arcs to [:num_active] we would need to replace
+        # embeddings that are out of sentence range with zeros - because
+        # otherwise when broadcasting and summing we will modify valid
+        # batch activations for earlier tokens of the sentence.
+        # ====================== Code for padding ==========================
+        # invalid_pad = ((0, int(batch_size - num_active)), (0, 0))
+        # d_arc_pad = F.pad(d_arc[i][:num_active],
+        #                   invalid_pad, 'constant', constant_values=0.)
+        # ==================================================================
+        a_u, a_w = F.broadcast(h_arc, d_arc_i)
+
+        arc_logit = F.reshape(F.tanh(a_u + a_w), (-1, self.mlp_arc_units))
+
+        if self.arc_dropout > 0.:
+            arc_logit = F.dropout(arc_logit, ratio=self.arc_dropout)
+
+        arc_logit = self.vT(arc_logit)
+        return F.swapaxes(F.reshape(arc_logit, (-1, batch_size)), 0, 1)
+
+    def _score_all_arcs(self, h_arc, d_arc):
+        """Scores of all heads for all dependents at once with the chunked
+        or biaffine scorer.
+
+        h_arc: heads x bs x mlp_arc_units, d_arc: dependents x bs x
+        mlp_arc_units
+
+        returns: dependents x heads x bs
+        """
+        if self.arc_scorer == 'chunked':
+            return chunked_arc_scores(h_arc, d_arc, self.vT.W, self.vT.b,
+                                      self.arc_chunk_size,
+                                      dropout=self.arc_dropout)
+        heads, deps = F.tanh(h_arc), F.tanh(d_arc)
+        if self.arc_dropout > 0.:
+            heads = F.dropout(heads, ratio=self.arc_dropout)
+            deps = F.dropout(deps, ratio=self.arc_dropout)
+        num_heads, batch_size, units = heads.shape
+        # bs x heads x units
+        heads = F.swapaxes(heads, 0, 1)
+        deps = F.swapaxes(deps, 0, 1)
+        deps_U = F.reshape(F.matmul(F.reshape(deps, (-1, units)), self.U_arc),
+                           deps.shape)
+        # bs x dependents x heads
+        scores = F.batch_matmul(deps_U, heads, transb=True)
+        # how likely each word is to be a head at all
+        head_bias = F.reshape(self.u_arc(F.reshape(heads, (-1, units))),
+                              (batch_size, 1, num_heads))
+        scores = scores + F.broadcast_to(head_bias, scores.shape)
+        return F.transpose(scores, (1, 2, 0))
+
     def _predict_labels(self, sent_states, pred_heads, gold_heads, batch_stats,
-                        sorted_labels=None):
+                        gold_labels=None):
         """Predict the label for each of the arcs predicted in _predict_heads."""
         batch_size, max_sent_len, col_lengths = batch_stats
 
-        calc_loss = sorted_labels is not None
-        if calc_loss:
-            labels = self.encoder.transpose_batch(sorted_labels)
+        calc_loss = gold_labels is not None
+        labels = gold_labels
 
         u_lbl = self.U_lbl(sent_states)
         u_lbl = F.reshape(u_lbl, (-1, batch_size, self.mlp_lbl_units))
@@ -157,7 +270,7 @@ class GraphParser(chainer.Chain):
             # if we are calculating loss create truth variables
             if calc_loss:
                 # i-1 because sentence has root appended to beginning
-                gold_labels = labels[i-1]
+                true_labels = labels[i-1]
 
                 true_heads = gold_heads[i-1]
             arc_pred = pred_heads[i-1]
@@ -182,7 +295,7 @@ class GraphParser(chainer.Chain):
 
             # Calculate losses
             if calc_loss:
-                label_loss = F.sum(F.softmax_cross_entropy(lbls[:num_active], gold_labels[:num_active], reduce='no'))
+                label_loss = F.sum(F.softmax_cross_entropy(lbls[:num_active], true_labels[:num_active], reduce='no'))
                 self.loss += label_loss
 
             reshaped_lbls = F.reshape(lbls, (num_active, -1, 1))
@@ -192,6 +305,17 @@ class GraphParser(chainer.Chain):
         lbls = F.concat(sent_lbls, axis=2)
         return lbls
 
+    def prepare_batch(self, *inputs, **kwargs):
+        """Do all the python side work on a batch before computation can
+        start (see PreparedBatch). The result can be passed to __call__
+        instead of the inputs. Doesn't modify the model, so it is safe
+        to call from a background thread."""
+        is_subword = getattr(self.encoder.embedder, 'is_subword', False)
+        return PreparedBatch(inputs,
+                             heads=kwargs.get('heads', None),
+                             labels=kwargs.get('labels', None),
+                             is_subword=is_subword)
+
     def __call__(self, *inputs, **kwargs):
         """ Expects a batch of sentences 
         so a list of K sentences where each sentence
@@ -203,32 +327,49 @@ class GraphParser(chainer.Chain):
 
         w = word, p = pos tag, s = sentence
 
+        Alternatively expects a single PreparedBatch as returned by
+        prepare_batch, which already contains the heads and labels.
+
         This is as slow as the longest sentence - so bucketing sentences
         of same size can speed up training - prediction.
         """
         assert(len(inputs) >= 1)
-        heads = kwargs.get('heads', None)
-        labels = kwargs.get('labels', None)
-
-        calc_loss = ((heads is not None) and (labels is not None))
-        # in order to process batches of different sized sentences using LSTM in chainer
-        # we need to sort by sentence length.
-        # The longest sentences in tokens need to be at the beginning of the
-        # list, since chainer will simply not update the states corresponding
-        # to the smallest sentences that have 'run out of tokens'.
-        # We keep the permutation indices in order to reorder the output states,
-        # since we want to map the activations to the inputs.
-        perm_indices, sorted_batch = zip(*sorted(enumerate(zip(*inputs)),
-                                                 key=lambda x: len(x[1][0]),
-                                                 reverse=True))
-        sorted_inputs = list(zip(*sorted_batch))
-        if calc_loss:
-            sorted_heads = [heads[i] for i in perm_indices]
-            sorted_labels = [labels[i] for i in perm_indices]
+        if isinstance(inputs[0], PreparedBatch):
+            batch = inputs[0]
         else:
-            sorted_heads, sorted_labels = None, None
+            batch = self.prepare_batch(*inputs, **kwargs)
+        return self._forward(batch, calc_loss=batch.has_targets)
+
+    def predict(self, *inputs, **kwargs):
+        """Parse a batch of sentences (or a PreparedBatch) - same inputs as
+        __call__ without the heads and labels. Runs in test mode without
+        building the graph for backprop and without computing the loss,
+        even if the batch has targets.
 
-        comb_states_2d = self.encoder(*sorted_inputs)
+        return_scores: if True, also return for each sentence the
+        probabilities of the heads (sent_len + 1 x sent_len - over the
+        possible heads of each token) and of the labels (num_labels x
+        sent_len - labels of the predicted arcs).
+
+        returns: arc_preds, lbl_preds (, arc_scores, lbl_scores)
+        """
+        return_scores = kwargs.pop('return_scores', False)
+        assert(len(inputs) >= 1)
+        with chainer.using_config('train', False), \
+                chainer.no_backprop_mode():
+            if isinstance(inputs[0], PreparedBatch):
+                batch = inputs[0]
+            else:
+                batch = self.prepare_batch(*inputs)
+            return self._forward(batch, calc_loss=False,
+                                 return_scores=return_scores)
+
+    def _forward(self, batch, calc_loss=True, return_scores=False):
+        perm_indices = batch.perm_indices
+        sorted_heads, sorted_labels = batch.sorted_heads, batch.sorted_labels
+
+        with self.timer.stage('encoder'):
+            comb_states_2d = self.encoder(batch.inputs)
 
         self.loss = 0
 
@@ -239,69 +380,77 @@ class GraphParser(chainer.Chain):
         if calc_loss:
             # NOTE: We need the heads variables both in predict heads & labels
             # heads are seq_len - 1 in length because they don't include ROOT
-            gold_heads = self.encoder.transpose_batch(sorted_heads)
+            gold_heads = [Variable(self.xp.asarray(h)) for h in batch.heads]
+            gold_labels = [Variable(self.xp.asarray(l)) for l in batch.labels]
         else:
-            gold_heads = None
+            gold_heads, gold_labels = None, None
 
-        arcs = self._predict_heads(comb_states_2d, self.encoder.mask, batch_stats,
-                sorted_heads=gold_heads)
+        with self.timer.stage('heads'):
+            arcs = self._predict_heads(comb_states_2d, self.encoder.mask,
+                                       batch_stats, sorted_heads=gold_heads)
 
         if self.debug or self.visualise:
             self.arcs = cuda.to_cpu(F.softmax(arcs).data)
-
-        if self.treeify != 'none':
-            # TODO: check multiple roots issue
-            # We process the head scores to apply tree constraints
-            arcs = cuda.to_cpu(arcs.data)
-            # arcs are batch_size x sent_len + 1 x sent_len
-            # axis 1 has the scores over the sentence
-            # axis 2 is one shorter because we don't predict for root
-            dd = DependencyDecoder()
-            # sent length not taking root into account
-            sent_lengths = [len(sent) for sent in sorted_inputs[0]]
-            arc_preds = []
-            if self.treeify == 'chu':
-                # Just remove cycles, non-projective trees are ok
-                for l, score_mat in zip(sent_lengths, arcs):
-                    # remove fallout from batch size
-                    trunc_score_mat = score_mat[:l+1, :l]
-                    # DependencyDecoder expects a square matrix - fill root col with zeros
-                    trunc_score_mat = np.pad(trunc_score_mat, ((0, 0), (1, 0)), 'constant')
-                    nproj_arcs = dd.parse_nonproj(trunc_score_mat)[1:]
-                    arc_preds.append(nproj_arcs)
-
-                # arc_preds = np.array([dd.parse_nonproj(each)[1:] for each in pd_arcs])
-            elif self.treeify == 'eisner':
-                # Remove cycles and make sure trees are projective
-                for l, score_mat in zip(sent_lengths, arcs):
-                    # remove fallout from batch size
-                    trunc_score_mat = score_mat[:l+1, :l]
-                    # DependencyDecoder expects a square matrix - fill root col with zeros
-                    trunc_score_mat = np.pad(trunc_score_mat, ((0, 0), (1, 0)), 'constant')
-                    proj_arcs = dd.parse_proj(trunc_score_mat)[1:]
-                    arc_preds.append(proj_arcs)
+        if return_scores:
+            arc_scores = cuda.to_cpu(F.softmax(arcs).data)
+
+        with self.timer.stage('decode'):
+            if self.treeify != 'none':
+                # TODO: check multiple roots issue
+                # We process the head scores to apply tree constraints
+                arcs = cuda.to_cpu(arcs.data)
+                # arcs are batch_size x sent_len + 1 x sent_len
+                # axis 1 has the scores over the sentence
+                # axis 2 is one shorter because we don't predict for root
+                dd = DependencyDecoder()
+                # sent length not taking root into account
+                sent_lengths = batch.lengths[perm_indices].tolist()
+                arc_preds = []
+                if self.treeify == 'chu':
+                    # Just remove cycles, non-projective trees are ok
+                    for l, score_mat in zip(sent_lengths, arcs):
+                        # remove fallout from batch size
+                        trunc_score_mat = score_mat[:l+1, :l]
+                        # DependencyDecoder expects a square matrix - fill root col with zeros
+                        trunc_score_mat = np.pad(trunc_score_mat, ((0, 0), (1, 0)), 'constant')
+                        nproj_arcs = dd.parse_nonproj(trunc_score_mat)[1:]
+                        arc_preds.append(nproj_arcs)
+
+                    # arc_preds = np.array([dd.parse_nonproj(each)[1:] for each in pd_arcs])
+                elif self.treeify == 'eisner':
+                    # Remove cycles and make sure trees are projective
+                    for l, score_mat in zip(sent_lengths, arcs):
+                        # remove fallout from batch size
+                        trunc_score_mat = score_mat[:l+1, :l]
+                        # DependencyDecoder expects a square matrix - fill root col with zeros
+                        trunc_score_mat = np.pad(trunc_score_mat, ((0, 0), (1, 0)), 'constant')
+                        proj_arcs = dd.parse_proj(trunc_score_mat)[1:]
+                        arc_preds.append(proj_arcs)
+                else:
+                    raise ValueError('Unexpected method')
+                p_arcs = self.encoder.transpose_batch(arc_preds, create_var=False)
             else:
-                raise ValueError('Unexpected method')
-            p_arcs = self.encoder.transpose_batch(arc_preds, create_var=False)
-        else:
-            # We ignore tree constraints - head predictions may create cycles
-            # we pass predict_labels the gpu object
-            arcs = arcs.data
-            p_arcs = self.xp.argmax(arcs, axis=1)
-            arc_preds = cuda.to_cpu(p_arcs)
-            p_arcs = np.swapaxes(p_arcs, 0, 1)
+                # We ignore tree constraints - head predictions may create cycles
+                # we pass predict_labels the gpu object
+                arcs = arcs.data
+                p_arcs = self.xp.argmax(arcs, axis=1)
+                arc_preds = cuda.to_cpu(p_arcs)
+                p_arcs = np.swapaxes(p_arcs, 0, 1)
 
-        lbls = self._predict_labels(comb_states_2d, p_arcs, gold_heads,
-                batch_stats, sorted_labels=sorted_labels)
+        with self.timer.stage('labels'):
+            lbls = self._predict_labels(comb_states_2d, p_arcs, gold_heads,
+                                        batch_stats, gold_labels=gold_labels)
 
         if self.debug or self.visualise:
             self.lbls = cuda.to_cpu(F.softmax(lbls).data)
+        if return_scores:
+            lbl_scores = cuda.to_cpu(F.softmax(lbls).data)
 
         lbls = cuda.to_cpu(lbls.data)
 
         # we only bother actually getting the softmax values
         # if we are to visualise the results
-        if self.visualise:
+        if self.visualise and calc_loss:
             # replace logits with prob from softmax - we pad with the exp
             # of the MIN_PAD - since that would have been the value if we passed
             # the MIN_PAD through the softmax
@@ -320,9 +469,11 @@ class GraphParser(chainer.Chain):
 
         # normalize loss over all tokens seen
         total_tokens = np.sum(self.encoder.col_lengths)
-        self.loss = self.loss / total_tokens
+        self.num_tokens = total_tokens
+        if calc_loss:
+            self.loss = self.loss / total_tokens
 
-        inv_perm_indices = [perm_indices.index(i) for i in range(len(perm_indices))]
+        inv_perm_indices = batch.inv_perm_indices
         if self.debug or self.visualise:
             self.arcs = self.arcs[inv_perm_indices]
             self.lbls = self.lbls[inv_perm_indices]
@@ -333,11 +484,17 @@ class GraphParser(chainer.Chain):
 
         lbl_preds = np.argmax(lbls, axis=1)
 
-        input_sent_lengths = [len(sent) for sent in inputs[0]]
+        input_sent_lengths = batch.lengths.tolist()
 
         arc_preds = [arc_p[:l] for arc_p, l in zip(arcs, input_sent_lengths)]
         lbl_preds = [lbl_p[:l] for lbl_p, l in zip(lbl_preds, input_sent_lengths)]
 
+        if return_scores:
+            arc_scores = [arc_scores[i][:l+1, :l] for i, l
+                          in zip(inv_perm_indices, input_sent_lengths)]
+            lbl_scores = [lbl_scores[i][:, :l] for i, l
+                          in zip(inv_perm_indices, input_sent_lengths)]
+            return arc_preds, lbl_preds, arc_scores, lbl_scores
         return arc_preds, lbl_preds
 
     def _visualise(self, arcs, lbls, gold_heads, gold_labels):
@@ -366,3 +523,51 @@ class GraphParser(chainer.Chain):
             one_hot_arc[correct_head_index] = 0.
             one_hot_lbl[correct_lbl_index] = 0.
             sleep(self.sleep_time)
+
+
+class PreparedBatch(object):
+    """A batch of inputs (and optionally targets) ready for GraphParser.
+
+    The sentences are sorted from longest to shortest since the LSTM
+    needs the longest sentences in tokens at the beginning of the batch:
+    chainer will simply not update the states corresponding to the
+    smallest sentences that have 'run out of tokens'. We keep the
+    permutation indices in order to reorder the predictions, since we want
+    to map them to the inputs. The inputs are augmented and transposed
+    for the encoder (see PreparedInputs) and the heads and labels are
+    transposed to time major int32 arrays.
+
+    Only numpy is used, so batches can be prepared in a background thread
+    (see johnny.misc.Prefetcher) - the model only moves the arrays to the
+    device.
+    """
+
+    def __init__(self, inputs, heads=None, labels=None, is_subword=False):
+        super(PreparedBatch, self).__init__()
+        self.lengths = np.array([len(sent) for sent in inputs[0]],
+                                dtype=np.int64)
+        # stable sort keeps sentences of same length in input order
+        self.perm_indices = np.argsort(-self.lengths, kind='mergesort')
+        self.inv_perm_indices = np.argsort(self.perm_indices)
+        perm = self.perm_indices.tolist()
+        sorted_inputs = [[seq[i] for i in perm] for seq in inputs]
+        self.inputs = PreparedInputs(sorted_inputs, is_subword=is_subword)
+        self.has_targets = (heads is not None) and (labels is not None)
+        if self.has_targets:
+            self.sorted_heads = [heads[i] for i in perm]
+            self.sorted_labels = [labels[i] for i in perm]
+            # heads are seq_len - 1 in length because they don't include ROOT
+            self.heads = transpose_seqs(self.sorted_heads)
+            self.labels = transpose_seqs(self.sorted_labels)
+        else:
+            self.sorted_heads, self.sorted_labels = None, None
+            self.heads, self.labels = None, None
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @property
+    def num_tokens(self):
+        """Number of tokens GraphParser normalises the loss of the batch by
+        (same as GraphParser.num_tokens after the forward pass)."""
+        return int(np.sum(self.inputs.col_lengths))
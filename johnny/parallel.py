@@ -0,0 +1,155 @@
+""" Data parallel training on the cpu using multiple processes """
+import ctypes
+import traceback
+import multiprocessing
+import numpy as np
+import chainer
+
+
+def _context():
+    # workers need to be forked - they get their model replica
+    # and the shared memory from the parent
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('fork')
+    return multiprocessing
+
+
+def _worker(conn, model, grads):
+    try:
+        while True:
+            msg = conn.recv()
+            if msg is None:
+                break
+            seed, batch = msg
+            # the parent seeds us for each batch, so dropout masks only
+            # depend on the parent's random state
+            np.random.seed(seed)
+            seqs = list(zip(*batch))
+            label_batch = seqs.pop()
+            head_batch = seqs.pop()
+            with chainer.using_config('train', True):
+                arc_preds, lbl_preds = model(*seqs, heads=head_batch,
+                                             labels=label_batch)
+                model.cleargrads()
+                model.loss.backward()
+            for (_, param), grad in zip(sorted(model.namedparams()), grads):
+                if param.grad is None:
+                    grad.fill(0.)
+                else:
+                    grad[...] = param.grad
+            conn.send((None, (float(model.loss.data), int(model.num_tokens),
+                              arc_preds, lbl_preds)))
+    except Exception:
+        conn.send((traceback.format_exc(), None))
+    finally:
+        conn.close()
+
+
+class DataParallel(object):
+    """Trains a model on several batches at once, one per worker process.
+
+    The parameters of the model are moved to shared memory, so that the
+    workers (forked with a replica of the model) always see the current
+    parameters. Each worker computes the gradients of its batch and writes
+    them to its own slot in shared memory. We then combine them and do a
+    single optimizer step in this process.
+
+    GraphParser normalises the loss by the number of tokens in the batch,
+    so we weight the gradients of each batch by its share of the tokens:
+    the step is the same as if the batches were concatenated in a single
+    large batch (apart from the order of floating point operations and
+    the dropout masks).
+
+    NOTE: cpu only. Each worker uses its own BLAS threads, so it may help
+    to limit them (eg: OMP_NUM_THREADS) when using many workers.
+    """
+
+    def __init__(self, model, optimizer, num_workers):
+        super(DataParallel, self).__init__()
+        assert(num_workers > 0)
+        self.model = model
+        self.optimizer = optimizer
+        self.num_workers = num_workers
+        self.params = [param for _, param in sorted(model.namedparams())]
+        for param in self.params:
+            if param.data is None:
+                raise ValueError('All parameters need to be initialised')
+            if not isinstance(param.data, np.ndarray):
+                raise ValueError('DataParallel only supports training on cpu')
+        sizes = [param.data.size for param in self.params]
+        self.offsets = np.cumsum([0] + sizes)
+        size = int(self.offsets[-1])
+
+        ctx = _context()
+        self._shared_params = ctx.RawArray(ctypes.c_float, size)
+        self._shared_grads = ctx.RawArray(ctypes.c_float, size * num_workers)
+        flat_params = np.frombuffer(self._shared_params, dtype=np.float32)
+        # num_workers x size
+        self.grads = np.frombuffer(self._shared_grads,
+                                   dtype=np.float32).reshape(num_workers, -1)
+        self.combined_grad = np.zeros(size, dtype=np.float32)
+        for param, (s, e) in zip(self.params, self._bounds()):
+            flat_params[s:e] = param.data.ravel()
+            # optimizers update parameters in place, so updates
+            # are visible to the workers
+            param.data = flat_params[s:e].reshape(param.data.shape)
+
+        self.conns, self.workers = [], []
+        for i in range(num_workers):
+            parent_conn, child_conn = ctx.Pipe()
+            worker_grads = [self.grads[i, s:e].reshape(param.data.shape)
+                            for param, (s, e) in zip(self.params,
+                                                     self._bounds())]
+            worker = ctx.Process(target=_worker,
+                                 args=(child_conn, model, worker_grads))
+            worker.daemon = True
+            worker.start()
+            child_conn.close()
+            self.conns.append(parent_conn)
+            self.workers.append(worker)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _bounds(self):
+        return zip(self.offsets[:-1].tolist(), self.offsets[1:].tolist())
+
+    def update(self, batches):
+        """Compute gradients of batches (a list of at most num_workers
+        batches of rows) in the workers and take an optimizer step.
+
+        returns: the loss of the combined batch and the (arc, label)
+        predictions of each batch.
+        """
+        assert(0 < len(batches) <= self.num_workers)
+        seeds = np.random.randint(2**31, size=len(batches))
+        for conn, seed, batch in zip(self.conns, seeds, batches):
+            conn.send((int(seed), batch))
+        results = []
+        for conn in self.conns[:len(batches)]:
+            error, result = conn.recv()
+            if error is not None:
+                raise RuntimeError('Worker failed:\n%s' % error)
+            results.append(result)
+        losses, num_tokens, arc_preds, lbl_preds = zip(*results)
+        weights = np.array(num_tokens, dtype=np.float32) / sum(num_tokens)
+        np.dot(weights, self.grads[:len(batches)], out=self.combined_grad)
+        for param, (s, e) in zip(self.params, self._bounds()):
+            param.grad = self.combined_grad[s:e].reshape(param.data.shape)
+        self.optimizer.update()
+        loss = float(np.dot(weights, losses))
+        return loss, list(zip(arc_preds, lbl_preds))
+
+    def close(self):
+        for conn in self.conns:
+            try:
+                conn.send(None)
+            except (IOError, OSError):
+                pass
+            conn.close()
+        for worker in self.workers:
+            worker.join()
+        self.conns, self.workers = [], []
@@ -0,0 +1,98 @@
+""" Parsing raw tokenized text with a trained model """
+import six
+import numpy as np
+from johnny.dep import Sentence, Token
+from johnny.bundle import is_bundle, load_bundle
+from johnny.vocab import is_vocab_file, load_vocabs
+from johnny.text_utils import process_texts, encode_texts
+
+
+def load_model_vocabs(path):
+    """Vocabs saved by train.py as a dict of name -> vocab - either in the
+    binary format or pickled (models trained before we switched)."""
+    if is_vocab_file(path):
+        return load_vocabs(path)
+    import dill
+    with open(path, 'rb') as pf:
+        return dict(dill.load(pf)._asdict())
+
+
+def to_sentence(words):
+    """A Sentence with tokens for words (and nothing else) - so that
+    parses of plain text can be written with ConlluWriter."""
+    empty = Token.EMPTY
+    return Sentence([Token(str(i), w, empty, empty, empty, empty,
+                           empty, empty, empty, empty)
+                     for i, w in enumerate(words, 1)])
+
+
+class Parser(object):
+    """Loads a trained model along with its vocabs once and parses batches
+    of tokenized sentences.
+
+    path: a model bundle folder (see johnny.bundle - fastest to load),
+    or the blueprint saved by train.py (or the path to it) - it knows
+    where the model and vocabs are.
+
+    batch_size: the number of sentences we parse at once (None means all
+    sentences passed to parse). Sentences are sorted by length before they
+    are split into batches, so that there is little padding.
+
+    treeify: if specified, overrides how the model postprocesses arcs
+    ('chu', 'eisner' or 'none').
+    """
+
+    def __init__(self, path, batch_size=256, treeify=None, gpu_id=-1):
+        super(Parser, self).__init__()
+        if isinstance(path, six.string_types) and is_bundle(path):
+            self.model, self.vocabs, config = load_bundle(path, treeify=treeify)
+        else:
+            self.model, self.vocabs, config = self._load_blueprint(path, treeify)
+        self.ngram = config['ngram']
+        self.subword = config['subword']
+        self.preprocess = dict(config['preprocess'])
+        self.batch_size = batch_size
+        self.rev_labels = self.vocabs['arcs'].rev_index
+        if gpu_id >= 0:
+            self.model.to_gpu(gpu_id)
+
+    @staticmethod
+    def _load_blueprint(blueprint, treeify=None):
+        import chainer
+        from mlconf import Blueprint
+        if not isinstance(blueprint, Blueprint):
+            blueprint = Blueprint.from_file(blueprint)
+        if treeify is not None:
+            blueprint.model.treeify = treeify
+        vocabs = load_model_vocabs(blueprint.vocab_path)
+        model = blueprint.build().model
+        chainer.serializers.load_npz(blueprint.model_path, model)
+        return model, vocabs, blueprint
+
+    def encode(self, sents):
+        """Preprocess sentences (lists of words) and map them to ids."""
+        text = process_texts(sents, self.ngram, self.subword, self.preprocess)
+        return encode_texts(text, self.vocabs['text'], self.subword)
+
+    def parse(self, sents):
+        """Parse sentences - a list of lists of words.
+
+        returns: a list with the heads (0 is root) and the labels of the
+        words of each sentence.
+        """
+        sents = [tuple(sent) for sent in sents]
+        parses = [([], []) for _ in sents]
+        # nothing to parse in empty sentences
+        to_parse = [i for i, sent in enumerate(sents) if sent]
+        if not to_parse:
+            return parses
+        ids = self.encode([sents[i] for i in to_parse])
+        order = np.argsort([-len(sent) for sent in ids], kind='mergesort')
+        batch_size = self.batch_size or len(order)
+        for start in range(0, len(order), batch_size):
+            indices = order[start:start + batch_size].tolist()
+            arc_preds, lbl_preds = self.model.predict([ids[i] for i in indices])
+            for i, arcs, lbls in zip(indices, arc_preds, lbl_preds):
+                labels = [self.rev_labels[l] for l in np.asarray(lbls).tolist()]
+                parses[to_parse[i]] = (np.asarray(arcs).tolist(), labels)
+        return parses
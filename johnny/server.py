@@ -0,0 +1,283 @@
+""" HTTP parsing service - concurrent requests are parsed in micro batches
+
+Run with:
+
+    python -m johnny.server --blueprint models/.../mytest.bp --port 8000
+
+POST /parse with {"sentences": [["the", "cat", "sat"], ...]} returns
+{"parses": [{"heads": [2, 3, 0], "labels": ["det", "nsubj", "root"]}, ...]}
+GET /stats returns latency percentiles and batch size histograms.
+"""
+import json
+import time
+import threading
+import six
+import numpy as np
+from collections import deque
+from six.moves import queue
+from six.moves.BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from six.moves.socketserver import ThreadingMixIn
+
+
+class _Request(object):
+
+    def __init__(self, sents):
+        self.sents = sents
+        self.num_tokens = sum(len(sent) for sent in sents)
+        self.start = time.time()
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class ServingStats(object):
+    """Latencies of the last window requests and histograms of the size
+    of the batches (in sentences and tokens) - bins are powers of 2."""
+
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self, window=10000):
+        super(ServingStats, self).__init__()
+        self.latencies = deque(maxlen=window)
+        self.num_requests = 0
+        self.num_batches = 0
+        self.num_sents = 0
+        self.num_tokens = 0
+        self.sent_hist = dict()
+        self.token_hist = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _bin(value):
+        """The smallest power of 2 that is >= value."""
+        return 1 << max(int(value) - 1, 0).bit_length()
+
+    def add_batch(self, requests, num_sents, num_tokens):
+        now = time.time()
+        with self._lock:
+            self.latencies.extend(now - r.start for r in requests)
+            self.num_requests += len(requests)
+            self.num_batches += 1
+            self.num_sents += num_sents
+            self.num_tokens += num_tokens
+            for hist, value in ((self.sent_hist, num_sents),
+                                (self.token_hist, num_tokens)):
+                b = self._bin(value)
+                hist[b] = hist.get(b, 0) + 1
+
+    def as_dict(self):
+        with self._lock:
+            latencies = np.array(self.latencies)
+            stats = {'requests': self.num_requests,
+                     'batches': self.num_batches,
+                     'sents': self.num_sents,
+                     'tokens': self.num_tokens,
+                     'batch_sents_hist': dict(('<=%d' % k, v) for k, v
+                                              in sorted(self.sent_hist.items())),
+                     'batch_tokens_hist': dict(('<=%d' % k, v) for k, v
+                                               in sorted(self.token_hist.items()))}
+        for p in self.PERCENTILES:
+            stats['latency_p%d' % p] = float(np.percentile(latencies, p)) \
+                if len(latencies) else 0.
+        stats['mean_batch_sents'] = self.num_sents / float(max(self.num_batches, 1))
+        return stats
+
+
+class MicroBatcher(object):
+    """Collects concurrent requests into batches for func.
+
+    func: called with a list of sentences, returns a list with a result
+    for each sentence (eg: johnny.parse.Parser.parse).
+
+    The first request waits at most max_wait seconds for others to join
+    it. A batch is closed early when adding the next request would take it
+    over max_tokens tokens - a single request larger than that gets a batch
+    of its own. func is only ever called from the batching thread.
+
+    If func fails on a batch, each of its requests is retried on its own,
+    so an error only reaches the request that caused it.
+    """
+
+    def __init__(self, func, max_wait=0.01, max_tokens=4096, stats=None):
+        super(MicroBatcher, self).__init__()
+        self.func = func
+        self.max_wait = max_wait
+        self.max_tokens = max_tokens
+        self.stats = stats or ServingStats()
+        self._queue = queue.Queue()
+        # requests that didn't fit in the previous batch
+        self._carried = deque()
+        self._thread = threading.Thread(target=self._consume)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __call__(self, sents, timeout=None):
+        """Parse sents (a list of sentences) - blocks until their batch
+        has been processed."""
+        if self._thread is None:
+            raise ValueError('MicroBatcher is closed')
+        request = _Request(list(sents))
+        self._queue.put(request)
+        if not request.done.wait(timeout):
+            raise RuntimeError('Timed out waiting for the batch')
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _next_batch(self):
+        first = self._carried.popleft() if self._carried else self._queue.get()
+        if first is None:
+            return None
+        batch, num_tokens = [first], first.num_tokens
+        deadline = first.start + self.max_wait
+        while num_tokens < self.max_tokens:
+            try:
+                request = self._queue.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                break
+            if request is None or num_tokens + request.num_tokens > self.max_tokens:
+                self._carried.append(request)
+                break
+            batch.append(request)
+            num_tokens += request.num_tokens
+        return batch
+
+    def _consume(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            sents = [sent for request in batch for sent in request.sents]
+            try:
+                results = self.func(sents)
+                start = 0
+                for request in batch:
+                    request.result = results[start:start + len(request.sents)]
+                    start += len(request.sents)
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0].error = e
+                else:
+                    for request in batch:
+                        self._process_alone(request)
+            self.stats.add_batch(batch, len(sents),
+                                 sum(r.num_tokens for r in batch))
+            for request in batch:
+                request.done.set()
+
+    def _process_alone(self, request):
+        try:
+            request.result = self.func(request.sents)
+        except Exception as e:
+            request.error = e
+
+    def close(self):
+        """Process requests already queued and stop the batching thread."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+
+class ParseHandler(BaseHTTPRequestHandler):
+
+    def _send_json(self, code, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._send_json(200, self.server.batcher.stats.as_dict())
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/parse':
+            self._send_json(404, {'error': 'not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            sents = request['sentences']
+            if not isinstance(sents, list) or \
+                    not all(isinstance(sent, list) for sent in sents):
+                raise ValueError('sentences should be lists of words')
+            # bad words would fail the whole micro batch they end up in
+            if not all(isinstance(word, six.string_types) and word
+                       for sent in sents for word in sent):
+                raise ValueError('words should be non empty strings')
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {'error': str(e)})
+            return
+        try:
+            parses = self.server.batcher(sents)
+        except Exception as e:
+            self._send_json(500, {'error': str(e)})
+            return
+        self._send_json(200, {'parses': [{'heads': heads, 'labels': labels}
+                                         for heads, labels in parses]})
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class ParseServer(ThreadingMixIn, HTTPServer):
+    """Serves parses of func (see MicroBatcher) over HTTP - each request
+    is handled in its own thread and waits for its micro batch."""
+
+    daemon_threads = True
+
+    def __init__(self, address, func, max_wait=0.01, max_tokens=4096,
+                 verbose=False):
+        HTTPServer.__init__(self, address, ParseHandler)
+        self.batcher = MicroBatcher(func, max_wait=max_wait,
+                                    max_tokens=max_tokens)
+        self.verbose = verbose
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.batcher.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    from johnny.parse import Parser
+
+    parser = argparse.ArgumentParser(description='Dependency parsing HTTP server')
+    parser.add_argument('--blueprint', required=True, type=str,
+                        help='Path to a model bundle folder (fastest to load) '
+                        'or to the .bp blueprint file produced by training.')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max_wait', type=float, default=0.01,
+                        help='Seconds a request waits for others to join its batch.')
+    parser.add_argument('--max_tokens', type=int, default=4096,
+                        help='Max tokens in a batch.')
+    parser.add_argument('--treeify', type=str, default='chu',
+                        help='algorithm to postprocess arcs with. '
+                        'Choose chu to allow for non projectivity, else eisner')
+    parser.add_argument('--gpu_id', type=int, default=-1,
+                        help='Which gpu device to use, -1 means cpu.')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Log each request.')
+
+    args = parser.parse_args()
+
+    # the batcher bounds the size of batches
+    dep_parser = Parser(args.blueprint, batch_size=None,
+                        treeify=args.treeify, gpu_id=args.gpu_id)
+    server = ParseServer((args.host, args.port), dep_parser.parse,
+                         max_wait=args.max_wait, max_tokens=args.max_tokens,
+                         verbose=args.verbose)
+    print('Serving on http://%s:%d' % server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
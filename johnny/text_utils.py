@@ -2,6 +2,7 @@
 import re
 import unicodedata
 from itertools import chain
+from johnny.vocab import seq_offsets, split_ids
 
 
 COLLAPSE_NUMS_RE = re.compile(r'\d*[\.,]?\d+')
@@ -75,6 +76,47 @@ def to_ngrams(iterable, n=1, pad='_'):
                      for i in range(len(iterable)-n+1))
 
 
+# preprocessing results of word types for each preprocessing configuration
+# we bound the number of types we remember per configuration
+CACHE_SIZE = 1000000
+_type_cache = dict()
+
+
+def clear_cache():
+    _type_cache.clear()
+
+
+def process_types(words, ngram=1, is_subword=False, preprocess_funcs=None):
+    """Preprocess each distinct word type once.
+
+    words: iterable of word types - duplicates are fine.
+
+    returns: dict mapping each word to its preprocessed form (or ngrams
+    of characters of the preprocessed form if is_subword).
+
+    Results are memoized keyed by the word and the configuration, so
+    words that were seen in earlier calls are not processed again.
+    """
+    if preprocess_funcs is None:
+        preprocess_funcs = dict()
+    config = (ngram, is_subword, tuple(sorted(preprocess_funcs.items())))
+    cache = _type_cache.setdefault(config, dict())
+    processed = dict()
+    for w in words:
+        if w in processed:
+            continue
+        try:
+            processed[w] = cache[w]
+        except KeyError:
+            p = preprocess(w, **preprocess_funcs)
+            if is_subword:
+                p = to_ngrams(p, n=ngram)
+            if len(cache) >= CACHE_SIZE:
+                cache.clear()
+            cache[w] = processed[w] = p
+    return processed
+
+
 def process_text(sent, ngram=1, is_subword=False, preprocess_funcs=None):
     """Preprocess text and create ngrams from an iterable of tokens.
 
@@ -82,15 +124,43 @@ def process_text(sent, ngram=1, is_subword=False, preprocess_funcs=None):
 
     returns: generator expression of ngrams of preprocessed sentence.
     """
-    if preprocess_funcs is None:
-        preprocess_funcs = dict()
+    return process_texts((sent,), ngram=ngram, is_subword=is_subword,
+                         preprocess_funcs=preprocess_funcs)[0]
+
+
+def process_texts(sents, ngram=1, is_subword=False, preprocess_funcs=None):
+    """Same as process_text but for a whole corpus of sentences.
+
+    Tokens follow a zipf distribution, so we preprocess (and split into
+    ngrams) each distinct word type once and then map the results back
+    to the token positions.
+    """
+    sents = tuple(sents)
+    types = process_types(chain.from_iterable(sents), ngram=ngram,
+                          is_subword=is_subword,
+                          preprocess_funcs=preprocess_funcs)
+    if is_subword:
+        return tuple(tuple(types[w] for w in sent) for sent in sents)
+    else:
+        return tuple(to_ngrams(tuple(types[w] for w in sent), n=ngram)
+                     for sent in sents)
+
+
+def encode_texts_flat(sents, vocab, is_subword=False):
+    """Encode a batch of sentences using a vocabulary, returning flat
+    arrays instead of tuples.
+
+    returns: (ids, offsets) where ids of sentence i are at
+    ids[offsets[i]:offsets[i+1]]. If is_subword, ids are the subword ids,
+    and we return (ids, word_offsets, offsets) - offsets index into the
+    words of word_offsets.
+    """
     if is_subword:
-        return tuple(to_ngrams(preprocess(w, **preprocess_funcs),
-                               n=ngram)
-                     for w in sent)
+        words = tuple(chain.from_iterable(sents))
+        ids, word_offsets = vocab.encode_batch(words)
+        return ids, word_offsets, seq_offsets(sents)
     else:
-        return tuple(to_ngrams(tuple(preprocess(w, **preprocess_funcs) for w in sent),
-                               n=ngram))
+        return vocab.encode_batch(sents)
 
 
 def encode_texts(sents, vocab, is_subword=False):
@@ -98,6 +168,9 @@ def encode_texts(sents, vocab, is_subword=False):
     This converts the strings to ids looked up in the vocab
     dictionary."""
     if is_subword:
-        return tuple(tuple(map(vocab.encode, s)) for s in sents)
+        ids, word_offsets, offsets = encode_texts_flat(sents, vocab, is_subword)
+        words = split_ids(ids, word_offsets)
+        offsets = offsets.tolist()
+        return tuple(words[s:e] for s, e in zip(offsets[:-1], offsets[1:]))
     else:
-        return tuple(map(vocab.encode, sents))
+        return split_ids(*encode_texts_flat(sents, vocab, is_subword))
@@ -1,7 +1,11 @@
 import six
+import json
+import zlib
+import heapq
 import pickle
-from itertools import chain
-from collections import Counter, namedtuple
+import numpy as np
+from itertools import chain, repeat, islice
+from collections import Counter, OrderedDict, namedtuple
 
 
 # We reserve these indexes in all vocabs we create
@@ -43,6 +47,64 @@ def augment_word(seq):
             (reserved.END_WORD,)))
 
 
+def seq_offsets(seqs):
+    """Offsets of each sequence in the concatenation of seqs - the
+    tokens of seqs[i] are at [offsets[i]:offsets[i+1]]."""
+    offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs)),
+              out=offsets[1:])
+    return offsets
+
+
+def split_ids(ids, offsets):
+    """Inverse of concatenating: split a flat array of ids back to a tuple
+    of tuples using offsets."""
+    ids = ids.tolist()
+    offsets = offsets.tolist()
+    return tuple(tuple(ids[s:e]) for s, e in zip(offsets[:-1], offsets[1:]))
+
+
+def _lookup(get, seqs, offsets, *default):
+    """Map each token in seqs to an id using get - we let numpy drive
+    the loop instead of building a tuple."""
+    flat = chain.from_iterable(seqs)
+    if default:
+        ids = map(get, flat, repeat(default[0]))
+    else:
+        ids = map(get, flat)
+    return np.fromiter(ids, dtype=np.int32, count=int(offsets[-1]))
+
+
+def char_table(index, unk):
+    """If all tokens in index are characters, return an int32 array
+    mapping unicode codepoints to ids, else None. The last entry of the
+    array is unk, for all codepoints larger than the ones we know."""
+    if not all(isinstance(k, six.string_types) and len(k) == 1
+               for k in index):
+        return None
+    max_cp = max([ord(k) for k in index] or [0])
+    table = np.full(max_cp + 2, unk, dtype=np.int32)
+    for key, val in six.iteritems(index):
+        table[ord(key)] = val
+    return table
+
+
+def _lookup_chars(table, seqs, offsets):
+    """Encode all the text at once and index the table using the
+    codepoints. Returns None if we can't - eg: if tokens aren't characters,
+    in which case they need to be looked up one by one."""
+    if table is None or not len(seqs):
+        return None
+    try:
+        text = six.text_type('').join(chain.from_iterable(seqs))
+    except TypeError:
+        return None
+    if len(text) != offsets[-1]:
+        return None
+    cps = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+    return table[np.minimum(cps, len(table) - 1)]
+
+
 class Vocab(object):
     """The tokens we know. Class defines a way to create the vocabulary
     and assign each known token to an index. All other tokens are replaced
@@ -62,14 +124,26 @@ class Vocab(object):
     special.update(UNK=len(special))
     reserved = namedtuple('Reserved', special.keys())(**special)
 
-    def __init__(self, size=None, out_size=None, counts=None, threshold=0):
+    def __init__(self, size=None, out_size=None, counts=None, threshold=0,
+                 sketch_size=None):
         """
             size: int - the number of tokens we can represent.
             We always represent UNK, START and END but we don't count
             them in len. Use out_size attribute for that.
 
+            counts: Counter - counts to start from (see partial_fit).
+
             threshold: int - we throw away tokens with up to and including
             this many counts.
+
+            sketch_size: int - if set, we count with a Misra-Gries summary
+            of sketch_size counters (we prune when we have twice as many).
+            Memory is bounded and counts become underestimates by at most
+            count_error, which is at most the number of tokens seen divided
+            by sketch_size + 1. Any token seen more than count_error times
+            is kept, so with sketch_size a few times size the top size
+            tokens of zipfian data are exact up to that error. The threshold
+            is applied to the (under)estimated counts.
         """
         super(Vocab, self).__init__()
         if size is None:
@@ -83,7 +157,12 @@ class Vocab(object):
         else:
             raise ValueError("Can't set both size and out_size")
         self.threshold = threshold
+        self.sketch_size = sketch_size
+        self.counts = Counter(counts) if counts else Counter()
+        # the most any count may be below the true count (see sketch_size)
+        self.count_error = 0
         self.index = None
+        self._char_table = None
 
     def __repr__(self):
         return ('Vocab object\ncapacity: %d\nactual size: %d\nthreshold: %d'
@@ -99,38 +178,109 @@ class Vocab(object):
         # we sort because in python 3 most_common is not guaranteed
         # to return the same order for elements with same count
         # when the code runs again. #fun_debugging
-        candidates = sorted(self.counts.most_common(),
-                            key=lambda x: (x[1], x[0]), reverse=True)
+        # nlargest is equivalent to sorting and keeping the first limit
+        # entries, but we don't need to sort the whole long tail.
         limit = self.size
+        keep = heapq.nlargest(limit, six.iteritems(self.counts),
+                              key=lambda x: (x[1], x[0]))
         offset = len(self.reserved)
         # we leave reserved indices to represent the UNK and the rest
-        keep = candidates[:limit]
         if keep:
             keys, _ = zip(*keep)
             self.index = dict(zip(keys, range(offset, len(keys)+offset)))
         else:
             self.index = dict()
+        self._char_table = None
 
     def _threshold_counts(self):
-        remove = []
-        for key, c in six.iteritems(self.counts):
-            if c <= self.threshold:
-                remove.append(key)
-        for key in remove:
-            self.counts.pop(key)
-
-    def fit(self, tokens):
+        self.counts = Counter(dict((key, c)
+                                   for key, c in six.iteritems(self.counts)
+                                   if c > self.threshold))
+
+    def _prune_counts(self):
+        sketch_size = getattr(self, 'sketch_size', None)
+        if sketch_size is None or len(self.counts) <= 2 * sketch_size:
+            return
+        # misra gries (in batch): take the count of the (sketch_size + 1)th
+        # most frequent token off all counts and drop those left with none.
+        # each count is at most count_error below the true count.
+        cut = heapq.nlargest(sketch_size + 1, six.itervalues(self.counts))[-1]
+        self.counts = Counter(dict((key, c - cut)
+                                   for key, c in six.iteritems(self.counts)
+                                   if c > cut))
+        self.count_error = getattr(self, 'count_error', 0) + cut
+
+    def fit(self, tokens, chunk_size=1000000):
         """Populate the vocabulary using the tokens as input.
         Tokens are expected to be a iterable of tokens."""
-        self.counts = Counter(tokens)
+        self.counts = Counter()
+        self.count_error = 0
+        return self.partial_fit(tokens, chunk_size=chunk_size).finalize()
+
+    def partial_fit(self, tokens, chunk_size=1000000):
+        """Update the counts with the tokens without building the index.
+
+        tokens: iterable of tokens - it is consumed in chunks of chunk_size
+        tokens, so it can be a generator over a corpus that doesn't fit in
+        memory. Call finalize when done counting.
+        """
+        tokens = iter(tokens)
+        while True:
+            chunk = tuple(islice(tokens, chunk_size))
+            if not chunk:
+                break
+            self.counts.update(chunk)
+            self._prune_counts()
+        return self
+
+    def merge(self, other):
+        """Add counts from another vocab (or Counter), eg: one that was
+        partially fit by a different worker on a different part of the
+        data. Call finalize when done merging."""
+        if isinstance(other, Vocab):
+            counts = other.counts
+            # errors of merged summaries add up
+            self.count_error = (getattr(self, 'count_error', 0) +
+                                getattr(other, 'count_error', 0))
+        else:
+            counts = other
+        self.counts.update(counts)
+        self._prune_counts()
+        return self
+
+    def finalize(self):
+        """Apply the threshold to the counts and build the index."""
         self._threshold_counts()
         self._build_index()
         return self
 
+    @property
+    def char_table(self):
+        """If all tokens in the vocabulary are characters we can lookup
+        ids in an array indexed by unicode codepoint (see char_table)."""
+        if getattr(self, '_char_table', None) is None:
+            self._char_table = char_table(self.index, self.reserved.UNK)
+        return self._char_table
+
     def encode(self, tokens):
         """tokens: iterable of tokens to get indices for.
         Returns list of indices.  """
-        return tuple(self.index.get(token, self.reserved.UNK) for token in tokens)
+        ids, _ = self.encode_batch((tuple(tokens),))
+        return tuple(ids.tolist())
+
+    def encode_batch(self, seqs):
+        """Encode a batch (or a whole corpus) of token sequences at once.
+
+        seqs: sequence of sequences of tokens.
+
+        Returns a flat int32 array of ids and the offsets of each sequence
+        in it (see seq_offsets). Unknown tokens are mapped to UNK.
+        """
+        offsets = seq_offsets(seqs)
+        ids = _lookup_chars(self.char_table, seqs, offsets)
+        if ids is None:
+            ids = _lookup(self.index.get, seqs, offsets, self.reserved.UNK)
+        return ids, offsets
 
     def save(self, filepath):
         with open(filepath, 'wb') as f:
@@ -191,6 +341,13 @@ class UPOSVocab(object):
         """tags : iterable of tags """
         return tuple(self.index[tag] for tag in tags)
 
+    def encode_batch(self, seqs):
+        """seqs : sequence of sequences of tags. Returns flat int32 array
+        of ids and offsets of each sequence. Raises KeyError if a tag is
+        unknown."""
+        offsets = seq_offsets(seqs)
+        return _lookup(self.index.__getitem__, seqs, offsets), offsets
+
 
 class UDepVocab(object):
     """ Universal dependency relations label vocabulary.
@@ -263,6 +420,13 @@ class UDepVocab(object):
         """tags : iterable of tags """
         return tuple(self.index[tag] for tag in tags)
 
+    def encode_batch(self, seqs):
+        """seqs : sequence of sequences of tags. Returns flat int32 array
+        of ids and offsets of each sequence. Raises KeyError if a tag is
+        unknown."""
+        offsets = seq_offsets(seqs)
+        return _lookup(self.index.__getitem__, seqs, offsets), offsets
+
 
 class AbstractVocab(object):
     """Used when we don't know what labels to expect"""
@@ -297,6 +461,11 @@ class AbstractVocab(object):
             l.append(self.index[tag])
         return tuple(l)
 
+    def encode_batch(self, seqs):
+        offsets = seq_offsets(seqs)
+        ids = np.array(self.encode(chain.from_iterable(seqs)), dtype=np.int32)
+        return ids, offsets
+
     def save(self, filepath):
         with open(filepath, 'wb') as f:
             pickle.dump(self, f)
@@ -307,3 +476,245 @@ class AbstractVocab(object):
             v = pickle.load(f)
             v.mutable = False
             return v
+
+
+# Binary vocabulary format. We store several vocabs in one file:
+# MAGIC, uint64 length of the json header, the header and then 8 byte
+# aligned arrays. For each vocab we store the tokens sorted and utf-8
+# encoded in one byte string with their offsets, the id of each token,
+# a hash table (open addressing) mapping token hashes to positions in the
+# sorted table and optionally the counts.
+VOCAB_MAGIC = b'JVOCAB01'
+TUPLE_SEP = u'\x00'
+
+
+def _token_key(token, tuple_tokens):
+    if tuple_tokens:
+        token = TUPLE_SEP.join(token)
+    return token.encode('utf-8')
+
+
+def _token_hash(key):
+    return zlib.crc32(key) & 0xffffffff
+
+
+def is_vocab_file(path):
+    with open(path, 'rb') as f:
+        return f.read(len(VOCAB_MAGIC)) == VOCAB_MAGIC
+
+
+def save_vocabs(path, vocabs, with_counts=False):
+    """Write vocabs to path in the binary vocab format.
+
+    vocabs: dict or OrderedDict of name -> vocab (Vocab, UDepVocab,
+    UPOSVocab or AbstractVocab).
+
+    with_counts: whether to also store the counts of the tokens of the
+    vocabs that have them.
+    """
+    header = dict(order=list(vocabs), tables=dict())
+    arrays = []
+    position = 0
+    for name, vocab in vocabs.items():
+        keys = list(vocab.index)
+        tuple_tokens = bool(keys) and isinstance(keys[0], tuple)
+        if not all(isinstance(k, tuple if tuple_tokens else six.string_types)
+                   for k in keys):
+            raise ValueError('Can only save vocabs of strings or '
+                             'tuples of strings')
+        encoded = sorted((_token_key(k, tuple_tokens), k) for k in keys)
+        strings = b''.join(e for e, _ in encoded)
+        offsets = seq_offsets([e for e, _ in encoded])
+        ids = np.array([vocab.index[k] for _, k in encoded], dtype=np.int32)
+        # at most half full so that probing stays short
+        num_slots = 1
+        while num_slots < 2 * len(encoded) + 1:
+            num_slots *= 2
+        slots = np.full(num_slots, -1, dtype=np.int32)
+        for i, (e, _) in enumerate(encoded):
+            slot = _token_hash(e) & (num_slots - 1)
+            while slots[slot] >= 0:
+                slot = (slot + 1) & (num_slots - 1)
+            slots[slot] = i
+        table_arrays = [('strings', np.frombuffer(strings, dtype=np.uint8)),
+                        ('offsets', offsets),
+                        ('ids', ids),
+                        ('slots', slots)]
+        counts = getattr(vocab, 'counts', None)
+        if with_counts and counts is not None:
+            table_arrays.append(('counts', np.array([counts.get(k, 0)
+                                                     for _, k in encoded],
+                                                    dtype=np.int64)))
+        unk = getattr(getattr(vocab, 'reserved', None), 'UNK', None)
+        if not isinstance(vocab, Vocab):
+            unk = None
+        meta = dict(kind=vocab.__class__.__name__,
+                    length=len(vocab),
+                    unk=unk,
+                    tuple_tokens=tuple_tokens,
+                    arrays=dict())
+        for key in ('size', 'out_size', 'threshold'):
+            if hasattr(vocab, key):
+                meta[key] = getattr(vocab, key)
+        for arr_name, arr in table_arrays:
+            meta['arrays'][arr_name] = (arr.dtype.str, position, len(arr))
+            arrays.append(arr)
+            position += arr.nbytes
+            position += (-position) % 8
+        header['tables'][name] = meta
+    header_bytes = json.dumps(header).encode('utf-8')
+    # start of the arrays is aligned too
+    start = len(VOCAB_MAGIC) + 8 + len(header_bytes)
+    header_bytes += b' ' * ((-start) % 8)
+    with open(path, 'wb') as f:
+        f.write(VOCAB_MAGIC)
+        f.write(np.array([len(header_bytes)], dtype='<u8').tobytes())
+        f.write(header_bytes)
+        for arr in arrays:
+            f.write(arr.tobytes())
+            f.write(b'\0' * ((-arr.nbytes) % 8))
+
+
+def load_vocabs(path):
+    """Load vocabs saved with save_vocabs. The file is memory mapped, so
+    loading is cheap and processes on the same host share the pages.
+
+    returns: OrderedDict of name -> VocabTable
+    """
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    if data[:len(VOCAB_MAGIC)].tobytes() != VOCAB_MAGIC:
+        raise ValueError('%s is not a vocab file' % path)
+    header_start = len(VOCAB_MAGIC) + 8
+    header_len = int(data[len(VOCAB_MAGIC):header_start].view('<u8')[0])
+    header = json.loads(data[header_start:header_start + header_len]
+                        .tobytes().decode('utf-8'))
+    start = header_start + header_len
+    vocabs = OrderedDict()
+    for name in header['order']:
+        meta = header['tables'][name]
+        arrays = dict()
+        for arr_name, (dtype, offset, count) in meta['arrays'].items():
+            arrays[arr_name] = np.frombuffer(data, dtype=dtype, count=count,
+                                             offset=start + offset)
+        vocabs[name] = VocabTable(meta, arrays)
+    return vocabs
+
+
+class VocabTable(object):
+    """Read only vocabulary backed by arrays (see load_vocabs).
+
+    Lookups probe the hash table in the arrays, so we don't need to
+    build a python dict when loading. index, rev_index and char_table are
+    only built if someone asks for them.
+    """
+
+    def __init__(self, meta, arrays):
+        super(VocabTable, self).__init__()
+        self.meta = meta
+        self.kind = meta['kind']
+        self.unk = meta['unk']
+        self.tuple_tokens = meta['tuple_tokens']
+        self.strings = arrays['strings']
+        self.offsets = arrays['offsets']
+        self.ids = arrays['ids']
+        self.slots = arrays['slots']
+        self.counts = arrays.get('counts', None)
+        self._mask = len(self.slots) - 1
+        self._index = None
+        self._rev_index = None
+        self._char_table = None
+        for key in ('size', 'out_size', 'threshold'):
+            if key in meta:
+                setattr(self, key, meta[key])
+
+    def __repr__(self):
+        return ('VocabTable object (%s)\nnum tokens: %d'
+                % (self.kind, len(self.ids)))
+
+    def __len__(self):
+        return self.meta['length']
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def _position(self, token):
+        """Position of token in the sorted table or -1."""
+        try:
+            key = _token_key(token, self.tuple_tokens)
+        except (TypeError, AttributeError):
+            return -1
+        slot = _token_hash(key) & self._mask
+        while True:
+            i = int(self.slots[slot])
+            if i < 0:
+                return -1
+            s, e = self.offsets[i], self.offsets[i + 1]
+            if self.strings[s:e].tobytes() == key:
+                return i
+            slot = (slot + 1) & self._mask
+
+    def get(self, token, default=None):
+        i = self._position(token)
+        return int(self.ids[i]) if i >= 0 else default
+
+    def count(self, token):
+        if self.counts is None:
+            raise ValueError('Vocab was saved without counts')
+        i = self._position(token)
+        return int(self.counts[i]) if i >= 0 else 0
+
+    def tokens(self):
+        """Tokens in sorted order of their utf-8 encoding."""
+        strings = self.strings.tobytes()
+        offsets = self.offsets.tolist()
+        tokens = [strings[s:e].decode('utf-8')
+                  for s, e in zip(offsets[:-1], offsets[1:])]
+        if self.tuple_tokens:
+            tokens = [tuple(t.split(TUPLE_SEP)) for t in tokens]
+        return tokens
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = dict(zip(self.tokens(), self.ids.tolist()))
+        return self._index
+
+    @property
+    def rev_index(self):
+        if self._rev_index is None:
+            self._rev_index = dict((v, k) for k, v in self.index.items())
+        return self._rev_index
+
+    @property
+    def char_table(self):
+        if self._char_table is None and self.unk is not None:
+            self._char_table = char_table(self.index, self.unk)
+        return self._char_table
+
+    def _lookup_unique(self, seqs):
+        """Probe the hash table once per distinct token in seqs.
+        returns: dict of token -> id"""
+        found = dict()
+        for token in chain.from_iterable(seqs):
+            if token not in found:
+                found[token] = self.get(token, self.unk)
+                if found[token] is None:
+                    raise KeyError(token)
+        return found
+
+    def encode(self, tokens):
+        ids, _ = self.encode_batch((tuple(tokens),))
+        return tuple(ids.tolist())
+
+    def encode_batch(self, seqs):
+        """Same as Vocab.encode_batch. If the vocab has no UNK, unknown
+        tokens raise a KeyError."""
+        offsets = seq_offsets(seqs)
+        ids = _lookup(self._lookup_unique(seqs).__getitem__, seqs, offsets)
+        return ids, offsets
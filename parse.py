@@ -0,0 +1,65 @@
+import io
+import sys
+from itertools import islice
+from mlconf import ArgumentParser
+from johnny.dep import UDepLoader, ConlluWriter
+from johnny.parse import Parser, to_sentence
+
+
+def read_sentences(inp, fmt):
+    """Sentences from inp - one per line with words separated by spaces
+    if fmt is text, else CoNLL-U blocks."""
+    if fmt == 'conllu':
+        for sent in UDepLoader.iter_conllu_sents(inp):
+            yield sent
+    else:
+        for line in inp:
+            yield to_sentence(line.split())
+
+
+def parse_stream(parser, inp, out, fmt='text', batch_size=256):
+    """Parse sentences read from inp and write them to out as CoNLL-U.
+    We read batch_size sentences at a time, so output for a batch is
+    written (and flushed) as soon as it is parsed."""
+    sents = read_sentences(inp, fmt)
+    with ConlluWriter(out) as writer:
+        while True:
+            batch = list(islice(sents, batch_size))
+            if not batch:
+                break
+            parses = parser.parse([sent.words for sent in batch])
+            for sent, (heads, labels) in zip(batch, parses):
+                writer.write(sent, heads=heads, labels=labels)
+            writer.flush()
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser(description='Dependency parser - reads sentences '
+                            'from stdin and writes their parses to stdout '
+                            'in CoNLL-U format')
+    parser.add_argument('--blueprint', required=True, type=str,
+                        help='Path to a model bundle folder (fastest to load) '
+                        'or to the .bp blueprint file produced by training.')
+    parser.add_argument('--format', type=str, default='text',
+                        choices=('text', 'conllu'),
+                        help='text: one tokenized sentence per line, words '
+                        'separated by spaces. conllu: CoNLL-U sentences, '
+                        'heads and labels are replaced by the predictions.')
+    parser.add_argument('--batch_size', type=int, default=256,
+                        help='How many sentences to parse at once.')
+    parser.add_argument('--treeify', type=str, default='chu',
+                        help='algorithm to postprocess arcs with. '
+                        'Choose chu to allow for non projectivity, else eisner')
+    parser.add_argument('--gpu_id', type=int, default=-1,
+                        help='Which gpu device to use, -1 means cpu.')
+
+    args = parser.parse_args()
+
+    dep_parser = Parser(args.blueprint, batch_size=args.batch_size,
+                        treeify=args.treeify, gpu_id=args.gpu_id)
+
+    inp = io.open(sys.stdin.fileno(), 'r', encoding='utf-8', closefd=False)
+    out = io.open(sys.stdout.fileno(), 'w', encoding='utf-8', closefd=False)
+    parse_stream(dep_parser, inp, out, fmt=args.format,
+                 batch_size=args.batch_size)
@@ -1,20 +1,19 @@
 import chainer
-import dill
 from tqdm import tqdm
-from johnny.dep import UDepLoader
-from johnny.metrics import Average, UAS, LAS
+from johnny.dep import UDepLoader, ConlluWriter
+from johnny.metrics import UAS, LAS, add_batch_preds
 from johnny.misc import visualise_dict
-from train import dataset_to_cols, data_to_rows, to_batches
+from johnny.parse import load_model_vocabs
+from train import dataset_to_cols, data_to_rows, to_batches, vocab_tup
 from mlconf import ArgumentParser, Blueprint
 
 
-def test_loop(bp, test_set):
+def test_loop(bp, test_set, conll_out=None):
 
     model_path = bp.model_path
     vocab_path = bp.vocab_path
 
-    with open(vocab_path, 'rb') as pf:
-        vocabs = dill.load(pf)
+    vocabs = vocab_tup(**load_model_vocabs(vocab_path))
 
     visualise_dict(vocabs.text.index, num_items=20)
     visualise_dict(vocabs.arcs.index, num_items=20)
@@ -39,51 +38,64 @@ def test_loop(bp, test_set):
     model = built_bp.model
     chainer.serializers.load_npz(model_path, model)
 
+    # predictions are streamed to conll_out from a background thread
+    # while we parse the next batch
+    writer = None
+    if conll_out is not None:
+        writer = ConlluWriter(conll_out, rev_labels=vocabs.arcs.rev_index,
+                              background=True)
+
     # test
-    tf_str = ('Eval - test : batch_size={0:d}, mean loss={1:.2f}, '
-              'mean UAS={2:.3f} mean LAS={3:.3f}')
-    with tqdm(total=len(test_set)) as pbar, \
-        chainer.using_config('train', False), \
-        chainer.no_backprop_mode():
-
-        mean_loss = Average()
-        u_scorer = UAS()
-        l_scorer = LAS()
-        index = 0
-        # NOTE: IMPORTANT!!
-        # BATCH SIZE is important here to reproduce the results
-        # for the cnn - since changing the batch size changes
-        # has the effect of different words having different padding.
-        # NOTE: test_mean_loss changes because it is averaged
-        # across batches, so changing the number of batches affects it
-        BATCH_SIZE = 256
-        for batch in to_batches(test_rows, BATCH_SIZE, sort=False):
-            batch_size = 0
-            seqs = list(zip(*batch))
-            label_batch = seqs.pop()
-            head_batch = seqs.pop()
-            arc_preds, lbl_preds = model(*seqs, heads=head_batch, labels=label_batch)
-            loss = model.loss
-            loss_value = float(loss.data)
-
-            for p_arcs, p_lbls, t_arcs, t_lbls in zip(arc_preds, lbl_preds, head_batch, label_batch):
-                u_scorer(arcs=(p_arcs, t_arcs))
-                l_scorer(arcs=(p_arcs, t_arcs), labels=(p_lbls, t_lbls))
-                test_set[index].set_heads(p_arcs)
-                str_labels = (vocabs.arcs.rev_index[l] for l in p_lbls)
-                test_set[index].set_labels(str_labels)
-                index += 1
-                batch_size += 1
-            mean_loss(loss_value)
-            out_str = tf_str.format(batch_size, mean_loss.score, u_scorer.score, l_scorer.score)
-            pbar.set_description(out_str)
-            pbar.update(batch_size)
+    tf_str = ('Eval - test : batch_size={0:d}, '
+              'mean UAS={1:.3f} mean LAS={2:.3f}')
+    try:
+        with tqdm(total=len(test_set)) as pbar:
+
+            u_scorer = UAS()
+            l_scorer = LAS()
+            index = 0
+            # NOTE: IMPORTANT!!
+            # BATCH SIZE is important here to reproduce the results
+            # for the cnn - since changing the batch size changes
+            # has the effect of different words having different padding.
+            BATCH_SIZE = 256
+            for batch in to_batches(test_rows, BATCH_SIZE, sort=False):
+                seqs = list(zip(*batch))
+                label_batch = seqs.pop()
+                head_batch = seqs.pop()
+                # gold heads and labels are only used for scoring
+                arc_preds, lbl_preds = model.predict(*seqs)
+
+                add_batch_preds(u_scorer, l_scorer, arc_preds, lbl_preds,
+                                head_batch, label_batch)
+                if writer is not None:
+                    for i, (sent_arcs, sent_lbls) in enumerate(zip(arc_preds, lbl_preds)):
+                        writer.write(test_set[index + i], heads=sent_arcs, labels=sent_lbls)
+                batch_size = len(batch)
+                index += batch_size
+                out_str = tf_str.format(batch_size, u_scorer.score, l_scorer.score)
+                pbar.set_description(out_str)
+                pbar.update(batch_size)
+    finally:
+        # writes out whatever is still buffered, even if we failed
+        if writer is not None:
+            writer.close()
     # make sure you aren't a dodo
     assert(index == len(test_set))
 
-    stats = {'test_mean_loss': mean_loss.score,
-             'test_uas': u_scorer.score,
-             'test_las': l_scorer.score}
+    stats = {'test_uas': u_scorer.score,
+             'test_las': l_scorer.score,
+             'test_uas_by_length': u_scorer.length_scores,
+             'test_las_by_length': l_scorer.length_scores}
+
+    rev_labels = vocabs.arcs.rev_index
+    label_scores = dict()
+    for i, (p, r) in enumerate(zip(l_scorer.precision, l_scorer.recall)):
+        if l_scorer.label_true[i] or l_scorer.label_pred[i]:
+            label_scores[rev_labels.get(i, i)] = {'precision': float(p),
+                                                  'recall': float(r),
+                                                  'support': int(l_scorer.label_true[i])}
+    stats['test_label_scores'] = label_scores
 
     # TODO: save these
     bp.test_results = stats
@@ -115,7 +127,8 @@ if __name__ == "__main__":
     test_data = UDepLoader.load_conllu(args.test_file)
     test_data.lang = blueprint.dataset.lang
 
-    test_loop(blueprint, test_data)
-
+    conll_out = None
     if CONLL_OUT:
-        test_data.save(blueprint.model_path.replace('.model', '.conllu'))
+        conll_out = blueprint.model_path.replace('.model', '.conllu')
+
+    test_loop(blueprint, test_data, conll_out=conll_out)
@@ -0,0 +1,97 @@
+import pytest
+import chainer
+import numpy as np
+from johnny.models import GraphParser
+from johnny.components import Embedder, SentenceEncoder
+from johnny.misc import BucketManager
+from johnny.checkpoint import save_training_state, load_training_state, AsyncCheckpointer
+
+
+def _setup(rows):
+    np.random.seed(13)
+    embed = Embedder((20,), (8,), dropout=0.2)
+    encoder = SentenceEncoder(embed, num_units=8, dropout=0.2)
+    model = GraphParser(encoder, mlp_arc_units=8, mlp_lbl_units=8,
+                        num_labels=5, treeify='none')
+    opt = chainer.optimizers.Adam(alpha=0.01)
+    opt.setup(model)
+    buckets = BucketManager(rows, 2, 8, batch_size=4, right_leak=1,
+                            row_key=lambda x: len(x[0]), loop_forever=True)
+    return model, opt, buckets
+
+
+def _train(model, opt, buckets, num_steps):
+    with chainer.using_config('train', True):
+        for _ in range(num_steps):
+            words, heads, labels = zip(*next(buckets))
+            model(words, heads=heads, labels=labels)
+            model.cleargrads()
+            model.loss.backward()
+            opt.update()
+
+
+def _rows():
+    rs = np.random.RandomState(0)
+    rows = []
+    for _ in range(30):
+        l = rs.randint(1, 9)
+        rows.append((tuple(rs.randint(1, 20, l)),
+                     tuple(rs.randint(0, l + 1, l)),
+                     tuple(rs.randint(0, 5, l))))
+    return rows
+
+
+def test_resume_is_exact(tmpdir):
+    path = str(tmpdir.join('state.npz'))
+    rows = _rows()
+    model, opt, buckets = _setup(rows)
+    _train(model, opt, buckets, 5)
+    save_training_state(path, model, opt, buckets, dict(patience=3))
+    # goes over an epoch boundary
+    _train(model, opt, buckets, 10)
+    expected = dict((k, np.copy(p.data)) for k, p in model.namedparams())
+
+    # different seed - everything should come from the state
+    np.random.seed(1)
+    model2, opt2, buckets2 = _setup(rows)
+    counters = load_training_state(path, model2, opt2, buckets2)
+    assert(counters == dict(patience=3))
+    assert(opt2.t == 5)
+    _train(model2, opt2, buckets2, 10)
+    for k, p in model2.namedparams():
+        assert(np.array_equal(p.data, expected[k]))
+
+
+def test_async_checkpointer(tmpdir):
+    path = str(tmpdir.join('model.npz'))
+    model, _, _ = _setup(_rows())
+    expected = []
+    with AsyncCheckpointer(keep=3, name='model') as saver:
+        assert(saver.stats()['model_writes'] == 0)
+        # no thread until we have something to write
+        assert(saver._thread is None)
+        for i in range(4):
+            saver.save_model(path, model)
+            expected.append(np.copy(model.vT.W.data))
+            # we snapshot, so this doesn't change what is written
+            model.vT.W.data += 1.
+        saver.flush()
+        stats = saver.stats()
+    assert(stats['model_writes'] == 4)
+    assert(stats['model_write_bytes'] == tmpdir.join('model.npz').size())
+    assert(sorted(f.basename for f in tmpdir.listdir()) ==
+           ['model.npz', 'model.npz.1', 'model.npz.2'])
+    for suffix, W in zip(('.2', '.1', ''), expected[1:]):
+        loaded, _, _ = _setup(_rows())
+        chainer.serializers.load_npz(path + suffix, loaded)
+        assert(np.array_equal(loaded.vT.W.data, W))
+
+
+def test_async_checkpointer_error(tmpdir):
+    saver = AsyncCheckpointer()
+    saver.save(str(tmpdir.join('missing', 'x.npz')), dict(a=np.zeros(3)))
+    with pytest.raises(OSError):
+        saver.flush()
+    saver.close()
+    with pytest.raises(ValueError):
+        saver.save(str(tmpdir.join('x.npz')), dict(a=np.zeros(3)))
@@ -0,0 +1,44 @@
+from johnny.corpus import MemmapCorpus
+from johnny.misc import BucketManager
+
+
+WORD_ROWS = (((5, 6, 7), (2, 0, 2), (1, 3, 4)),
+             ((8,), (0,), (2,)),
+             ((9, 10), (0, 1), (4, 4)))
+
+CHAR_ROWS = ((((5, 6), (7,), (8, 9, 10)), (2, 0, 2), (1, 3, 4)),
+             (((11,),), (0,), (2,)),
+             (((12, 13), (14, 15, 16, 17)), (0, 1), (4, 4)))
+
+
+def test_word_rows(tmpdir):
+    assert(not MemmapCorpus.exists(str(tmpdir.join('corpus'))))
+    c = MemmapCorpus.build(str(tmpdir.join('corpus')), iter(WORD_ROWS),
+                           chunk_size=2)
+    assert(MemmapCorpus.exists(c.path))
+    assert(len(c) == 3)
+    assert(tuple(c) == WORD_ROWS)
+    assert(c.lengths.tolist() == [3, 1, 2])
+    assert(c[-1] == WORD_ROWS[-1])
+    # reopening gives the same rows
+    assert(tuple(MemmapCorpus(c.path)) == WORD_ROWS)
+
+
+def test_subword_rows(tmpdir):
+    c = MemmapCorpus.build(str(tmpdir.join('corpus')), CHAR_ROWS,
+                           subword=True)
+    assert(tuple(c) == CHAR_ROWS)
+
+
+def test_empty(tmpdir):
+    c = MemmapCorpus.build(str(tmpdir.join('corpus')), [])
+    assert(len(c) == 0)
+    assert(tuple(c) == ())
+
+
+def test_bucket_manager_uses_lengths(tmpdir):
+    c = MemmapCorpus.build(str(tmpdir.join('corpus')), WORD_ROWS)
+    bm = BucketManager(c, 1, 3, batch_size=2, shuffle=False,
+                       row_key=lambda x: 1 / 0, lengths=c.lengths)
+    rows = [row for batch in bm for row in batch]
+    assert(sorted(rows) == sorted(WORD_ROWS))
@@ -0,0 +1,53 @@
+import numpy as np
+from johnny.metrics import UAS, LAS, flatten, add_batch_preds
+
+
+def _sents():
+    rs = np.random.RandomState(0)
+    sents = []
+    for _ in range(20):
+        l = rs.randint(1, 35)
+        sents.append([rs.randint(0, l + 1, l), rs.randint(0, l + 1, l),
+                      rs.randint(0, 4, l), rs.randint(0, 4, l)])
+    return sents
+
+
+def test_batch_same_as_per_sentence():
+    sents = _sents()
+    u, l = UAS(), LAS(num_labels=4)
+    for p_arcs, t_arcs, p_lbls, t_lbls in sents:
+        u(arcs=(p_arcs, t_arcs))
+        l(arcs=(p_arcs, t_arcs), labels=(p_lbls, t_lbls))
+    bu, bl = UAS(), LAS(num_labels=4)
+    cols = [flatten(col) for col in zip(*sents)]
+    offsets = cols[0][1]
+    (p_arcs, _), (t_arcs, _), (p_lbls, _), (t_lbls, _) = cols
+    bu.add_batch(p_arcs, t_arcs, offsets)
+    bl.add_batch(p_arcs, t_arcs, p_lbls, t_lbls, offsets)
+    assert(bu.score == u.score)
+    assert(bl.score == l.score)
+    assert(bl.length_scores == l.length_scores)
+    assert(np.array_equal(bl.conf_matrix, l.conf_matrix))
+    assert(np.array_equal(bl.precision, l.precision))
+    # same again, flattening the predictions of each sentence for us
+    pu, pl = UAS(), LAS(num_labels=4)
+    p_arcs, t_arcs, p_lbls, t_lbls = zip(*sents)
+    flat = add_batch_preds(pu, pl, p_arcs, p_lbls, t_arcs, t_lbls)
+    assert(np.array_equal(flat[-1], offsets))
+    assert(pu.score == u.score)
+    assert(pl.score == l.score)
+
+
+def test_las_breakdown():
+    l = LAS(num_labels=3, length_edges=(2,))
+    # first sentence all right, second has a wrong head and a wrong label
+    l.add_batch([1, 0, 2, 0, 1], [1, 0, 2, 1, 1],
+                [1, 1, 0, 2, 2], [1, 1, 0, 2, 1],
+                offsets=[0, 2, 5])
+    assert(l.score == 3 / 5.)
+    assert(l.length_scores == {'1-2': 1., '3-': 1 / 3.})
+    # repeated (pred, true) pairs are all counted
+    assert(l.conf_matrix[1, 1] == 2)
+    assert(l.conf_matrix[2, 1] == 1)
+    assert(np.allclose(l.precision, [1., 1., 0.]))
+    assert(np.allclose(l.recall, [1., 2 / 3., 0.]))
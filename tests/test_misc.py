@@ -1,7 +1,9 @@
 import os
 import numpy as np
 import pytest
-from johnny.misc import BucketManager, Experiment
+from johnny.misc import BucketManager, Experiment, stratified_sample, length_strata
+from johnny.misc import StageTimer, MemoryTracker
+from johnny.metrics import StratifiedRatio
 from johnny import EXP_ENV_VAR
 
 def test_basic():
@@ -160,8 +162,7 @@ def test_right_leak_exact():
 
     batch_size = 2 
     bm = BucketManager(data, 1, 5, right_leak=2, batch_size=batch_size, shuffle=False, row_key=lambda x: len(x[0]))
-    # make it improbable that it will select bucket with index 4 instead of 1
-    bm.left_samples[1] = 1000
+    # without shuffling batches are planned in order of bucket
     batch = next(bm)
     assert(len(batch) == 2)
     assert([[1,2],[1,2]] in batch)
@@ -173,8 +174,7 @@ def test_right_leak_minus_one():
 
     batch_size = 2 
     bm = BucketManager(data, 1, 5, right_leak=1, batch_size=batch_size, shuffle=False, row_key=lambda x: len(x[0]))
-    # make it improbable that it will select bucket with index 4 instead of 1
-    bm.left_samples[1] = 1000
+    # without shuffling batches are planned in order of bucket
     batch = next(bm)
     assert(len(batch) == 1)
     assert([[1,2,3,4],[1,2,3,4]] not in batch)
@@ -186,8 +186,7 @@ def test_right_leak_overzealous():
 
     batch_size = 2 
     bm = BucketManager(data, 1, 5, right_leak=100, batch_size=batch_size, shuffle=False, row_key=lambda x: len(x[0]))
-    # make it improbable that it will select bucket with index 4 instead of 1
-    bm.left_samples[1] = 1000
+    # without shuffling batches are planned in order of bucket
     batch = next(bm)
     assert(len(batch) == 2)
     assert([[1,2],[1,2]] in batch)
@@ -199,13 +198,77 @@ def test_right_leak_right_one():
 
     batch_size = 2 
     bm = BucketManager(data, 1, 5, right_leak=100, batch_size=batch_size, shuffle=False, row_key=lambda x: len(x[0]))
-    # make it improbable that it will select bucket with index 4 instead of 1
-    bm.left_samples[1] = 1000
+    # without shuffling batches are planned in order of bucket
     batch = next(bm)
     assert(len(batch) == 2)
     assert([[1,2],[1,2]] in batch)
     assert([[1,2,3,4],[1,2,3,4]] in batch)
 
+def test_token_budget():
+    data = [[1] * l for l in (1, 1, 1, 1, 2, 2, 5, 5, 9)]
+    bm = BucketManager(data, 1, 10, batch_size=None, shuffle=False,
+                       token_budget=4)
+    batches = sorted(list(bm), key=len)
+    assert(sorted(len(b) for b in batches) == [1, 1, 1, 2, 4])
+    for b in batches:
+        assert(len(b) == 1 or max(len(r) for r in b) * len(b) <= 4)
+
+def test_token_budget_quadratic():
+    data = [[1] * l for l in (2, 2, 2, 2, 2, 3, 3, 3)]
+    bm = BucketManager(data, 2, 4, batch_size=None, shuffle=False,
+                       token_budget=20, budget_cost='quadratic')
+    # bucket of length 2-3: 5 rows of length 2 cost 20, 2 rows of 3 cost 18
+    lens = [[len(r) for r in b] for b in bm]
+    assert(sorted(map(sorted, lens)) == [[2, 2, 2, 2, 2], [3], [3, 3]])
+    with pytest.raises(ValueError):
+        BucketManager(data, 2, 4, token_budget=20, budget_cost='cubic')
+
+def test_token_budget_and_batch_size():
+    data = [[1]] * 10
+    bm = BucketManager(data, 1, 1, batch_size=3, token_budget=100)
+    assert(sorted(len(b) for b in bm) == [1, 3, 3, 3])
+
+def test_token_budget_right_leak():
+    data = [[1, 2], [1, 2, 3, 4], [1, 2, 3, 4]]
+    bm = BucketManager(data, 1, 5, batch_size=None, right_leak=2,
+                       shuffle=False, token_budget=8)
+    # without shuffling batches are planned in order of bucket
+    batch = next(bm)
+    # only one of the length 4 rows fits: max len 4 * 2 rows = 8
+    assert(sorted(map(len, batch)) == [2, 4])
+
+def test_epoch_plan_covers_rows():
+    rs = np.random.RandomState(3)
+    data = [[0] * rs.randint(1, 20) for _ in range(500)]
+    for leak in (None, 2):
+        for budget in (None, 100):
+            bm = BucketManager(data, 3, 20, batch_size=16, right_leak=leak,
+                               token_budget=budget)
+            for epoch in range(2):
+                rows = [id(r) for batch in bm for r in batch]
+                assert(sorted(rows) == sorted(map(id, data)))
+                assert(bm.total_left == 0)
+                bm.reset()
+
+def test_resume_from_state():
+    rs = np.random.RandomState(3)
+    data = [[i] * rs.randint(1, 20) for i in range(300)]
+    np.random.seed(5)
+    bm = BucketManager(data, 3, 20, batch_size=16, right_leak=1,
+                       loop_forever=True)
+    for _ in range(10):
+        next(bm)
+    state = dict((k, np.copy(v)) for k, v in bm.state_dict().items())
+    # go past the end of the epoch so that we also plan a new one
+    expected = [next(bm) for _ in range(40)]
+    bm2 = BucketManager(data, 3, 20, batch_size=16, right_leak=1,
+                        loop_forever=True)
+    bm2.load_state_dict(state)
+    assert(bm2.batch_count == 10)
+    assert([next(bm2) for _ in range(40)] == expected)
+    with pytest.raises(ValueError):
+        BucketManager(data[:10], 3, 20).load_state_dict(state)
+
 def test_experiment_to_and_from_yaml(tmpdir):
     p = str(tmpdir.mkdir('exps'))
     e = Experiment('test', lang='English', model={'lr': 0.5, 'lstm_units': 100}, exp_folder_path=p)
@@ -235,3 +298,103 @@ def test_experiment_non_existant_file(tmpdir):
     with pytest.raises(ValueError):
         e = Experiment('test', lang='English', model={'lr': 0.5, 'lstm_units': 100})
         e.save()
+
+def test_prefetcher():
+    from johnny.misc import Prefetcher
+    with Prefetcher(range(10), lambda x: x * 2, size=3) as p:
+        assert(list(p) == [x * 2 for x in range(10)])
+
+    def fail(x):
+        if x == 3:
+            raise ValueError('oops')
+        return x
+    p = Prefetcher(range(10), fail)
+    assert([next(p) for _ in range(3)] == [0, 1, 2])
+    with pytest.raises(ValueError):
+        next(p)
+
+    # stopping early doesn't hang
+    p = Prefetcher(iter(int, 1), size=1)
+    assert(next(p) == 0)
+    p.close()
+    with pytest.raises(StopIteration):
+        next(p)
+
+
+def test_stratified_sample():
+    rs = np.random.RandomState(0)
+    lengths = rs.randint(1, 50, 1000)
+    indices, edges, sizes = stratified_sample(lengths, 100, num_strata=5,
+                                              random_state=rs)
+    assert(len(edges) == 4)
+    assert(sum(sizes) == 1000)
+    assert(len(set(indices)) == len(indices))
+    assert(abs(len(indices) - 100) <= 5)
+    _, strata = length_strata(lengths, 5)
+    # each stratum gets its share of the sample
+    counts = np.bincount(strata[indices], minlength=5)
+    assert(np.all(np.abs(counts - sizes / 10.) <= 1))
+
+
+def test_stratified_ratio():
+    rs = np.random.RandomState(0)
+    lengths = rs.randint(1, 50, 1000)
+    correct = rs.binomial(lengths, 0.7)
+    true_ratio = correct.sum() / float(lengths.sum())
+    indices, edges, sizes = stratified_sample(lengths, 200, random_state=rs)
+    est = StratifiedRatio(edges, sizes)
+    for i in indices:
+        est(correct[i], lengths[i])
+    assert(abs(est.score - true_ratio) < 3 * est.stderr)
+    assert(0 < est.stderr < 0.02)
+    # the whole population - no error
+    est.reset()
+    for c, l in zip(correct, lengths):
+        est(c, l)
+    assert(np.isclose(est.score, true_ratio))
+    assert(np.isclose(est.stderr, 0.))
+
+
+def test_stage_timer():
+    synced = []
+    timer = StageTimer(sync=lambda: synced.append(1))
+    with timer.stage('outer'):
+        with timer.stage('inner'):
+            pass
+        with timer.stage('inner'):
+            pass
+    assert(timer.counts == {'outer': 1, 'inner': 2})
+    assert(timer.totals['outer'] >= timer.totals['inner'] >= 0.)
+    # we sync when entering and exiting each stage
+    assert(len(synced) == 6)
+    timer.reset()
+    assert(timer.as_dict() == {'time_outer': 0., 'time_inner': 0.})
+
+
+def test_bucket_bounds():
+    rows = [[0] * l for l in range(3, 20)]
+    bm = BucketManager(rows, 5, 20, min_len=3)
+    assert(bm.bucket_bounds(3) == (3, 7))
+    assert(bm.bucket_bounds(7) == (3, 7))
+    assert(bm.bucket_bounds(8) == (8, 12))
+
+
+def test_memory_tracker():
+    bm = BucketManager([[0] * l for l in range(1, 20)], 5, 20)
+    tracker = MemoryTracker(bm)
+    try:
+        with tracker.track(7, predicted=100):
+            a = np.ones(100000, dtype=np.float32)
+            del a
+        with tracker.track(9):
+            pass
+        stats = tracker.as_dict()
+    finally:
+        tracker.close()
+    assert(list(stats['mem_by_bucket']) == ['6-10'])
+    bucket = stats['mem_by_bucket']['6-10']
+    assert(bucket['batches'] == 2)
+    assert(bucket['max_len'] == 9)
+    assert(bucket['predicted_bytes'] == 100)
+    # the array was freed but it counts towards the peak
+    assert(bucket['peak_bytes'] >= 400000)
@@ -162,3 +162,194 @@ def test_batched_preds_equal_non_batched_preds(simple_pos_model):
         for i, (w, p) in enumerate(zip(oh_words, oh_pos)):
             pred, l = simple_pos_model([w], [p])
             assert(np.allclose(pred, b_preds[i]))
+
+def test_prepared_batch_same_as_inputs(simple_pos_model):
+    oh_words = [[1,2], [1,2,3,4], [3], [4,5]]
+    oh_pos = [[5,6], [5,6,7,8], [1], [2,2]]
+    oh_heads = [[1,0], [2,3,1,3], [0], [2,0]]
+    oh_labels = [[3,5], [2,4,5,3], [2], [1,1]]
+
+    with chainer.using_config('train', False):
+        r, l = simple_pos_model(oh_words, oh_pos, heads=oh_heads, labels=oh_labels)
+        loss = simple_pos_model.loss.data
+        batch = simple_pos_model.prepare_batch(oh_words, oh_pos,
+                                               heads=oh_heads, labels=oh_labels)
+        # stable sort - ties keep input order
+        assert(batch.perm_indices.tolist() == [1, 0, 3, 2])
+        assert(batch.inputs.col_lengths == [4, 4, 3, 1, 1])
+        assert([h.tolist() for h in batch.heads] == [[2,1,2,0], [3,0,0], [1], [3]])
+        pr, pl = simple_pos_model(batch)
+    assert(np.allclose(loss, simple_pos_model.loss.data))
+    for a, b in zip(r + l, pr + pl):
+        assert(np.array_equal(a, b))
+
+def test_accumulated_grads_same_as_large_batch(simple_word_model):
+    words = [[1, 2], [1, 2, 3, 4], [3], [4, 5, 6]]
+    heads = [[2, 0], [2, 0, 2, 3], [0], [0, 1, 1]]
+    labels = [[1, 0], [2, 1, 1, 3], [0], [1, 2, 0]]
+    model = simple_word_model
+    with chainer.using_config('train', True):
+        model(words, heads=heads, labels=labels)
+        model.cleargrads()
+        model.loss.backward()
+        expected = dict((k, np.copy(p.grad)) for k, p in model.namedparams())
+
+        micro = [model.prepare_batch(words[:2], heads=heads[:2], labels=labels[:2]),
+                 model.prepare_batch(words[2:], heads=heads[2:], labels=labels[2:])]
+        total = sum(batch.num_tokens for batch in micro)
+        model.cleargrads()
+        for batch in micro:
+            model(batch)
+            assert(batch.num_tokens == model.num_tokens)
+            (model.loss * (batch.num_tokens / float(total))).backward()
+    for k, p in model.namedparams():
+        assert(np.allclose(p.grad, expected[k], atol=1e-6))
+
+def test_predict_same_as_call(simple_pos_model):
+    words = [[1, 2], [1, 2, 3, 4], [3]]
+    pos = [[2, 3], [4, 5, 6, 7], [8]]
+    heads = [[2, 0], [2, 0, 2, 3], [0]]
+    labels = [[1, 0], [2, 1, 1, 3], [0]]
+    model = simple_pos_model
+    with chainer.using_config('train', False):
+        r, l = model(words, pos, heads=heads, labels=labels)
+    pr, pl, arc_scores, lbl_scores = model.predict(words, pos, return_scores=True)
+    assert(model.loss == 0)
+    for a, b in zip(r + l, pr + pl):
+        assert(np.array_equal(a, b))
+    for sent, arcs, s_arcs, s_lbls in zip(words, pr, arc_scores, lbl_scores):
+        assert(s_arcs.shape == (len(sent) + 1, len(sent)))
+        assert(s_lbls.shape == (model.num_labels, len(sent)))
+        assert(np.allclose(s_arcs.sum(axis=0), 1.))
+        # no tree constraints - the best head is the prediction
+        assert(np.array_equal(np.argmax(s_arcs, axis=0), arcs))
+
+def test_stage_timer(simple_word_model):
+    from johnny.misc import StageTimer
+    words = [[1, 2], [1, 2, 3, 4], [3]]
+    model = simple_word_model
+    model.predict(words)
+    timer = StageTimer()
+    model.set_timer(timer)
+    model.predict(words)
+    model.predict(words)
+    for stage in ('encoder', 'embed', 'lstm', 'deaugment', 'heads',
+                  'decode', 'labels'):
+        assert(timer.counts[stage] == 2)
+    # the encoder stages are part of the encoder stage
+    assert(timer.totals['encoder'] >= timer.totals['lstm'])
+    model.set_timer(None)
+    model.predict(words)
+    assert(timer.counts['encoder'] == 2)
+
+def test_activation_bytes(simple_word_model):
+    model = simple_word_model
+    # linear in batch size, quadratic in length
+    assert(model.activation_bytes(4, 10) == 4 * model.activation_bytes(1, 10))
+    assert(model.activation_bytes(1, 100) > 20 * model.activation_bytes(1, 10))
+
+@pytest.mark.parametrize('arc_dropout', [0., 0.2])
+def test_activation_bytes_close_to_measured(arc_dropout):
+    from johnny.misc import MemoryTracker
+    np.random.seed(SEED)
+    embed = Embedder((50,), (10,), dropout=0.)
+    encoder = SentenceEncoder(embed, num_units=8, dropout=0.)
+    model = GraphParser(encoder, mlp_arc_units=64, mlp_lbl_units=8,
+                        arc_dropout=arc_dropout, treeify='none')
+    batch_size, max_len = 8, 40
+    words = [np.random.randint(1, 50, max_len) for _ in range(batch_size)]
+    heads = [np.random.randint(0, max_len + 1, max_len) for _ in range(batch_size)]
+    labels = [np.random.randint(0, 10, max_len) for _ in range(batch_size)]
+    batch = model.prepare_batch(words, heads=heads, labels=labels)
+    tracker = MemoryTracker()
+    try:
+        with chainer.using_config('train', True):
+            with tracker.track(max_len):
+                model(batch)
+                model.loss.backward()
+        measured = tracker.by_bucket[str(max_len)]['peak_bytes']
+    finally:
+        tracker.close()
+    predicted = model.activation_bytes(batch_size, max_len)
+    # the arc scores dominate - the rest (parameter gradients, python
+    # objects) is small for this model
+    assert(0.7 * measured < predicted < 1.3 * measured)
+
+def _arc_scorer_model(arc_scorer, arc_dropout=0., arc_chunk_size=5):
+    np.random.seed(SEED)
+    embed = Embedder((10,), (10,), dropout=0.)
+    encoder = SentenceEncoder(embed, num_units=8, dropout=0.)
+    return GraphParser(encoder, mlp_arc_units=8, mlp_lbl_units=8, lbl_dropout=0.,
+            arc_dropout=arc_dropout, treeify='none', arc_scorer=arc_scorer,
+            arc_chunk_size=arc_chunk_size)
+
+# 2 is smaller than the batch, so tiles split the batch too
+@pytest.mark.parametrize('arc_chunk_size', [5, 2])
+def test_chunked_arc_scores_same_as_mlp(arc_chunk_size):
+    words = [[1, 2], [1, 2, 3, 4], [3], [4, 5, 6]]
+    heads = [[2, 0], [2, 0, 2, 3], [0], [0, 1, 1]]
+    labels = [[1, 0], [2, 1, 1, 3], [0], [1, 2, 0]]
+    results = []
+    for arc_scorer in ('mlp', 'chunked'):
+        model = _arc_scorer_model(arc_scorer, arc_chunk_size=arc_chunk_size)
+        with chainer.using_config('train', True):
+            r, l = model(words, heads=heads, labels=labels)
+            model.cleargrads()
+            model.loss.backward()
+        grads = dict((k, np.copy(p.grad)) for k, p in model.namedparams())
+        results.append((r, l, float(model.loss.data), grads))
+    (r, l, loss, grads), (cr, cl, c_loss, c_grads) = results
+    assert(np.allclose(loss, c_loss))
+    for a, b in zip(r + l, cr + cl):
+        assert(np.array_equal(a, b))
+    assert(sorted(grads) == sorted(c_grads))
+    for k in grads:
+        assert(np.allclose(grads[k], c_grads[k], atol=1e-6))
+
+def test_chunked_arc_scores_tiles():
+    from johnny.components import ChunkedArcScores
+    for chunk_size in (1, 3, 7, 64, 1000):
+        f = ChunkedArcScores(chunk_size)
+        for num_deps, num_heads, batch_size in ((5, 6, 4), (3, 4, 10), (1, 1, 1)):
+            seen = np.zeros((num_deps, num_heads, batch_size), dtype=np.int32)
+            for i0, i1, j0, j1, k0, k1 in f._tiles(num_deps, num_heads, batch_size):
+                assert((i1 - i0) * (j1 - j0) * (k1 - k0) <= chunk_size)
+                seen[i0:i1, j0:j1, k0:k1] += 1
+            # each pair is in exactly one tile
+            assert(np.all(seen == 1))
+
+@pytest.mark.parametrize('chunk_size', [5, 2])
+def test_chunked_arc_scores_dropout_grads(chunk_size):
+    from johnny.components import ChunkedArcScores
+    rs = np.random.RandomState(SEED)
+    # heads, dependents, v and b - in float64 for finite differences
+    inputs = (rs.randn(4, 3, 5), rs.randn(6, 3, 5), rs.randn(1, 5), rs.randn(1))
+    g_scores = rs.randn(6, 4, 3)
+    with chainer.using_config('train', True):
+        f = ChunkedArcScores(chunk_size, dropout=0.3)
+    grads = f.backward(inputs, (g_scores,))
+    eps = 1e-6
+    for x, g in zip(inputs, grads):
+        for idx in np.ndindex(x.shape):
+            old = x[idx]
+            x[idx] = old + eps
+            plus = np.sum(f.forward(inputs)[0] * g_scores)
+            x[idx] = old - eps
+            minus = np.sum(f.forward(inputs)[0] * g_scores)
+            x[idx] = old
+            assert(np.isclose((plus - minus) / (2 * eps), g[idx], atol=1e-5))
+
+def test_biaffine_arc_scorer():
+    words = [[1, 2], [1, 2, 3, 4], [3]]
+    heads = [[2, 0], [2, 0, 2, 3], [0]]
+    labels = [[1, 0], [2, 1, 1, 3], [0]]
+    model = _arc_scorer_model('biaffine', arc_dropout=0.2)
+    assert(not hasattr(model, 'vT'))
+    with chainer.using_config('train', True):
+        r, l = model(words, heads=heads, labels=labels)
+        model.cleargrads()
+        model.loss.backward()
+    assert(model.U_arc.grad is not None)
+    arcs, lbls, arc_scores, _ = model.predict(words, return_scores=True)
+    for sent, s_arcs in zip(words, arc_scores):
+        assert(s_arcs.shape == (len(sent) + 1, len(sent)))
@@ -0,0 +1,58 @@
+import chainer
+import numpy as np
+from johnny.models import GraphParser
+from johnny.components import Embedder, SentenceEncoder
+from johnny.parallel import DataParallel
+
+
+def _setup():
+    np.random.seed(13)
+    embed = Embedder((20,), (8,), dropout=0.)
+    encoder = SentenceEncoder(embed, num_units=8, dropout=0.)
+    model = GraphParser(encoder, mlp_arc_units=8, mlp_lbl_units=8,
+                        num_labels=5, arc_dropout=0., lbl_dropout=0.,
+                        treeify='none')
+    opt = chainer.optimizers.Adam(alpha=0.01)
+    opt.setup(model)
+    return model, opt
+
+
+def _batch(rs, size):
+    rows = []
+    for _ in range(size):
+        l = rs.randint(1, 9)
+        rows.append((tuple(rs.randint(1, 20, l)),
+                     tuple(rs.randint(0, l + 1, l)),
+                     tuple(rs.randint(0, 5, l))))
+    return rows
+
+
+def test_same_as_large_batch():
+    rs = np.random.RandomState(0)
+    steps = [[_batch(rs, 3), _batch(rs, 5), _batch(rs, 2)] for _ in range(3)]
+
+    model, opt = _setup()
+    large_losses = []
+    with chainer.using_config('train', True):
+        for batches in steps:
+            words, heads, labels = zip(*sum(batches, []))
+            model(words, heads=heads, labels=labels)
+            model.cleargrads()
+            model.loss.backward()
+            opt.update()
+            large_losses.append(float(model.loss.data))
+
+    p_model, p_opt = _setup()
+    losses = []
+    with DataParallel(p_model, p_opt, 3) as parallel:
+        for batches in steps:
+            loss, preds = parallel.update(batches)
+            losses.append(loss)
+            assert([len(a) for a, l in preds] == list(map(len, batches)))
+    assert(np.allclose(losses, large_losses))
+    for (name, p), (_, p_p) in zip(sorted(model.namedparams()),
+                                   sorted(p_model.namedparams())):
+        # the bias of the arc scorer doesn't change the softmax over heads,
+        # so its gradient is only rounding noise which Adam amplifies
+        if name != '/vT/b':
+            assert(np.allclose(p.data, p_p.data, atol=1e-5))
@@ -0,0 +1,77 @@
+import io
+import chainer
+import numpy as np
+from mlconf import Blueprint
+from johnny.dep import UDepLoader, ConlluWriter
+from johnny.vocab import Vocab, UDepVocab, save_vocabs
+from johnny.text_utils import process_texts, encode_texts
+from johnny.parse import Parser, to_sentence
+from johnny.bundle import save_bundle, load_bundle, is_bundle
+
+SENTS = [['the', 'cat', 'sat'], ['a', 'dog'], [],
+         ['the', 'dog', 'sat', 'on', 'the', 'mat']]
+
+
+def _blueprint(tmpdir):
+    vocab = Vocab(size=10).fit(w for sent in SENTS for w in sent)
+    vocab_path = str(tmpdir.join('m.vocab'))
+    save_vocabs(vocab_path, dict(text=vocab, arcs=UDepVocab()))
+    bp = Blueprint.from_dict({
+        'ngram': 1, 'subword': False,
+        'preprocess': {'lowercase': True},
+        'model': {'$module': 'johnny.models', '$classname': 'GraphParser',
+                  'encoder': {'$module': 'johnny.components',
+                              '$classname': 'SentenceEncoder',
+                              'num_units': 8,
+                              'embedder': {'$module': 'johnny.components',
+                                           '$classname': 'Embedder',
+                                           'in_sizes': [len(vocab)],
+                                           'out_sizes': [8]}},
+                  'mlp_arc_units': 8, 'mlp_lbl_units': 8,
+                  'num_labels': len(UDepVocab()), 'treeify': 'chu'},
+        'vocab_path': vocab_path,
+        'model_path': str(tmpdir.join('m.model'))})
+    np.random.seed(0)
+    model = bp.build().model
+    chainer.serializers.save_npz(bp.model_path, model)
+    return bp, vocab, model
+
+
+def test_parser(tmpdir):
+    bp, vocab, model = _blueprint(tmpdir)
+    parser = Parser(bp, batch_size=2)
+    parses = parser.parse(SENTS)
+    assert(len(parses) == len(SENTS))
+    assert(parses[2] == ([], []))
+    ids = encode_texts(process_texts(SENTS[:2] + SENTS[3:], 1, False,
+                                     bp.preprocess), vocab)
+    arcs, lbls = model.predict(ids)
+    rev = UDepVocab().rev_index
+    for (heads, labels), p_arcs, p_lbls in zip(parses[:2] + parses[3:], arcs, lbls):
+        assert(heads == p_arcs.tolist())
+        assert(labels == [rev[l] for l in p_lbls])
+
+
+def test_write_parsed_text(tmpdir):
+    out = io.StringIO()
+    with ConlluWriter(out) as writer:
+        sent = to_sentence(SENTS[0])
+        writer.write(sent, heads=[2, 0, 2], labels=['det', 'root', 'x'])
+    # stream isn't closed - we can read back the sentence
+    sents = list(UDepLoader.iter_conllu_sents(io.StringIO(out.getvalue())))
+    assert(len(sents) == 1)
+    assert(sents[0].words == tuple(SENTS[0]))
+    assert(sents[0].heads == (2, 0, 2))
+    assert(sents[0].arctags == ('det', 'root', 'x'))
+
+
+def test_bundle(tmpdir):
+    bp, _, _ = _blueprint(tmpdir)
+    path = str(tmpdir.join('m.bundle'))
+    save_bundle(path, bp.as_dict(), bp.model_path, bp.vocab_path)
+    assert(is_bundle(path))
+    model, vocabs, config = load_bundle(path, treeify='none')
+    assert(model.treeify == 'none')
+    assert(list(vocabs) == ['text', 'arcs'])
+    assert(config['preprocess'] == {'lowercase': True})
+    assert(Parser(path).parse(SENTS) == Parser(bp).parse(SENTS))
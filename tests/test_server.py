@@ -0,0 +1,126 @@
+import json
+import pytest
+import threading
+from six.moves.urllib.request import urlopen
+from six.moves.urllib.error import HTTPError
+from johnny.server import MicroBatcher, ParseServer
+
+
+def _fake_parse(calls):
+    def parse(sents):
+        calls.append(len(sents))
+        return [(list(range(len(sent))), ['x'] * len(sent)) for sent in sents]
+    return parse
+
+
+def test_micro_batcher():
+    calls = []
+    batcher = MicroBatcher(_fake_parse(calls), max_wait=0.2, max_tokens=10)
+    results = dict()
+
+    def request(i):
+        results[i] = batcher([['w'] * (i + 1)])
+
+    threads = [threading.Thread(target=request, args=(i,)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    batcher.close()
+    for i in range(4):
+        assert(results[i] == [(list(range(i + 1)), ['x'] * (i + 1))])
+    # 10 tokens in all - fits in a batch if they arrive in time
+    assert(sum(calls) == 4)
+    assert(len(calls) < 4)
+    stats = batcher.stats.as_dict()
+    assert(stats['requests'] == 4)
+    assert(stats['tokens'] == 10)
+    assert(stats['batches'] == len(calls))
+    assert(stats['latency_p99'] >= stats['latency_p50'] > 0)
+
+
+def test_micro_batcher_max_tokens():
+    calls = []
+    batcher = MicroBatcher(_fake_parse(calls), max_wait=0., max_tokens=3)
+    # larger than max tokens - still parsed, in a batch of its own
+    assert(len(batcher([['w'] * 5, ['w']])) == 2)
+    batcher.close()
+    assert(calls == [2])
+
+
+def test_micro_batcher_error():
+    def fail(sents):
+        raise ValueError('oops')
+    batcher = MicroBatcher(fail)
+    with pytest.raises(ValueError):
+        batcher([['w']])
+    batcher.close()
+
+
+def test_server():
+    server = ParseServer(('127.0.0.1', 0), _fake_parse([]), max_wait=0.)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:%d' % server.server_address[1]
+    try:
+        body = json.dumps({'sentences': [['a', 'b'], ['c']]}).encode('utf-8')
+        reply = json.loads(urlopen(url + '/parse', body).read().decode('utf-8'))
+        assert(reply == {'parses': [{'heads': [0, 1], 'labels': ['x', 'x']},
+                                    {'heads': [0], 'labels': ['x']}]})
+        stats = json.loads(urlopen(url + '/stats').read().decode('utf-8'))
+        assert(stats['requests'] == 1)
+        assert(stats['batch_sents_hist'] == {'<=2': 1})
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_micro_batcher_error_stays_with_request():
+    calls = []
+
+    def parse(sents):
+        calls.append(len(sents))
+        if any(not isinstance(w, str) for sent in sents for w in sent):
+            raise AttributeError('bad word')
+        return [(list(range(len(sent))), ['x'] * len(sent)) for sent in sents]
+
+    batcher = MicroBatcher(parse, max_wait=0.5, max_tokens=100)
+    results = dict()
+
+    def request(i, sents):
+        try:
+            results[i] = batcher(sents)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=request, args=(0, [['a', 'b']])),
+               threading.Thread(target=request, args=(1, [['a', 3]]))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    batcher.close()
+    assert(results[0] == [([0, 1], ['x', 'x'])])
+    assert(isinstance(results[1], AttributeError))
+    # batched together, then retried one at a time
+    assert(calls[0] == 2)
+
+
+def test_server_rejects_bad_words():
+    calls = []
+    server = ParseServer(('127.0.0.1', 0), _fake_parse(calls), max_wait=0.)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:%d' % server.server_address[1]
+    try:
+        for sents in ([['a', None]], [['a', 1]], [['']], ['ab']):
+            body = json.dumps({'sentences': sents}).encode('utf-8')
+            with pytest.raises(HTTPError) as e:
+                urlopen(url + '/parse', body)
+            assert(e.value.code == 400)
+        assert(calls == [])
+    finally:
+        server.shutdown()
+        server.server_close()
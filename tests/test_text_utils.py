@@ -27,3 +27,27 @@ def test_remove_diacritics():
     assert(pp._remove_diacritics(s) == u'ταιζω')
     s = u'ᾧ'
     assert(pp._remove_diacritics(s) == u'ω')
+
+def test_process_texts_matches_per_token():
+    sents = [[u'The', u'Cat', u'sat', u'on', u'the', u'maaaat', u'5.4'],
+             [u'the', u'cat']]
+    funcs = dict(lowercase=True, collapse_nums=True, collapse_triples=True)
+    for ngram in (1, 2, 3):
+        for is_subword in (False, True):
+            if is_subword:
+                expected = tuple(tuple(pp.to_ngrams(pp.preprocess(w, **funcs), n=ngram)
+                                       for w in s) for s in sents)
+            else:
+                expected = tuple(pp.to_ngrams(tuple(pp.preprocess(w, **funcs) for w in s),
+                                              n=ngram) for s in sents)
+            assert(pp.process_texts(sents, ngram, is_subword, funcs) == expected)
+            assert(pp.process_text(sents[0], ngram, is_subword, funcs) == expected[0])
+
+def test_process_types_memoized():
+    pp.clear_cache()
+    funcs = dict(lowercase=True)
+    assert(pp.process_types([u'A', u'b', u'A'], preprocess_funcs=funcs) ==
+           {u'A': u'a', u'b': u'b'})
+    # a different configuration doesn't reuse the results
+    assert(pp.process_types([u'A'])[u'A'] == u'A')
+    assert(len(pp._type_cache) == 2)
@@ -1,4 +1,8 @@
-from johnny.dep import Sentence
+import io
+import pytest
+import numpy as np
+from johnny.dep import Dataset, Sentence, Token, ConlluWriter, non_projective
+from johnny.dep import UDepLoader, Shard, CONLL2006Loader
 from collections import namedtuple
 
 
@@ -6,3 +10,159 @@ def test_arclen():
     t = namedtuple('TokenStub', ('head'))
     s = Sentence([t(3), t(1), t(0), t(2)])
     assert(s.arc_lengths == (2, 1, 1, 2))
+
+
+CONLLU_SENT = [
+    ['1-2', "don't", '_', '_', '_', '_', '_', '_', '_', '_'],
+    ['1', 'do', 'do', 'AUX', '_', 'Mood=Imp', '3', 'aux', '_', '_'],
+    ['2', "n't", 'not', 'PART', '_', '_', '3', 'advmod', '_', '_'],
+    ['3', 'go', 'go', 'VERB', '_', '_', '0', 'root', '_', 'SpaceAfter=No'],
+]
+
+
+def _conllu_sent():
+    return Sentence([Token(*cols) for cols in CONLLU_SENT])
+
+
+def test_writer_matches_str(tmpdir):
+    f = str(tmpdir.join('out.conllu'))
+    sent = _conllu_sent()
+    with ConlluWriter(f) as writer:
+        writer.write(sent)
+        writer.write(sent)
+    expected = '%s\n\n' % '\n'.join('\t'.join(cols) for cols in CONLLU_SENT)
+    with io.open(f, encoding='utf-8') as inp:
+        assert(inp.read() == expected * 2)
+
+
+@pytest.mark.parametrize('background', [False, True])
+def test_writer_flush(background):
+    out = io.StringIO()
+    writer = ConlluWriter(out, background=background)
+    writer.write(_conllu_sent())
+    # below chunk_size - nothing is written until we flush
+    assert(out.getvalue() == '')
+    writer.flush()
+    expected = '%s\n\n' % '\n'.join('\t'.join(cols) for cols in CONLLU_SENT)
+    assert(out.getvalue() == expected)
+    writer.write(_conllu_sent())
+    writer.close()
+    assert(out.getvalue() == expected * 2)
+
+
+def test_writer_predictions(tmpdir):
+    f = str(tmpdir.join('out.conllu'))
+    sent = _conllu_sent()
+    rev_labels = {0: 'root', 1: 'nsubj'}
+    with ConlluWriter(f, rev_labels=rev_labels, background=True,
+                      chunk_size=1) as writer:
+        for i in range(10):
+            writer.write(sent, heads=np.array([0, 1, 1]),
+                         labels=np.array([0, 1, 1]))
+    with io.open(f, encoding='utf-8') as inp:
+        blocks = inp.read().split('\n\n')[:-1]
+    assert(len(blocks) == 10)
+    rows = [l.split('\t') for l in blocks[0].split('\n')]
+    # multiword tokens are written as they were
+    assert(rows[0][6:8] == ['_', '_'])
+    assert([r[6] for r in rows[1:]] == ['0', '1', '1'])
+    assert([r[7] for r in rows[1:]] == ['root', 'nsubj', 'nsubj'])
+    # the tokens are not touched
+    assert(sent.heads == (3, 3, 0))
+
+
+def _random_tree(n, rng):
+    # attach each word in a random order to a word already in the tree
+    order = rng.permutation(n) + 1
+    heads = [0] * n
+    attached = [0]
+    for w in order:
+        heads[w - 1] = attached[rng.randint(len(attached))]
+        attached.append(w)
+    return heads
+
+
+def test_non_projective_matches_is_projective():
+    t = namedtuple('TokenStub', ('head'))
+    rng = np.random.RandomState(13)
+    trees = [_random_tree(rng.randint(1, 12), rng) for i in range(300)]
+    sent_lens = [len(h) for h in trees]
+    heads = [h for tree in trees for h in tree]
+    result = non_projective(heads, sent_lens, max_elements=50)
+    expected = [not Sentence([t(h) for h in tree]).is_projective()
+                for tree in trees]
+    assert(result.tolist() == expected)
+    assert(any(expected) and not all(expected))
+
+
+def test_stats():
+    sents = [_conllu_sent(), Sentence([Token(*cols) for cols in CONLLU_SENT[1:3]] +
+                                      [Token('3', 'do', 'do', 'AUX', '_', '_',
+                                             '1', 'aux', '_', '_')])]
+    # make the second sentence a tree that isn't projective
+    sents[1].tokens[0].head = 3
+    sents[1].tokens[1].head = 0
+    sents[1].tokens[2].head = 2
+    d = Dataset(sents)
+    stats = d.stats
+    assert(stats['num_sents'] == 2)
+    assert(stats['num_words'] == 6)
+    assert(stats['num_types'] == 3)
+    assert(stats['max_sent_len'] == 3)
+    assert(stats['arc_len_hist'] == [0, 4, 2])
+    assert(stats['num_non_projective'] == 1)
+    assert(stats['percentage_projective'] == 0.5)
+    assert(stats['max_arc_len'] == d.arc_len_stats['max_arc_len'])
+
+
+def _write_conllu(path, num_sents):
+    with io.open(path, 'w', encoding='utf-8') as f:
+        for i in range(num_sents):
+            cols = list(CONLLU_SENT[3])
+            cols[1] = u'word%d' % i
+            f.write(u'# sent_id = %d\n%s\n\n' % (i, '\t'.join(cols)))
+
+
+def test_shards_partition_file(tmpdir):
+    f = str(tmpdir.join('data.conllu'))
+    _write_conllu(f, 200)
+    state = np.random.get_state()
+    all_words = [s.words for s in UDepLoader.load_conllu(f)]
+    for hash_by in Shard.HASH_OPTS:
+        shards = [UDepLoader.load_conllu(f, shard=Shard(i, 3, hash_by=hash_by))
+                  for i in range(3)]
+        words = [s.words for shard in shards for s in shard]
+        assert(sorted(words) == sorted(all_words))
+        assert(all(len(shard) > 0 for shard in shards))
+        # loading again gives the same sentences in each shard
+        again = UDepLoader.load_conllu(f, shard=Shard(1, 3, hash_by=hash_by))
+        assert([s.words for s in again] == [s.words for s in shards[1]])
+    sample = UDepLoader.load_conllu(f, shard=Shard(sample_ratio=0.25))
+    assert(0 < len(sample) < 100)
+    assert(set(s.words for s in sample) <= set(all_words))
+    # global random state is not touched
+    assert(np.all(np.random.get_state()[1] == state[1]))
+
+
+def test_conll2006_dev_split_independent_of_shard(tmpdir):
+    folder = tmpdir.mkdir('data')
+    lang_folder = folder.join('a', 'b', 'c', 'd', 'e')
+    lang_folder.ensure(dir=True)
+    _write_conllu(str(lang_folder.join('english_train.conll')), 200)
+    _write_conllu(str(lang_folder.join('english_gs.conll')), 10)
+    loader = CONLL2006Loader('CONLL2006', datafolder=str(folder))
+    train, dev = loader.load_train_dev('english')
+    words = lambda dataset: [s.words for s in dataset]
+    assert(len(train) == 190 and len(dev) == 10)
+    shards = [loader.load_train_dev('english', shard=Shard(i, 2))
+              for i in range(2)]
+    for shard_train, shard_dev in shards:
+        assert(words(shard_dev) == words(dev))
+    shard_words = words(shards[0][0]) + words(shards[1][0])
+    assert(sorted(shard_words) == sorted(words(train)))
+    sample_train, sample_dev = loader.load_train_dev(
+        'english', shard=Shard(sample_ratio=0.5))
+    assert(words(sample_dev) == words(dev))
+    assert(set(words(sample_train)) < set(words(train)))
+    no_train, only_dev = loader.load_train_dev('english', load_train=False)
+    assert(no_train is None and words(only_dev) == words(dev))
@@ -7,3 +7,12 @@ def test_basic():
     assert(e == (p.TAGS.index('acl'), p.TAGS.index('advcl')))
     with pytest.raises(KeyError):
         e = p.encode(('acl', 'WTF'))
+
+def test_encode_batch():
+    p = UDepVocab()
+    ids, offsets = p.encode_batch([['acl', 'advcl'], ['root']])
+    assert(ids.tolist() == [p.TAGS.index('acl'), p.TAGS.index('advcl'),
+                            p.TAGS.index('root')])
+    assert(offsets.tolist() == [0, 2, 3])
+    with pytest.raises(KeyError):
+        p.encode_batch([['acl'], ['WTF']])
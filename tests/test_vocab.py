@@ -1,4 +1,7 @@
-from johnny.vocab import Vocab
+# -*- coding: utf-8 -*-
+import numpy as np
+from collections import Counter
+from johnny.vocab import Vocab, UDepVocab, split_ids, save_vocabs, load_vocabs
 
 def test_fit():
     s = 'daybreak at the bottom of the lake' # note there are 2 "the"
@@ -41,3 +44,94 @@ def test_serialisation(tmpdir):
     v2 = Vocab.load(str(f))
     for w in s:
         assert v[w] == v2[w]
+
+def test_encode_batch():
+    s = 'daybreak at the bottom of the lake'.split()
+    v = Vocab(size=3).fit(s)
+    seqs = [['the', 'lake', 'x'], [], ['at']]
+    ids, offsets = v.encode_batch(seqs)
+    assert(ids.dtype == np.int32)
+    assert(offsets.tolist() == [0, 3, 3, 4])
+    assert(split_ids(ids, offsets) == tuple(v.encode(seq) for seq in seqs))
+    assert(v.char_table is None)
+
+def test_encode_batch_chars():
+    s = u'daybreak at the bottom of the lake ταΐζω'
+    v = Vocab(size=10).fit(s)
+    words = [tuple(w) for w in u'the lake τω €!'.split()]
+    ids, offsets = v.encode_batch(words)
+    assert(v.char_table is not None)
+    expected = tuple(tuple(v.index.get(c, v.reserved.UNK) for c in w)
+                     for w in words)
+    assert(split_ids(ids, offsets) == expected)
+    # tokens that aren't characters are looked up one by one
+    ids, offsets = v.encode_batch([[u'th', u't']])
+    assert(ids.tolist() == [v.reserved.UNK, v.index[u't']])
+
+def test_partial_fit_and_merge():
+    s = 'a b c a b a d d d d e'.split()
+    v = Vocab(size=3).fit(s)
+    v1 = Vocab(size=3).partial_fit(iter(s[:5]), chunk_size=2)
+    v2 = Vocab(size=3).partial_fit(iter(s[5:]), chunk_size=2)
+    merged = v1.merge(v2).finalize()
+    assert(merged.index == v.index)
+    assert(merged.counts == v.counts)
+
+def test_sketch():
+    s = ['common'] * 100 + ['rare%d' % i for i in range(1000)] + ['freq'] * 50
+    v = Vocab(size=2, sketch_size=20).fit(s, chunk_size=10)
+    assert(len(v.counts) <= 40)
+    assert(set(v.index) == set(['common', 'freq']))
+
+def test_sketch_error_bound():
+    rs = np.random.RandomState(0)
+    s = ['w%d' % i for i in rs.zipf(1.5, size=20000)]
+    true = Counter(s)
+    sketch_size = 50
+    v = Vocab(size=10, sketch_size=sketch_size).fit(iter(s), chunk_size=1000)
+    assert(0 < v.count_error <= len(s) / (sketch_size + 1.))
+    for token, count in true.items():
+        assert(count - v.count_error <= v.counts[token] <= count)
+    # merged summaries keep the bound of the total
+    v1 = Vocab(size=10, sketch_size=sketch_size).partial_fit(s[:10000], 1000)
+    v2 = Vocab(size=10, sketch_size=sketch_size).partial_fit(s[10000:], 1000)
+    merged = v1.merge(v2).finalize()
+    assert(merged.count_error <= len(s) / (sketch_size + 1.))
+    for token, count in true.items():
+        assert(count - merged.count_error <= merged.counts[token] <= count)
+    top = [t for t, _ in true.most_common(10)]
+    assert(set(merged.index) == set(top))
+
+
+def test_save_load_vocabs(tmpdir):
+    f = str(tmpdir.join('v.vocab'))
+    s = u'here i go playing the fool again yes i am i am i am ελα'.split()
+    words = Vocab(size=20).fit(s)
+    chars = Vocab(size=30).fit(''.join(s))
+    arcs = UDepVocab()
+    save_vocabs(f, dict(text=words, chars=chars, arcs=arcs), with_counts=True)
+    loaded = load_vocabs(f)
+    assert sorted(loaded) == ['arcs', 'chars', 'text']
+    lw, lc, la = loaded['text'], loaded['chars'], loaded['arcs']
+    # encoding goes through the hash table - no dicts get built
+    seqs = [['the', 'lake'], [], [u'ελα']]
+    assert np.array_equal(lw.encode_batch(seqs)[0], words.encode_batch(seqs)[0])
+    seqs = [list('the lake'), list(u'ελα')]
+    assert np.array_equal(lc.encode_batch(seqs)[0], chars.encode_batch(seqs)[0])
+    assert lw._index is None and lc._index is None
+    assert lc._char_table is None
+    assert len(lw) == len(words) and len(la) == len(arcs)
+    assert lw.out_size == words.out_size
+    for w in s:
+        assert lw[w] == words[w]
+        assert lw.count(w) == words.counts[w]
+    assert 'supercalifragilistic' not in lw
+    assert lw.index == words.index
+    assert la.rev_index == arcs.rev_index
+    assert np.array_equal(lc.char_table, chars.char_table)
+    assert la.encode(['nsubj', 'root']) == arcs.encode(['nsubj', 'root'])
+    try:
+        la.encode(['not a label'])
+        assert False
+    except KeyError:
+        pass
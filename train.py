@@ -1,18 +1,23 @@
 import os
 import sys
-import dill
 import chainer
 import numpy as np
 from mlconf import YAMLLoaderAction, ArgumentParser
 from tqdm import tqdm
 from itertools import chain
+from contextlib import closing
 from collections import namedtuple
 from johnny import EXP_ENV_VAR
-from johnny.dep import UDepLoader
-from johnny.vocab import Vocab, UDepVocab # , UPOSVocab
-from johnny.misc import visualise_dict, BucketManager
-from johnny.metrics import Average, UAS, LAS
-from johnny.text_utils import process_text, encode_texts
+from johnny.dep import UDepLoader, Shard
+from johnny.corpus import MemmapCorpus
+from johnny.checkpoint import AsyncCheckpointer, training_state, load_training_state
+from johnny.bundle import save_bundle
+from johnny.parallel import DataParallel
+from johnny.vocab import Vocab, UDepVocab, split_ids, save_vocabs # , UPOSVocab
+from johnny.misc import visualise_dict, BucketManager, Prefetcher, stratified_sample
+from johnny.misc import StageTimer, MemoryTracker, NULL_TIMER
+from johnny.metrics import Average, UAS, LAS, StratifiedRatio, add_batch_preds, sentence_sums
+from johnny.text_utils import process_texts, encode_texts
 
 
 np.set_printoptions(precision=5, suppress=True)
@@ -20,6 +25,9 @@ np.set_printoptions(precision=5, suppress=True)
 vocab_tup = namedtuple('Vocabs', ('text', 'arcs'))
 data_tup = namedtuple('DataCols', ('text', 'heads', 'arcs'))
 
+# the word vocab the rows of a memmap corpus were encoded with
+CORPUS_VOCAB = 'text.vocab'
+
 
 def seed_chainer(seed, gpu_id):
     np.random.seed(seed)
@@ -34,8 +42,7 @@ def seed_chainer(seed, gpu_id):
 
 
 def dataset_to_cols(dataset, conf):
-    text = tuple(process_text(s, conf.ngram, conf.subword, conf.preprocess)
-                 for s in dataset.words)
+    text = process_texts(dataset.words, conf.ngram, conf.subword, conf.preprocess)
     return data_tup(text, dataset.heads, dataset.arctags)
 
 
@@ -44,7 +51,7 @@ def data_to_rows(data, vocabs, conf):
     rows. Each row is a training instance containing both inputs and
     targets (inputs first, targets later)."""
     text_ids = encode_texts(data.text, vocabs.text, conf.subword)
-    label_ids = tuple(map(vocabs.arcs.encode, data.arcs))
+    label_ids = split_ids(*vocabs.arcs.encode_batch(data.arcs))
     # NOTE: The order of the following args in the zip matters
     data_rows = zip(text_ids, data.heads, label_ids)
     return tuple(data_rows)
@@ -61,46 +68,202 @@ def to_batches(rows, batch_size, sort=False):
         batch = rows[i: i + batch_size]
 
 
-def train_epoch(model, optimizer, buckets, data_size):
-    iters = 0
-    tf_str = 'Train: batch_size={0:d}, mean loss={1:.2f}, mean LAS={3:.3f} mean UAS={2:.3f}'
-    with tqdm(total=data_size, leave=False) as pbar, \
-        chainer.using_config('train', True):
-
-        mean_loss = Average()
-        u_scorer = UAS()
-        l_scorer = LAS()
+def train_epoch(model, optimizer, buckets, data_size, prefetch=0,
+                parallel=None, accumulate=1, accumulate_tokens=None,
+                timer=None, memory=None, memory_budget=None):
+    """Train on batches from buckets until we have seen data_size rows.
+
+    prefetch: how many batches to prepare ahead in a background thread
+    while the model is training on the current one (0 means prepare each
+    batch when we need it).
+
+    parallel: a johnny.parallel.DataParallel - if specified each step is
+    taken on one batch per worker.
+
+    accumulate: accumulate the gradients of this many batches before each
+    optimizer step.
+
+    accumulate_tokens: if specified, accumulate the gradients of batches
+    until we have seen this many tokens instead (accumulate is ignored).
+
+    timer: a johnny.misc.StageTimer - if specified we time the stages of
+    each step (waiting for data, forward - broken down by GraphParser, -
+    backward and the optimizer update) and add the totals to the stats.
+
+    memory: a johnny.misc.MemoryTracker - if specified we record the peak
+    memory of the forward and backward pass of each batch and add it (by
+    length bucket) to the stats. tracemalloc sees the allocations of all
+    threads, so batches prepared by prefetch in the meantime count too.
+
+    memory_budget: int - if specified, batches that model.activation_bytes
+    predicts need more bytes than this are split in parts that don't, and
+    the gradients of the parts are accumulated - the step is the same as
+    that on the whole batch.
+    """
+    timer = timer or NULL_TIMER
+    if parallel is not None and (accumulate > 1 or accumulate_tokens or
+                                 memory_budget):
+        raise ValueError('Gradient accumulation is not supported with '
+                         'data parallel training')
+
+    def batches():
+        # we stop drawing from buckets exactly where training stops, so
+        # nothing is left half consumed in the background at checkpoints
+        seen = 0
         for batch in buckets:
-            seqs = list(zip(*batch))
+            yield batch
+            seen += len(batch)
+            if seen >= data_size:
+                break
+
+    def split(batch):
+        if memory_budget is None:
+            return [batch]
+        max_len = max(len(row[0]) for row in batch)
+        # memory is linear in the number of rows
+        row_bytes = model.activation_bytes(1, max_len)
+        part_size = max(int(memory_budget // row_bytes), 1)
+        return [batch[i:i + part_size] for i in range(0, len(batch), part_size)]
+
+    # we prepare a list of parts for each batch - see memory_budget
+    def prepare(batch):
+        parts = []
+        for part in split(batch):
+            seqs = list(zip(*part))
             label_batch = seqs.pop()
             head_batch = seqs.pop()
-            arc_preds, lbl_preds = model(*seqs, heads=head_batch, labels=label_batch)
-            loss = model.loss
-            model.cleargrads()
+            prepared = model.prepare_batch(*seqs, heads=head_batch,
+                                           labels=label_batch)
+            parts.append((prepared, head_batch, label_batch))
+        return parts
+
+    # each step yields the loss and for each batch in the step:
+    # (arc predictions, label predictions, gold heads, gold labels)
+    def single_steps():
+        if prefetch > 0:
+            prepared_batches = Prefetcher(batches(), prepare, size=prefetch)
+        else:
+            prepared_batches = (prepare(batch) for batch in batches())
+        with closing(prepared_batches):
+            micro_batches, num_batches, num_tokens = [], 0, 0
+            while True:
+                with timer.stage('data'):
+                    parts = next(prepared_batches, None)
+                if parts is None:
+                    break
+                micro_batches.extend(parts)
+                num_batches += 1
+                num_tokens += sum(prepared.num_tokens for prepared, _, _ in parts)
+                if accumulate_tokens is not None:
+                    full = num_tokens >= accumulate_tokens
+                else:
+                    full = num_batches >= accumulate
+                if full:
+                    yield accumulated_step(micro_batches, num_tokens)
+                    micro_batches, num_batches, num_tokens = [], 0, 0
+            if micro_batches:
+                yield accumulated_step(micro_batches, num_tokens)
+
+    def forward_backward(batch, num_tokens):
+        with timer.stage('forward'):
+            arc_preds, lbl_preds = model(batch)
+        loss = model.loss * (batch.num_tokens / float(num_tokens))
+        with timer.stage('backward'):
             loss.backward()
+        # backward doesn't free the graph - the arrays it retains for the
+        # gradients would stay alive until the next forward pass replaces
+        # model.loss, doubling the peak memory of accumulated steps
+        loss.unchain_backward()
+        return arc_preds, lbl_preds, loss
+
+    def accumulated_step(micro_batches, num_tokens):
+        # each batch loss is normalised by the tokens in the batch, we
+        # reweight so that the accumulated gradient is that of the loss
+        # normalised by the tokens in all micro batches - same as
+        # training on all micro batches in a single batch
+        model.cleargrads()
+        loss_value, results = 0., []
+        for batch, head_batch, label_batch in micro_batches:
+            if memory is None:
+                arc_preds, lbl_preds, loss = forward_backward(batch, num_tokens)
+            else:
+                max_len = int(np.max(batch.lengths))
+                with memory.track(max_len, model.activation_bytes(
+                        len(batch.lengths), max_len)):
+                    arc_preds, lbl_preds, loss = forward_backward(batch,
+                                                                  num_tokens)
+            loss_value += float(loss.data)
+            results.append((arc_preds, lbl_preds, head_batch, label_batch))
+        with timer.stage('optimizer'):
             optimizer.update()
+        return loss_value, results
+
+    def parallel_steps():
+        group = []
+        for batch in batches():
+            group.append(batch)
+            if len(group) == parallel.num_workers:
+                yield parallel_step(group)
+                group = []
+        if group:
+            yield parallel_step(group)
+
+    def parallel_step(group):
+        # the stages inside the workers are not timed
+        with timer.stage('parallel_update'):
+            loss_value, preds = parallel.update(group)
+        return loss_value, [(arc_preds, lbl_preds,
+                             [row[-2] for row in batch],
+                             [row[-1] for row in batch])
+                            for batch, (arc_preds, lbl_preds)
+                            in zip(group, preds)]
+
+    steps = single_steps() if parallel is None else parallel_steps()
+    model.set_timer(timer)
 
-            loss_value = float(loss.data)
+    tf_str = 'Train: batch_size={0:d}, mean loss={1:.2f}, mean LAS={3:.3f} mean UAS={2:.3f}'
+    with tqdm(total=data_size, leave=False) as pbar, \
+        closing(steps), \
+        chainer.using_config('train', True):
 
-            for p_arcs, p_lbls, t_arcs, t_lbls in zip(arc_preds, lbl_preds, head_batch, label_batch):
-                u_scorer(arcs=(p_arcs, t_arcs))
-                l_scorer(arcs=(p_arcs, t_arcs), labels=(p_lbls, t_lbls))
+        mean_loss = Average()
+        u_scorer = UAS()
+        l_scorer = LAS()
+        num_sents, num_tokens = 0, 0
+        for loss_value, step_batches in steps:
+            step_size = 0
+            for arc_preds, lbl_preds, head_batch, label_batch in step_batches:
+                offsets = add_batch_preds(u_scorer, l_scorer, arc_preds,
+                                          lbl_preds, head_batch, label_batch)[-1]
+                step_size += len(head_batch)
+                num_tokens += int(offsets[-1])
+            num_sents += step_size
             mean_loss(loss_value)
-            out_str = tf_str.format(len(batch), mean_loss.score, u_scorer.score, l_scorer.score)
+            out_str = tf_str.format(step_size, mean_loss.score, u_scorer.score, l_scorer.score)
             pbar.set_description(out_str)
-            iters += len(batch)
-            pbar.update(len(batch))
-            if iters >= data_size:
-                break
+            pbar.update(step_size)
         time_taken = pbar._time() - pbar.start_t
+    model.set_timer(None)
     stats = {'train_time': time_taken,
              'train_mean_loss': mean_loss.score,
              'train_uas': u_scorer.score,
-             'train_las': l_scorer.score}
+             'train_las': l_scorer.score,
+             'train_sents_per_sec': num_sents / max(time_taken, 1e-9),
+             'train_tokens_per_sec': num_tokens / max(time_taken, 1e-9)}
+    stats.update(timer.as_dict(prefix='train_time_'))
+    if memory is not None:
+        stats.update(memory.as_dict(prefix='train_mem_'))
     return stats
 
 
-def eval_epoch(model, buckets, data_size, label='', num_labels=None):
+def eval_epoch(model, buckets, data_size, label='', num_labels=None,
+               estimator=None):
+    """Score the model on batches from buckets.
+
+    estimator: a johnny.metrics.StratifiedRatio - if specified the batches
+    are a stratified sample of the dev set. LAS is then the estimate of the
+    LAS of the whole dev set and we also return its standard error.
+    """
     def label_stat(stat):
         return '%s_%s' % (label, stat)
 
@@ -113,6 +276,7 @@ def eval_epoch(model, buckets, data_size, label='', num_labels=None):
         mean_loss = Average()
         u_scorer = UAS()
         l_scorer = LAS(num_labels=num_labels)
+        num_sents, num_tokens = 0, 0
         for batch in buckets:
             # model.reset_state()
             seqs = list(zip(*batch))
@@ -123,13 +287,19 @@ def eval_epoch(model, buckets, data_size, label='', num_labels=None):
 
             loss_value = float(loss.data)
 
-            for p_arcs, p_lbls, t_arcs, t_lbls in zip(arc_preds, lbl_preds, head_batch, label_batch):
-                u_scorer(arcs=(p_arcs, t_arcs))
-                l_scorer(arcs=(p_arcs, t_arcs), labels=(p_lbls, t_lbls))
+            p_arcs, t_arcs, p_lbls, t_lbls, offsets = add_batch_preds(
+                u_scorer, l_scorer, arc_preds, lbl_preds, head_batch, label_batch)
+            if estimator is not None:
+                correct = (p_arcs == t_arcs) & (p_lbls == t_lbls)
+                estimator.add_batch(sentence_sums(correct, offsets),
+                                    np.diff(offsets))
             mean_loss(loss_value)
+            num_sents += len(batch)
+            num_tokens += len(t_arcs)
             out_str = tf_str.format(len(batch), mean_loss.score, u_scorer.score, l_scorer.score)
             pbar.set_description(out_str)
             pbar.update(len(batch))
+        time_taken = pbar._time() - pbar.start_t
     # if num_labels is None:
     #     conf_matrix = [[]]
     # else:
@@ -137,23 +307,92 @@ def eval_epoch(model, buckets, data_size, label='', num_labels=None):
     # conf_matrix = [[]]
     stats = {label_stat('mean_loss'): mean_loss.score,
              label_stat('uas'): u_scorer.score,
-             label_stat('las'): l_scorer.score}
+             label_stat('las'): l_scorer.score,
+             label_stat('sents_per_sec'): num_sents / max(time_taken, 1e-9),
+             label_stat('tokens_per_sec'): num_tokens / max(time_taken, 1e-9)}
              # label_stat('conf_matrix'): conf_matrix}
+    if estimator is not None:
+        stats[label_stat('las')] = estimator.score
+        stats[label_stat('las_stderr')] = estimator.stderr
     return stats
 
 
-def train_loop(train_rows, dev_rows, conf, checkpoint_callback=None, gpu_id=-1):
+def train_loop(train_rows, dev_rows, conf, checkpoint_callback=None, gpu_id=-1,
+               state_path=None, resume=False, results=None, workers=0):
+    """Train conf.model on train_rows, checkpointing on dev_rows.
+
+    state_path: if specified, the full training state (model, optimizer,
+    position in the training data, random state and counters) is saved
+    there at each checkpoint.
+
+    resume: whether to continue from the state saved in state_path.
+
+    results: dict of results so far - saved along with the state and
+    restored in place when resuming.
 
+    workers: if > 0, train data parallel on the cpu with this many
+    worker processes, each computing the gradients of one batch per step.
+
+    conf.accumulate.batches / conf.accumulate.tokens: accumulate gradients
+    over several batches (or batches totalling this many tokens) before
+    each optimizer step (see train_epoch).
+
+    conf.valid_sample.size: if specified, score a sample of this many dev
+    sentences (stratified by length) at each checkpoint and only score the
+    full dev set when the sample LAS plus conf.valid_sample.z standard
+    errors is better than the best so far. Checkpoints that skip the full
+    dev set report the last full scores and valid_full=False.
+
+    conf.profile: if True, time the stages of training (see train_epoch)
+    and add the total time of each stage since the last checkpoint to the
+    checkpoint stats as train_time_<stage>.
+
+    conf.memory.track: if True, record the peak memory of each batch and
+    add it, by length bucket, to the checkpoint stats as train_mem_by_bucket
+    (along with the peak resident memory of the process, train_mem_peak_rss).
+    Prefetching is turned off, so that only the batch itself is measured.
+
+    conf.memory.budget_mb: if specified, split batches the model predicts
+    need more memory than this and accumulate the gradients of the parts.
+    """
+
+    # if we have a token budget, batches are only capped by cost unless
+    # we also specify a max batch size
+    token_budget = conf.get('train_buckets.token_budget')
+    if token_budget is None:
+        batch_size = conf.batch_size
+    else:
+        batch_size = conf.get('train_buckets.max_batch_size')
     train_buckets = BucketManager(train_rows,
                                   conf.train_buckets.bucket_width,
                                   conf.dataset.train_max_sent_len,
                                   shuffle=True,
-                                  batch_size=conf.batch_size,
+                                  batch_size=batch_size,
                                   right_leak=conf.train_buckets.right_leak,
                                   row_key=lambda x: len(x[0]),
-                                  loop_forever=True)
+                                  loop_forever=True,
+                                  lengths=getattr(train_rows, 'lengths', None),
+                                  token_budget=token_budget,
+                                  budget_cost=conf.get('train_buckets.budget_cost',
+                                                       'tokens'))
     dev_batches = tuple(to_batches(dev_rows, conf.dev_batch_size, sort=True))
 
+    sample_size = conf.get('valid_sample.size')
+    if sample_size is not None and sample_size < len(dev_rows):
+        # the sample has its own random state, so it is the same across
+        # runs and doesn't change the random state of training
+        sample_indices, edges, stratum_sizes = stratified_sample(
+            [len(row[0]) for row in dev_rows], sample_size,
+            num_strata=conf.get('valid_sample.strata', 10),
+            random_state=np.random.RandomState(conf.get('valid_sample.seed', 0)))
+        sample_rows = [dev_rows[i] for i in sample_indices]
+        sample_batches = tuple(to_batches(sample_rows, conf.dev_batch_size,
+                                          sort=True))
+        estimator = StratifiedRatio(edges, stratum_sizes, label='LAS')
+        z = conf.get('valid_sample.z', 2.)
+    else:
+        sample_batches = None
+
     print('training max seq len ', train_buckets.max_len)
 
     model = conf.model
@@ -174,42 +413,141 @@ def train_loop(train_rows, dev_rows, conf, checkpoint_callback=None, gpu_id=-1):
     iters_per_epoch = len(train_rows)
     current_iters = 0
     current_checkpoint = 0
+    # scores of the last time we evaluated on the full dev set
+    valid_stats = None
+
+    if resume:
+        if os.path.exists(state_path):
+            counters = load_training_state(state_path, model, opt, train_buckets)
+            e = counters['epoch']
+            best_valid_las = counters['best_valid_las']
+            patience = counters['patience']
+            current_iters = counters['current_iters']
+            current_checkpoint = counters['current_checkpoint']
+            valid_stats = counters.get('valid_stats')
+            if results is not None:
+                results.clear()
+                results.update(counters['results'])
+            print('Resuming from checkpoint %d (epoch %d)'
+                  % (current_checkpoint, e))
+        else:
+            print('No training state in %s - starting from scratch' % state_path)
 
-    pbar = tqdm(desc='Epoch 0 - Patience %d' % patience)
-    while e < conf.max_epochs:
-        checkpoint_stats = dict()
-        # train
-        stats = train_epoch(model, opt, train_buckets, cp_iters)
-
-        checkpoint_stats.update(**stats)
-
-        # score dev set
-        stats = eval_epoch(model, dev_batches, data_size=len(dev_rows),
-                           label='valid', num_labels=conf.model.num_labels)
-        checkpoint_stats.update(**stats)
-
-        if checkpoint_stats['valid_las'] > best_valid_las:
-            best_valid_las = checkpoint_stats['valid_las']
-            patience = conf.checkpoint.patience
+    state_saver, parallel, memory = None, None, None
+    # make sure queued checkpoints get written and workers exit even if
+    # training is interrupted
+    try:
+        # we fork the workers once the model is in its final state - and
+        # before we start any threads, they don't survive a fork
+        if workers > 0:
+            if gpu_id >= 0:
+                raise ValueError('Data parallel training is only supported on cpu')
+            parallel = DataParallel(model, opt, workers)
+
+        # the state is snapshotted in memory and written in the background
+        if state_path is not None:
+            state_saver = AsyncCheckpointer(keep=conf.get('checkpoint.keep', 1),
+                                            name='state')
+
+        if conf.get('profile', False):
+            # kernels run asynchronously on the gpu - wait for them
+            timer = StageTimer(sync=chainer.cuda.Device(gpu_id).synchronize
+                               if gpu_id >= 0 else None)
         else:
-            patience -= 1
-        checkpoint_stats.update(patience=patience)
-
-        current_iters += cp_iters
-        e = int(current_iters / iters_per_epoch)
-        current_checkpoint += 1
-        pbar.set_description('Epoch %d - Patience %d - Best LAS: %.2f UAS: %.2f'
-                             % (e, patience, best_valid_las * 100,
-                                checkpoint_stats['valid_uas'] * 100))
-        pbar.update()
-
-        if checkpoint_callback is not None:
-            checkpoint_callback(e, checkpoint_stats,
-                                improved=(patience == conf.checkpoint.patience))
-
-        if patience == 0:
-            break
-    pbar.close()
+            timer = None
+
+        prefetch = conf.get('prefetch', 0)
+        if conf.get('memory.track', False):
+            memory = MemoryTracker(train_buckets)
+            # otherwise the peaks include batches the prefetch thread
+            # prepares in the meantime
+            prefetch = 0
+        memory_budget = conf.get('memory.budget_mb')
+        if memory_budget is not None:
+            memory_budget = int(memory_budget * 2 ** 20)
+
+        pbar = tqdm(desc='Epoch %d - Patience %d' % (e, patience))
+        while e < conf.max_epochs:
+            checkpoint_stats = dict()
+            # train
+            if timer is not None:
+                timer.reset()
+            if memory is not None:
+                memory.reset()
+            stats = train_epoch(model, opt, train_buckets, cp_iters,
+                                prefetch=prefetch,
+                                parallel=parallel,
+                                accumulate=conf.get('accumulate.batches', 1),
+                                accumulate_tokens=conf.get('accumulate.tokens'),
+                                timer=timer, memory=memory,
+                                memory_budget=memory_budget)
+
+            checkpoint_stats.update(**stats)
+
+            # score dev set
+            if sample_batches is None:
+                full_eval = True
+            else:
+                estimator.reset()
+                stats = eval_epoch(model, sample_batches, data_size=len(sample_rows),
+                                   label='valid_sample',
+                                   num_labels=conf.model.num_labels,
+                                   estimator=estimator)
+                checkpoint_stats.update(**stats)
+                upper = stats['valid_sample_las'] + z * stats['valid_sample_las_stderr']
+                full_eval = valid_stats is None or upper > best_valid_las
+                checkpoint_stats.update(valid_full=full_eval)
+            if full_eval:
+                valid_stats = eval_epoch(model, dev_batches, data_size=len(dev_rows),
+                                         label='valid',
+                                         num_labels=conf.model.num_labels)
+            checkpoint_stats.update(**valid_stats)
+
+            if full_eval and checkpoint_stats['valid_las'] > best_valid_las:
+                best_valid_las = checkpoint_stats['valid_las']
+                patience = conf.checkpoint.patience
+            else:
+                patience -= 1
+            checkpoint_stats.update(patience=patience)
+
+            current_iters += cp_iters
+            e = int(current_iters / iters_per_epoch)
+            current_checkpoint += 1
+            pbar.set_description('Epoch %d - Patience %d - Best LAS: %.2f UAS: %.2f'
+                                 % (e, patience, best_valid_las * 100,
+                                    checkpoint_stats['valid_uas'] * 100))
+            pbar.update()
+
+            if state_saver is not None:
+                # stats of the last state write that finished
+                checkpoint_stats.update(**state_saver.stats())
+
+            if checkpoint_callback is not None:
+                checkpoint_callback(e, checkpoint_stats,
+                                    improved=(patience == conf.checkpoint.patience))
+
+            if state_saver is not None:
+                counters = dict(epoch=e,
+                                best_valid_las=best_valid_las,
+                                patience=patience,
+                                current_iters=current_iters,
+                                current_checkpoint=current_checkpoint,
+                                valid_stats=valid_stats,
+                                results=results if results is not None else {})
+                state_saver.save(state_path, training_state(model, opt,
+                                                            train_buckets, counters))
+
+            if patience == 0:
+                break
+        pbar.close()
+    finally:
+        if parallel is not None:
+            parallel.close()
+        if memory is not None:
+            memory.close()
+        # waits for the last state to be written
+        if state_saver is not None:
+            state_saver.close()
     return model
 
 if __name__ == "__main__":
@@ -231,6 +569,34 @@ if __name__ == "__main__":
     parser.add_argument('--verbose', action='store_true',
                         help='Whether to print additional info such '
                         'as model and vocabulary info.')
+    parser.add_argument('--shard_index', type=int, default=0,
+                        help='Which shard of the training data to load.')
+    parser.add_argument('--num_shards', type=int, default=1,
+                        help='How many shards to split the training data in.')
+    parser.add_argument('--sample_ratio', type=float, default=1.,
+                        help='Load a deterministic subsample of this ratio '
+                        'of the training data.')
+    parser.add_argument('--memmap_corpus', type=str, default=None,
+                        help='If specified, the encoded training rows are '
+                        'written to this folder (along with the word vocab) '
+                        'and read back through memory maps instead of being '
+                        'kept in memory. Building it needs the treebank in '
+                        'memory once - later runs with the same folder reuse '
+                        'it as is (whatever the shard or vocab settings) '
+                        'without loading the training data at all.')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Number of processes to train with data parallel '
+                        'on the cpu. Each computes the gradients of one batch '
+                        'and the step is taken on all of them, so the '
+                        'effective batch size is multiplied by this number.')
+    parser.add_argument('--profile', action='store_true',
+                        help='Time the stages of each training step (encoder, '
+                        'heads, decoding, labels, backward, optimizer) and '
+                        'store the totals of each checkpoint in the results.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue training from the training state saved '
+                        'at the last checkpoint of the experiment with the '
+                        'same name.')
     parser.add_argument('--load_blueprint', action=YAMLLoaderAction)
 
     conf = parser.parse_args()
@@ -244,27 +610,60 @@ if __name__ == "__main__":
         print('Loaded Blueprint settings:\n%s\n' % conf)
 
     print('Loading dataset...')
+    # a corpus built by an earlier run already has the encoded training rows
+    # and the vocab they were encoded with - so we only need the dev set
+    reuse_corpus = (conf.memmap_corpus is not None and
+                    MemmapCorpus.exists(conf.memmap_corpus))
     udep = UDepLoader(conf.dataset.name, datafolder=conf.datafolder)
-    t_set, v_set = udep.load_train_dev(conf.dataset.lang, verbose=conf.verbose)
+    shard = Shard(conf.shard_index, conf.num_shards,
+                  sample_ratio=conf.sample_ratio)
+    t_set, v_set = udep.load_train_dev(conf.dataset.lang, verbose=conf.verbose,
+                                       shard=shard, load_train=not reuse_corpus)
 
-    conf.dataset.train_max_sent_len = t_set.len_stats['max_sent_len']
     conf.dataset.dev_max_sent_len = v_set.len_stats['max_sent_len']
-    
-    t_data = dataset_to_cols(t_set, conf)
-
-    # instantiate vocabs
-    v_word = Vocab(out_size=conf.vocab.size, threshold=conf.vocab.threshold)
     v_arcs = UDepVocab()
 
-    # fit vocabs to data
-    if conf.subword:
-        # if working on subwords, t_data.text is of depth 3: sents, words, chars
-        # so we need to chain to pass a flat list of char ngrams
-        v_word = v_word.fit(chain.from_iterable(chain.from_iterable(t_data.text)))
+    if reuse_corpus:
+        train_rows = MemmapCorpus(conf.memmap_corpus)
+        if train_rows.subword != conf.subword:
+            raise ValueError('The corpus in %s was built with subword=%s'
+                             % (conf.memmap_corpus, train_rows.subword))
+        print('Reusing %s' % train_rows)
+        v_word = Vocab.load(os.path.join(conf.memmap_corpus, CORPUS_VOCAB))
+        conf.dataset.train_max_sent_len = int(np.max(train_rows.lengths))
+        vocabs = vocab_tup(v_word, v_arcs)
     else:
-        v_word = v_word.fit(chain.from_iterable(t_data.text))
+        conf.dataset.train_max_sent_len = t_set.len_stats['max_sent_len']
+
+        t_data = dataset_to_cols(t_set, conf)
 
-    vocabs = vocab_tup(v_word, v_arcs)
+        # instantiate vocabs
+        v_word = Vocab(out_size=conf.vocab.size, threshold=conf.vocab.threshold,
+                       sketch_size=conf.get('vocab.sketch_size'))
+
+        # fit vocabs to data
+        if conf.subword:
+            # if working on subwords, t_data.text is of depth 3: sents, words, chars
+            # so we need to chain to pass a flat list of char ngrams
+            v_word = v_word.fit(chain.from_iterable(chain.from_iterable(t_data.text)))
+        else:
+            v_word = v_word.fit(chain.from_iterable(t_data.text))
+
+        vocabs = vocab_tup(v_word, v_arcs)
+
+        train_rows = data_to_rows(t_data, vocabs, conf)
+        if conf.memmap_corpus:
+            # the vocab goes first - the corpus only counts as built once
+            # MemmapCorpus.build is done
+            if not os.path.isdir(conf.memmap_corpus):
+                os.makedirs(conf.memmap_corpus)
+            v_word.save(os.path.join(conf.memmap_corpus, CORPUS_VOCAB))
+            train_rows = MemmapCorpus.build(conf.memmap_corpus, train_rows,
+                                            subword=conf.subword)
+            if conf.verbose:
+                print(train_rows)
+        # the rows are all we need from here on
+        del t_set, t_data
 
     # visualise vocabs
     if conf.verbose:
@@ -272,8 +671,6 @@ if __name__ == "__main__":
             print(v)
             visualise_dict(v.index, num_items=50)
 
-    train_rows = data_to_rows(t_data, vocabs, conf)
-
     v_data = dataset_to_cols(v_set, conf)
     dev_rows = data_to_rows(v_data, vocabs, conf)
 
@@ -307,11 +704,20 @@ if __name__ == "__main__":
     blueprint_path = os.path.join(lang_folder, blueprint_filename)
     model_path = os.path.join(lang_folder, model_filename)
     vocab_path = os.path.join(lang_folder, vocab_filename)
+    state_path = os.path.join(lang_folder, '%s.state.npz' % filename)
 
     # prepare for results
     conf.results = dict()
 
+    # models are snapshotted in memory and written in the background - the
+    # thread starts with the first save, after train_loop forks any workers
+    model_saver = AsyncCheckpointer(keep=conf.get('checkpoint.keep', 1),
+                                    compress=conf.get('checkpoint.compress', False),
+                                    name='model')
+
     def on_epoch_end(epoch, epoch_stats, improved):
+        # stats of the last model write that finished
+        epoch_stats.update(**model_saver.stats())
         if conf.results:
             for key, value in epoch_stats.items():
                 conf.results[key].append(value)
@@ -320,45 +726,54 @@ if __name__ == "__main__":
                 conf.results[key] = [value]
         if improved:
             print(' Saving model..')
-            chainer.serializers.save_npz(model_path, built_conf.model)
-
-    if conf.visualise:
-        import pynput
-
-        def on_press(key):
-            INCREMENT = 0.1
-            if key == pynput.keyboard.Key.esc:
-                built_conf.model.visualise = not built_conf.model.visualise
-            elif key == pynput.keyboard.Key.up:
-                built_conf.model.sleep_time += INCREMENT
-            elif key == pynput.keyboard.Key.down:
-                if built_conf.model.sleep_time >= INCREMENT:
-                    built_conf.model.sleep_time -= INCREMENT
-
-        if 'v2_0' not in built_conf.dataset.name:
-            print('### Sorry! visualisation only supported for Universal Dependencies v2.0\n'
-                  'Try without the --visualise flag.')
-            sys.exit(1)
-        try:
-            with pynput.keyboard.Listener(on_press=on_press) as listener:
-                built_conf.model.visualise = True
-                model = train_loop(train_rows, dev_rows, built_conf,
-                                   checkpoint_callback=on_epoch_end,
-                                   gpu_id=built_conf.gpu_id)
-                pynput.keyboard.Listener.stop
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
-            print('Cannot use visualisation - try without')
-    else:
-        model = train_loop(train_rows, dev_rows, built_conf,
-                           checkpoint_callback=on_epoch_end, gpu_id=built_conf.gpu_id)
-    
+            model_saver.save_model(model_path, built_conf.model)
+
+    try:
+        if conf.visualise:
+            import pynput
+
+            def on_press(key):
+                INCREMENT = 0.1
+                if key == pynput.keyboard.Key.esc:
+                    built_conf.model.visualise = not built_conf.model.visualise
+                elif key == pynput.keyboard.Key.up:
+                    built_conf.model.sleep_time += INCREMENT
+                elif key == pynput.keyboard.Key.down:
+                    if built_conf.model.sleep_time >= INCREMENT:
+                        built_conf.model.sleep_time -= INCREMENT
+
+            if 'v2_0' not in built_conf.dataset.name:
+                print('### Sorry! visualisation only supported for Universal Dependencies v2.0\n'
+                      'Try without the --visualise flag.')
+                sys.exit(1)
+            try:
+                with pynput.keyboard.Listener(on_press=on_press) as listener:
+                    built_conf.model.visualise = True
+                    model = train_loop(train_rows, dev_rows, built_conf,
+                                       checkpoint_callback=on_epoch_end,
+                                       gpu_id=built_conf.gpu_id,
+                                       state_path=state_path,
+                                       resume=conf.resume,
+                                       results=conf.results,
+                                       workers=conf.workers)
+                    pynput.keyboard.Listener.stop
+            except Exception as e:
+                import traceback
+                traceback.print_exc()
+                print('Cannot use visualisation - try without')
+        else:
+            model = train_loop(train_rows, dev_rows, built_conf,
+                               checkpoint_callback=on_epoch_end, gpu_id=built_conf.gpu_id,
+                               state_path=state_path, resume=conf.resume,
+                               results=conf.results, workers=conf.workers)
+    finally:
+        # wait for the last model to be written, even if interrupted
+        model_saver.close()
+
     try:
         conf.model_path = model_path
         print('Writing vocabs to %s' % vocab_path)
-        with open(vocab_path, 'wb') as pf:
-            dill.dump(vocabs, pf)
+        save_vocabs(vocab_path, vocabs._asdict())
         conf.vocab_path = vocab_path
         print('Writing blueprint to %s' % blueprint_path)
         conf.to_file(blueprint_path)
@@ -366,3 +781,9 @@ if __name__ == "__main__":
         os.remove(model_path)
         os.remove(vocab_path)
         os.remove(blueprint_path)
+
+    # a self contained copy of the model that loads fast (see johnny.bundle)
+    if os.path.exists(model_path) and os.path.exists(blueprint_path):
+        bundle_path = os.path.join(lang_folder, '%s.bundle' % filename)
+        print('Writing bundle to %s' % bundle_path)
+        save_bundle(bundle_path, conf.as_dict(), model_path, vocab_path)